@@ -1,24 +1,39 @@
+import io
 import os
-import logging
+import html
 import json
-import re
-import yaml
-import sqlite3
+import logging
 import threading
 import time
+import functools
 from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
-import openai
-import tiktoken
+from telegram.ext import Updater, CommandHandler, MessageHandler, TypeHandler, Filters, CallbackContext, CallbackQueryHandler
 from database import (
-    init_database, register_user, get_user_credits, update_user_credits,
-    record_usage, get_all_users, set_admin_status, is_admin,
+    ensure_schema, get_user, register_user, delete_user, get_user_credits,
+    record_usage, get_users_page, set_admin_status, is_admin,
     save_conversation_context, get_conversation_context, clear_conversation_context,
-    clear_inactive_conversations, DATABASE_PATH
+    clear_inactive_conversations, get_usage_stats, get_user_preference, set_user_preference,
+    get_archived_conversations, get_broadcast, list_broadcasts, get_credit_ledger,
+    reserve_credits, commit_credits, release_credits
 )
 from paypal_bot_integration import register_payment_handlers, handle_deep_link_start
+from paypal_payment import has_completed_payment
+from profiling import profiler, profiled, MODE_DETERMINISTIC, MODE_SAMPLING
+from tracing import trace_update, span, flush as flush_traces, SPAN_KIND_CLIENT
+from model_registry import ModelRegistry, DEFAULT_MODEL_KEY, DEFAULT_OPENAI_MODEL
+from rate_limiter import rate_limiter
+from openai_client import openai_client, GenerationError, REASON_CIRCUIT_OPEN, REASON_OVERLOADED, REASON_UNKNOWN
+from generation_scheduler import generation_scheduler, PRIORITY_ADMIN, PRIORITY_PAYING, PRIORITY_FREE
+from message_coalescer import MessageCoalescer
+from lifecycle import lifecycle, SHUTDOWN_DRAIN_SECONDS
+from update_dedup import update_deduplicator, skip_duplicate_update, update_dedup_prune_loop
+from storage import get_storage
+from rendering import send_rendered, sanitize_html
+from retention import retention_loop
+from ledger_check import ledger_check_loop, credit_hold_sweeper_loop
+from broadcast import broadcaster, BROADCAST_SEGMENTS
 
 # Load environment variables
 load_dotenv()
@@ -35,57 +50,58 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ADMIN_USER_ID = int(os.getenv('ADMIN_USER_ID', '0'))  # Default admin user ID
 NOTIFICATION_CHANNEL = 'https://t.me/trabajadoreswriteai'  # Canal para notificaciones
-
-# Configure OpenAI
-openai.api_key = OPENAI_API_KEY
+# Turns that were not answered before shutdown are saved here and replayed on start
+PENDING_TURNS_PATH = os.getenv('PENDING_TURNS_PATH', 'pending_turns.json')
 
 # Constants
 DEFAULT_CREDITS_PER_MESSAGE = 1
-DEFAULT_MODEL = "gpt-3.5-turbo"
+# Per-persona models and limits live in modelos.json; this one is used for token counting
+DEFAULT_MODEL = DEFAULT_OPENAI_MODEL
 CONVERSATION_TIMEOUT_MINUTES = 30  # Tiempo de inactividad antes de reiniciar una conversación
 
 # Variable global para almacenar la referencia al bot
 bot_instance = None
 
-# Initialize the database
-init_database()
-
-# Set initial admin if provided
-if ADMIN_USER_ID > 0:
-    set_admin_status(ADMIN_USER_ID, True)
-    logger.info(f"Set user {ADMIN_USER_ID} as admin")
+# tiktoken is imported lazily so importing this module stays fast and free of
+# side effects; see create_app(). OpenAI is wrapped by openai_client.
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=DEFAULT_MODEL):
+    """Load (once) the tiktoken encoding for a model."""
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
 
-# Load AI models from file
-def load_models():
-    try:
-        with open("modelos.json", "r", encoding="utf-8") as file:
-            models_data = json.load(file)
-            return models_data
-    except Exception as e:
-        logger.error(f"Error loading models: {e}")
-        return {}
-
-AI_MODELS = load_models()
+def warm_up_tokenizer():
+    """Load the tokenizer and the models file in a background thread."""
+    def warm_up():
+        started = time.perf_counter()
+        try:
+            get_encoding()
+            AI_MODELS.reload_if_changed()
+            logger.info(f"Tokenizer warmed up in {(time.perf_counter() - started) * 1000:.0f} ms")
+        except Exception as e:
+            logger.error(f"Error warming up tokenizer: {e}")
+    thread = threading.Thread(target=warm_up, daemon=True)
+    thread.start()
+    return thread
 
 def count_tokens(text, model=DEFAULT_MODEL):
     """Count the number of tokens in a text."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        encoding = get_encoding(model)
         return len(encoding.encode(text))
     except Exception as e:
         logger.error(f"Error counting tokens: {e}")
         return len(text) // 4  # Rough estimate
 
+# AI models from modelos.json (se carga al primer uso y se recarga si el archivo cambia)
+AI_MODELS = ModelRegistry("modelos.json", token_counter=count_tokens, autoload=False)
+
 def start(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued and reset conversation context."""
     user = update.effective_user
     
     # Check if user exists before registering
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE user_id = ?", (user.id,))
-    existing_user = cursor.fetchone()
-    conn.close()
+    existing_user = get_user(user.id)
     
     # Register user
     register_user(
@@ -183,16 +199,8 @@ def credits_command(update: Update, context: CallbackContext) -> None:
 
 def models_command(update: Update, context: CallbackContext) -> None:
     """Show available AI models with inline buttons."""
-    keyboard = []
-    
-    for model_key, model_data in AI_MODELS.items():
-        if model_key != "assistant":  # Skip the default assistant
-            keyboard.append([InlineKeyboardButton(
-                model_data.get('name', model_key),
-                callback_data=f"select_model_{model_key}"
-            )])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # El teclado se construye una sola vez por versión de modelos.json
+    reply_markup = AI_MODELS.keyboard
     
     update.message.reply_text(
         "🤖 Selecciona un modelo de IA:\n\n"
@@ -206,6 +214,7 @@ def select_model_command(update: Update, context: CallbackContext) -> None:
         "Por favor, usa el comando /modelos para seleccionar un modelo mediante botones."
     )
 
+@profiled
 def handle_button_callback(update: Update, context: CallbackContext) -> None:
     """Handle button callbacks for model selection and other actions."""
     query = update.callback_query
@@ -226,17 +235,13 @@ def handle_button_callback(update: Update, context: CallbackContext) -> None:
         if model_key in AI_MODELS:
             # Store user preference
             try:
-                conn = sqlite3.connect(DATABASE_PATH)
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT OR REPLACE INTO user_preferences (user_id, preference_key, preference_value) VALUES (?, ?, ?)",
-                    (user.id, "model", model_key)
-                )
-                conn.commit()
+                if not set_user_preference(user.id, "model", model_key):
+                    raise RuntimeError("could not save the model preference")
                 
                 # Get welcome message if available
-                welcome_message = AI_MODELS[model_key].get('welcome_message', '')
-                model_name = AI_MODELS[model_key].get('name', model_key)
+                persona = AI_MODELS.get(model_key)
+                welcome_message = persona.welcome_message
+                model_name = persona.name
                 
                 # Edit the message to show the selection
                 query.edit_message_text(
@@ -245,7 +250,6 @@ def handle_button_callback(update: Update, context: CallbackContext) -> None:
                 )
                 
                 logger.info(f"User {user.id} selected model: {model_key}")
-                conn.close()
             except Exception as e:
                 logger.error(f"Error setting model preference: {e}")
                 query.edit_message_text("❌ Error al seleccionar el modelo. Por favor, intenta de nuevo.")
@@ -280,26 +284,28 @@ def handle_button_callback(update: Update, context: CallbackContext) -> None:
         target_user_id = int(query.data.replace("confirm_delete_", ""))
         
         try:
-            # Eliminar usuario de la base de datos
-            conn = sqlite3.connect(DATABASE_PATH)
-            cursor = conn.cursor()
-            
-            # Eliminar registros relacionados primero
-            cursor.execute("DELETE FROM conversation_context WHERE user_id = ?", (target_user_id,))
-            cursor.execute("DELETE FROM user_preferences WHERE user_id = ?", (target_user_id,))
-            cursor.execute("DELETE FROM usage_history WHERE user_id = ?", (target_user_id,))
-            
-            # Finalmente eliminar el usuario
-            cursor.execute("DELETE FROM users WHERE user_id = ?", (target_user_id,))
-            
-            conn.commit()
-            conn.close()
+            # Eliminar usuario y sus registros relacionados
+            delete_user(target_user_id)
             
             query.edit_message_text(f"✅ Usuario con ID {target_user_id} eliminado correctamente.")
             logger.info(f"Admin {user.id} deleted user {target_user_id}")
         except Exception as e:
             logger.error(f"Error deleting user: {e}")
             query.edit_message_text(f"❌ Error al eliminar usuario: {e}")
+    # Handle admin user browser pagination
+    elif query.data.startswith("users_page:"):
+        if not is_admin(user.id):
+            query.edit_message_text("No tienes permisos para realizar esta acción.")
+            return
+        
+        _, purpose, direction, cursor_user_id, search = query.data.split(":", 4)
+        show_user_browser(
+            update,
+            purpose,
+            cursor_user_id=int(cursor_user_id) if cursor_user_id else None,
+            direction=direction,
+            search=search or None
+        )
     # Handle cancel delete
     elif query.data == "cancel_delete":
         query.edit_message_text("Operación cancelada. No se ha eliminado ningún usuario.")
@@ -310,34 +316,84 @@ def handle_button_callback(update: Update, context: CallbackContext) -> None:
         comprar_command(update, context)
     # Handle other callback types here if needed
 
-def admin_command(update: Update, context: CallbackContext) -> None:
-    """Admin command to manage users."""
-    user = update.effective_user
-    
-    if not is_admin(user.id):
-        update.message.reply_text("No tienes permisos para usar este comando.")
-        return
+# Navegador de usuarios paginado para /admin y /eliminar
+USER_BROWSER_ADMIN = "a"
+USER_BROWSER_DELETE = "d"
+# callback_data admite como máximo 64 bytes (UTF-8); los IDs de Telegram tienen hasta 16 dígitos
+CALLBACK_DATA_MAX_BYTES = 64
+USER_BROWSER_PAGE_PREFIX_BYTES = len(f"users_page:{USER_BROWSER_DELETE}:prev:{'9' * 16}:")
+USER_BROWSER_MAX_SEARCH_BYTES = CALLBACK_DATA_MAX_BYTES - USER_BROWSER_PAGE_PREFIX_BYTES
+
+def show_user_browser(update: Update, purpose, cursor_user_id=None, direction="next", search=None) -> None:
+    """Show one page of users with prev/next buttons, loading only that page."""
+    # Se recorta por bytes sin partir caracteres de varios bytes
+    search = search.encode('utf-8')[:USER_BROWSER_MAX_SEARCH_BYTES].decode('utf-8', 'ignore') if search else ""
+    users, has_more = get_users_page(cursor_user_id, direction, search or None)
     
-    # Get all users from database
-    users = get_all_users()
+    if direction == "prev":
+        has_prev, has_next = has_more, cursor_user_id is not None
+    else:
+        has_prev, has_next = cursor_user_id is not None, has_more
     
     # Create keyboard with user buttons
     keyboard = []
     for user_data in users:
         user_id = user_data[0]
         username = user_data[1] or "Sin nombre"
-        keyboard.append([InlineKeyboardButton(
-            f"ID: {user_id} | @{username}",
-            callback_data=f"admin_user_{user_id}"
-        )])
+        if purpose == USER_BROWSER_DELETE:
+            first_name = user_data[2] or ""
+            last_name = user_data[3] or ""
+            display_name = f"{first_name} {last_name}".strip() or "Sin nombre"
+            keyboard.append([InlineKeyboardButton(
+                f"ID: {user_id} | @{username} | {display_name}",
+                callback_data=f"delete_user_{user_id}"
+            )])
+        else:
+            keyboard.append([InlineKeyboardButton(
+                f"ID: {user_id} | @{username}",
+                callback_data=f"admin_user_{user_id}"
+            )])
+    
+    navigation = []
+    if users and has_prev:
+        navigation.append(InlineKeyboardButton(
+            "⬅️ Anterior",
+            callback_data=f"users_page:{purpose}:prev:{users[0][0]}:{search}"
+        ))
+    if users and has_next:
+        navigation.append(InlineKeyboardButton(
+            "Siguiente ➡️",
+            callback_data=f"users_page:{purpose}:next:{users[-1][0]}:{search}"
+        ))
+    if navigation:
+        keyboard.append(navigation)
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    update.message.reply_text(
-        "🔧 Panel de Administración\n\n"
-        "Selecciona un usuario para administrar:",
-        reply_markup=reply_markup
-    )
+    if purpose == USER_BROWSER_DELETE:
+        text = "🗑️ Eliminar Usuario\n\nSelecciona un usuario para eliminar del sistema:"
+    else:
+        text = "🔧 Panel de Administración\n\nSelecciona un usuario para administrar:"
+    if search:
+        text += f"\n\n🔎 Búsqueda: {search}"
+    if not users:
+        text += "\n\nNo se encontraron usuarios."
+    
+    if update.callback_query:
+        update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+    else:
+        update.message.reply_text(text, reply_markup=reply_markup)
+
+def admin_command(update: Update, context: CallbackContext) -> None:
+    """Admin command to manage users. Usage: /admin [username o ID a buscar]"""
+    user = update.effective_user
+    
+    if not is_admin(user.id):
+        update.message.reply_text("No tienes permisos para usar este comando.")
+        return
+    
+    search = context.args[0] if context.args else None
+    show_user_browser(update, USER_BROWSER_ADMIN, search=search)
 
 def eliminar_command(update: Update, context: CallbackContext) -> None:
     """Admin command to delete users (hidden from help menu)."""
@@ -347,32 +403,21 @@ def eliminar_command(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("No tienes permisos para usar este comando.")
         return
     
+    # /eliminar buscar <prefijo> filtra la lista por username o ID
+    if context.args and context.args[0].lower() == "buscar":
+        search = context.args[1] if len(context.args) > 1 else None
+        show_user_browser(update, USER_BROWSER_DELETE, search=search)
+        return
+    
     # Check if an ID was provided as an argument
     if context.args and len(context.args) > 0:
         try:
             target_user_id = int(context.args[0])
             
-            # Verificar que el usuario existe
-            conn = sqlite3.connect(DATABASE_PATH)
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE user_id = ?", (target_user_id,))
-            user_exists = cursor.fetchone()
-            
-            if not user_exists:
+            # Eliminar usuario y sus registros relacionados (False si no existe)
+            if not delete_user(target_user_id):
                 update.message.reply_text(f"❌ No se encontró ningún usuario con ID {target_user_id}.")
-                conn.close()
                 return
-                
-            # Eliminar registros relacionados primero
-            cursor.execute("DELETE FROM conversation_context WHERE user_id = ?", (target_user_id,))
-            cursor.execute("DELETE FROM user_preferences WHERE user_id = ?", (target_user_id,))
-            cursor.execute("DELETE FROM usage_history WHERE user_id = ?", (target_user_id,))
-            
-            # Finalmente eliminar el usuario
-            cursor.execute("DELETE FROM users WHERE user_id = ?", (target_user_id,))
-            
-            conn.commit()
-            conn.close()
             
             update.message.reply_text(f"✅ Usuario con ID {target_user_id} eliminado correctamente.")
             logger.info(f"Admin {user.id} deleted user {target_user_id} using direct command")
@@ -385,62 +430,314 @@ def eliminar_command(update: Update, context: CallbackContext) -> None:
             logger.error(f"Error deleting user: {e}")
             return
     
-    # If no ID provided, show the list of users as before
-    # Get all users from database
-    users = get_all_users()
+    # If no ID provided, show the first page of users
+    show_user_browser(update, USER_BROWSER_DELETE)
+
+def stats_command(update: Update, context: CallbackContext) -> None:
+    """Admin command to show usage and revenue statistics. Usage: /stats [días]"""
+    user = update.effective_user
     
-    # Create keyboard with user buttons
-    keyboard = []
-    for user_data in users:
-        user_id = user_data[0]
-        username = user_data[1] or "Sin nombre"
-        first_name = user_data[2] or ""
-        last_name = user_data[3] or ""
-        display_name = f"{first_name} {last_name}".strip() or "Sin nombre"
-        
-        keyboard.append([InlineKeyboardButton(
-            f"ID: {user_id} | @{username} | {display_name}",
-            callback_data=f"delete_user_{user_id}"
-        )])
+    if not is_admin(user.id):
+        update.message.reply_text("No tienes permisos para usar este comando.")
+        return
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    days = 7
+    if context.args:
+        try:
+            days = max(1, min(int(context.args[0]), 365))
+        except ValueError:
+            update.message.reply_text("❌ El número de días debe ser un número entero.")
+            return
     
-    update.message.reply_text(
-        "🗑️ Eliminar Usuario\n\n"
-        "Selecciona un usuario para eliminar del sistema:",
-        reply_markup=reply_markup
+    from paypal_payment import get_revenue_stats
+    
+    # Solo se leen las tablas de rollup, nunca usage_history ni payments
+    usage = get_usage_stats(days)
+    revenue = get_revenue_stats(days)
+    
+    text = f"📊 <b>ESTADÍSTICAS (últimos {days} días)</b>\n\n"
+    text += "<b>📅 Por día</b> (activos | mensajes | tokens | créditos)\n"
+    for day, active_users, messages, tokens, credits in usage['daily'][-14:]:
+        text += f"{day}: {active_users} | {messages} | {tokens} | {credits}\n"
+    if not usage['daily']:
+        text += "Sin datos\n"
+    
+    text += "\n<b>🤖 Por modelo</b> (mensajes | tokens | créditos)\n"
+    for model_key, messages, tokens, credits in usage['models']:
+        text += f"{AI_MODELS.get(model_key).name if model_key in AI_MODELS else model_key}: {messages} | {tokens} | {credits}\n"
+    if not usage['models']:
+        text += "Sin datos\n"
+    
+    text += "\n<b>💰 Ingresos por paquete</b> (pagos | importe | créditos)\n"
+    for package_id, currency, payments, amount, credits in revenue:
+        text += f"{package_id}: {payments} | {amount:.2f} {currency} | {credits}\n"
+    if not revenue:
+        text += "Sin datos\n"
+    
+    # Desde el arranque del proceso, no del periodo pedido
+    scheduler = generation_scheduler.metrics()
+    text += f"\n<b>⏱ Cola de generación</b> (en curso: {scheduler['active']})\n"
+    text += "(en cola | atendidas | p50 | p95 | máx | rechazadas)\n"
+    for priority_class, figures in scheduler['classes'].items():
+        p50 = f"{figures['wait_p50']}s" if figures['wait_p50'] is not None else "-"
+        p95 = f"{figures['wait_p95']}s" if figures['wait_p95'] is not None else "-"
+        text += (f"{priority_class}: {figures['queued']} | {figures['waits']} | {p50} | {p95} | "
+                 f"{figures['wait_max']:.1f}s | {figures['rejected']}\n")
+    
+    update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+def archivo_command(update: Update, context: CallbackContext) -> None:
+    """Admin command to export a user's archived conversations. Usage: /archivo <user_id> [cantidad]"""
+    user = update.effective_user
+    
+    if not is_admin(user.id):
+        update.message.reply_text("No tienes permisos para usar este comando.")
+        return
+    
+    if not context.args:
+        update.message.reply_text("Uso: /archivo <user_id> [cantidad]")
+        return
+    
+    try:
+        target_user_id = int(context.args[0])
+        limit = max(1, min(int(context.args[1]), 500)) if len(context.args) > 1 else 50
+    except ValueError:
+        update.message.reply_text("❌ El ID de usuario y la cantidad deben ser números enteros.")
+        return
+    
+    conversations = get_archived_conversations(target_user_id, limit)
+    if not conversations:
+        update.message.reply_text(f"No hay conversaciones archivadas para el usuario {target_user_id}.")
+        return
+    
+    # Se envía como archivo JSON: las conversaciones no caben en un mensaje
+    export = io.BytesIO(json.dumps(conversations, ensure_ascii=False, indent=2).encode('utf-8'))
+    export.name = f"archivo_{target_user_id}.json"
+    update.message.reply_document(
+        document=export,
+        caption=f"🗄️ {len(conversations)} conversaciones archivadas del usuario {target_user_id}"
     )
 
-def generate_ai_response(user_id, message_text, model_key="assistant"):
-    """Generate a response using OpenAI API based on the selected model and conversation context."""
+def movimientos_command(update: Update, context: CallbackContext) -> None:
+    """Admin command to show a user's credit ledger. Usage: /movimientos <user_id> [cantidad]"""
+    user = update.effective_user
+    
+    if not is_admin(user.id):
+        update.message.reply_text("No tienes permisos para usar este comando.")
+        return
+    
+    if not context.args:
+        update.message.reply_text("Uso: /movimientos <user_id> [cantidad]")
+        return
+    
+    try:
+        target_user_id = int(context.args[0])
+        limit = max(1, min(int(context.args[1]), 50)) if len(context.args) > 1 else 20
+    except ValueError:
+        update.message.reply_text("❌ El ID de usuario y la cantidad deben ser números enteros.")
+        return
+    
+    entries = get_credit_ledger(target_user_id, limit)
+    if not entries:
+        update.message.reply_text(f"No hay movimientos de créditos para el usuario {target_user_id}.")
+        return
+    
+    lines = [f"💳 <b>Movimientos de créditos del usuario {target_user_id}</b>\n"]
+    for entry in entries:
+        reference = f" ({html.escape(entry['reference'])})" if entry['reference'] else ""
+        lines.append(
+            f"{entry['created_at']} · <b>{entry['amount']:+d}</b> → {entry['balance_after']} · "
+            f"{html.escape(entry['entry_type'] or '')}{reference}"
+        )
+    update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+# Segmentos de difusión, con la descripción que ve el administrador
+BROADCAST_SEGMENT_DESCRIPTIONS = {
+    'all': "todos los usuarios que no han bloqueado el bot",
+    'paid': "pagaron en los últimos N días",
+    'active': "usaron el asistente en los últimos N días",
+    'never_paid': "nunca han pagado",
+    'no_credits': "se quedaron sin créditos",
+}
+
+def difusion_command(update: Update, context: CallbackContext) -> None:
+    """Admin command to broadcast a message to a segment of users (hidden from help menu).
+
+    Usage:
+        /difusion crear <segmento>[:días] <mensaje>
+        /difusion estado [id]
+        /difusion pausar|reanudar|cancelar <id>
+    """
+    user = update.effective_user
+    
+    if not is_admin(user.id):
+        update.message.reply_text("No tienes permisos para usar este comando.")
+        return
+    
+    action = context.args[0].lower() if context.args else "estado"
+    
+    if action == "crear":
+        # The message is taken from the raw text so line breaks are kept
+        parts = update.message.text.split(maxsplit=3)
+        if len(parts) < 4:
+            segments = "\n".join(
+                f"• <code>{segment}{':días' if takes_days else ''}</code>: {BROADCAST_SEGMENT_DESCRIPTIONS[segment]}"
+                for segment, takes_days in BROADCAST_SEGMENTS.items()
+            )
+            update.message.reply_text(
+                f"Uso: /difusion crear &lt;segmento&gt;[:días] &lt;mensaje&gt;\n\nSegmentos:\n{segments}",
+                parse_mode=ParseMode.HTML
+            )
+            return
+        segment, _, days = parts[2].partition(':')
+        if segment not in BROADCAST_SEGMENTS:
+            update.message.reply_text(f"❌ Segmento desconocido: {segment}")
+            return
+        try:
+            days = int(days) if days else None
+        except ValueError:
+            update.message.reply_text("❌ El número de días debe ser un número entero.")
+            return
+        job_id = broadcaster.create(segment, days, sanitize_html(parts[3]), user.id)
+        update.message.reply_text(
+            f"📣 Difusión #{job_id} iniciada para el segmento {segment}. "
+            f"Usa /difusion estado {job_id} para ver el progreso."
+        )
+    elif action == "estado":
+        if len(context.args) > 1:
+            try:
+                job = get_broadcast(int(context.args[1]))
+            except ValueError:
+                update.message.reply_text("❌ El ID debe ser un número entero.")
+                return
+            jobs = [job] if job else []
+        else:
+            jobs = list_broadcasts(5)
+        if not jobs:
+            update.message.reply_text("No hay difusiones.")
+            return
+        text = "📣 <b>DIFUSIONES</b>\n\n"
+        for job in jobs:
+            text += (f"<b>#{job['job_id']}</b> {job['segment']} — {job['status']}\n"
+                     f"Enviados: {job['sent']} | Bloqueados: {job['blocked']} | Fallidos: {job['failed']}\n"
+                     f"Último usuario: {job['last_user_id']} | Creada: {job['created_at']}\n\n")
+        update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    elif action in ("pausar", "reanudar", "cancelar"):
+        try:
+            job_id = int(context.args[1])
+        except (IndexError, ValueError):
+            update.message.reply_text(f"Uso: /difusion {action} <id>")
+            return
+        change = {"pausar": broadcaster.pause, "reanudar": broadcaster.resume, "cancelar": broadcaster.cancel}[action]
+        if change(job_id):
+            update.message.reply_text(f"✅ Difusión #{job_id}: {action} aplicado.")
+        else:
+            update.message.reply_text(f"❌ No se puede {action} la difusión #{job_id} en su estado actual.")
+    else:
+        update.message.reply_text("Uso: /difusion crear|estado|pausar|reanudar|cancelar")
+
+def perfil_command(update: Update, context: CallbackContext) -> None:
+    """Admin command to profile live handlers (hidden from help menu).
+
+    Usage:
+        /perfil start [deterministic|sampling] [segundos | Nu]
+        /perfil stop
+        /perfil status
+        /perfil mem start|snapshot|stop
+    """
+    user = update.effective_user
+    
+    if not is_admin(user.id):
+        update.message.reply_text("No tienes permisos para usar este comando.")
+        return
+    
+    args = context.args or []
+    action = args[0].lower() if args else "status"
+    
+    if action == "start":
+        mode = MODE_DETERMINISTIC
+        duration_seconds = None
+        max_updates = None
+        for arg in args[1:]:
+            arg = arg.lower()
+            if arg in (MODE_DETERMINISTIC, MODE_SAMPLING):
+                mode = arg
+            elif arg.endswith("u") and arg[:-1].isdigit():
+                max_updates = int(arg[:-1])
+            elif arg.isdigit():
+                duration_seconds = int(arg)
+            else:
+                update.message.reply_text(f"❌ Argumento no válido: {arg}")
+                return
+        if not duration_seconds and not max_updates:
+            duration_seconds = 60
+        
+        if profiler.start(mode, duration_seconds, max_updates):
+            update.message.reply_text(
+                f"⏱️ Profiling iniciado ({mode}).\n"
+                f"Duración: {duration_seconds or '-'} s | Updates: {max_updates or '-'}"
+            )
+        else:
+            update.message.reply_text(f"Ya hay una sesión activa: {profiler.status()}")
+    elif action == "stop":
+        path = profiler.stop()
+        update.message.reply_text(f"✅ Profiling detenido. Archivo: {path or 'sin datos'}")
+    elif action == "mem":
+        sub_action = args[1].lower() if len(args) > 1 else "snapshot"
+        if sub_action == "start":
+            profiler.start_memory_tracking()
+            update.message.reply_text("🧠 tracemalloc activado. Usa /perfil mem snapshot para comparar.")
+        elif sub_action == "stop":
+            profiler.stop_memory_tracking()
+            update.message.reply_text("tracemalloc desactivado.")
+        else:
+            path, summary = profiler.memory_snapshot()
+            if not path:
+                update.message.reply_text("tracemalloc no está activo. Usa /perfil mem start.")
+                return
+            top_lines = "\n".join(line[:200] for line in summary[:10])
+            update.message.reply_text(f"🧠 Snapshot guardado en {path}\n\n{top_lines}"[:4000])
+    else:
+        update.message.reply_text(
+            f"Estado del profiling: {profiler.status()}\n"
+            f"Último archivo: {profiler.last_output or '-'}"
+        )
+
+def generate_ai_response(user_id, message_text, model_key=DEFAULT_MODEL_KEY):
+    """Generate a response using OpenAI API based on the selected model and conversation context.
+
+    Raises GenerationError if no completion could be produced, so callers never
+    bill a failed generation.
+    """
     try:
-        # Get model configuration
-        model_data = AI_MODELS.get(model_key, AI_MODELS.get("assistant", {}))
-        system_prompt = model_data.get("prompt_start", "You are a helpful assistant.")
-        parse_mode = model_data.get("parse_mode", "html")
+        # Get model configuration (precomputed by the registry)
+        persona = AI_MODELS.get(model_key)
+        parse_mode = persona.parse_mode
         
         # Get conversation context
         conversation = get_conversation_context(user_id)
         
         # Prepare messages for API call
-        messages = [
-            {"role": "system", "content": system_prompt}
-        ]
+        messages = [persona.system_message]
         
-        # Add conversation history (limited to last 10 messages to avoid token limits)
-        for msg in conversation[-10:]:
-            messages.append(msg)
+        # Add conversation history (limited per persona to avoid token limits)
+        if persona.history_messages:
+            messages.extend(conversation[-persona.history_messages:])
             
         # Add current user message
         messages.append({"role": "user", "content": message_text})
         
-        # Use OpenAI API
-        response = openai.ChatCompletion.create(
-            model=DEFAULT_MODEL,
-            messages=messages,
-            max_tokens=500,
-            temperature=0.7
-        )
+        # Short turns may be routed to a cheaper, faster model
+        model = persona.route(count_tokens(message_text))
+        
+        # Use OpenAI API (timeouts, retries, circuit breaker and fallback model)
+        with span("openai.chat_completion", SPAN_KIND_CLIENT, model=model, persona=model_key):
+            response = openai_client.chat_completion(
+                model,
+                messages,
+                max_tokens=persona.max_tokens,
+                temperature=persona.temperature
+            )
         
         # Get the assistant's response
         assistant_response = response.choices[0].message.content.strip()
@@ -451,9 +748,12 @@ def generate_ai_response(user_id, message_text, model_key="assistant"):
         save_conversation_context(user_id, conversation)
         
         return assistant_response, parse_mode
+    except GenerationError as e:
+        logger.error(f"Error in OpenAI API call ({e.reason}): {e}")
+        raise
     except Exception as e:
         logger.error(f"Error in OpenAI API call: {e}")
-        return "Lo siento, tuve un problema al procesar tu solicitud. Por favor, intenta de nuevo más tarde.", "html"
+        raise GenerationError(REASON_UNKNOWN, str(e)) from e
 
 # Función para enviar notificaciones al canal de administrador
 def send_admin_notification(message):
@@ -464,15 +764,57 @@ def send_admin_notification(message):
             # Extraer el nombre del canal de la URL
             channel_name = NOTIFICATION_CHANNEL.split('/')[-1]
             # Enviar mensaje al canal
-            bot_instance.send_message(chat_id=f"@{channel_name}", text=message, parse_mode=ParseMode.HTML)
+            with span("telegram.send_admin_notification", SPAN_KIND_CLIENT):
+                bot_instance.send_message(chat_id=f"@{channel_name}", text=message, parse_mode=ParseMode.HTML)
             logger.info(f"Notification sent to admin channel: {message}")
     except Exception as e:
         logger.error(f"Error sending admin notification: {e}")
 
+def notify_balance_mismatches(mismatches):
+    """Tell the admin channel about balances that do not match the credit ledger."""
+    lines = [f"⚠️ <b>{len(mismatches)} saldos no cuadran con el registro de movimientos</b>"]
+    for user_id, credits, ledger_sum in mismatches[:20]:
+        lines.append(f"Usuario {user_id}: saldo {credits}, movimientos {ledger_sum}")
+    send_admin_notification("\n".join(lines))
+
 def handle_message(update: Update, context: CallbackContext) -> None:
-    """Handle user messages and generate AI responses with context."""
+    """Buffer user messages so a quick burst is answered as a single turn."""
+    message_coalescer.add(update.effective_user.id, update, context)
+
+# Scheduling classes are cached briefly: a new admin or customer moves up
+# within this many seconds
+PRIORITY_CLASS_TTL_SECONDS = 60
+PRIORITY_CLASS_CACHE_SIZE = 10000
+_priority_classes = {}  # user_id -> (expires_at, priority class)
+_priority_classes_lock = threading.Lock()
+
+def user_priority_class(user_id):
+    """Scheduling class of a user: admins, then customers who bought credits, then the rest."""
+    now = time.monotonic()
+    with _priority_classes_lock:
+        cached = _priority_classes.get(user_id)
+        if cached and cached[0] > now:
+            return cached[1]
+    if is_admin(user_id):
+        priority_class = PRIORITY_ADMIN
+    elif has_completed_payment(user_id):
+        priority_class = PRIORITY_PAYING
+    else:
+        priority_class = PRIORITY_FREE
+    with _priority_classes_lock:
+        if len(_priority_classes) >= PRIORITY_CLASS_CACHE_SIZE:
+            for stale_id in [uid for uid, (expires_at, _) in _priority_classes.items() if expires_at <= now]:
+                del _priority_classes[stale_id]
+            if len(_priority_classes) >= PRIORITY_CLASS_CACHE_SIZE:
+                _priority_classes.clear()
+        _priority_classes[user_id] = (now + PRIORITY_CLASS_TTL_SECONDS, priority_class)
+    return priority_class
+
+@trace_update
+@profiled
+def process_message_turn(update: Update, context: CallbackContext, user_message: str) -> None:
+    """Generate an AI response with context for one (possibly coalesced) user turn."""
     user = update.effective_user
-    user_message = update.message.text
     
     # Register user if not already registered
     register_user(
@@ -483,33 +825,49 @@ def handle_message(update: Update, context: CallbackContext) -> None:
     )
     
     # Get user preferences
-    try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT preference_value FROM user_preferences WHERE user_id = ? AND preference_key = ?",
-            (user.id, "model")
-        )
-        result = cursor.fetchone()
-        selected_model = result[0] if result else "assistant"
-        model_name = AI_MODELS.get(selected_model, {}).get('name', 'Asistente General')
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error getting user preferences: {e}")
-        selected_model = "assistant"
-        model_name = AI_MODELS.get(selected_model, {}).get('name', 'Asistente General')
+    selected_model = get_user_preference(user.id, "model", DEFAULT_MODEL_KEY)
+    persona = AI_MODELS.get(selected_model)
+    model_name = persona.name
+    
+    # Rate limit before anything is charged or sent to OpenAI; the estimate
+    # covers the same history slice generate_ai_response sends
+    history = get_conversation_context(user.id)[-persona.history_messages:] if persona.history_messages else []
+    estimated_tokens = (
+        persona.system_prompt_tokens
+        + sum(count_tokens(message["content"]) for message in history)
+        + count_tokens(user_message)
+        + persona.max_tokens
+    )
+    allowed, retry_after, scope = rate_limiter.try_acquire(user.id, estimated_tokens)
+    if not allowed:
+        logger.info(f"Rate limited user {user.id} ({scope}), retry after {retry_after:.1f}s")
+        if scope == 'user':
+            update.message.reply_text(
+                f"⏳ Vas demasiado rápido. Espera {max(1, round(retry_after))} segundos antes de enviar otro mensaje. "
+                "No se han descontado créditos."
+            )
+        else:
+            update.message.reply_text(
+                "⏳ El asistente está recibiendo muchas solicitudes en este momento. "
+                f"Inténtalo de nuevo en {max(1, round(retry_after))} segundos. No se han descontado créditos."
+            )
+        return
     
-    # Check if user has enough credits
-    user_credits = get_user_credits(user.id)
+    # Hold the credits before calling OpenAI, so concurrent turns of the
+    # same user cannot spend the same credits
+    hold = reserve_credits(user.id, DEFAULT_CREDITS_PER_MESSAGE)
     
-    if user_credits < DEFAULT_CREDITS_PER_MESSAGE:
+    if hold is None:
+        # Nothing is sent to OpenAI, so the whole estimate goes back to the buckets
+        rate_limiter.refund(user.id, estimated_tokens)
         update.message.reply_text(
             "❌ No tienes suficientes créditos para usar el asistente. Cada usuario dispone de 5 créditos gratuitos que se gastan con cada mensaje."
         )
         return
     
     # Let the user know the bot is processing
-    processing_message = update.message.reply_text("Procesando tu mensaje...")
+    with span("telegram.send_message", SPAN_KIND_CLIENT):
+        processing_message = update.message.reply_text("Procesando tu mensaje...")
     
     try:
         # Notificar al administrador sobre el uso del bot
@@ -523,36 +881,83 @@ def handle_message(update: Update, context: CallbackContext) -> None:
         
         send_admin_notification(usage_info)
         
-        # Generate AI response with selected model and conversation context
-        ai_response, parse_mode = generate_ai_response(user.id, user_message, selected_model)
+        # Generate AI response with selected model and conversation context;
+        # the scheduler decides when this turn gets one of the OpenAI slots
+        with generation_scheduler.slot(user.id, user_priority_class(user.id), cost=estimated_tokens):
+            ai_response, parse_mode = generate_ai_response(user.id, user_message, selected_model)
         
         # Calculate tokens used (approximate)
-        tokens_used = count_tokens(user_message) + count_tokens(ai_response)
-        
-        # Only deduct credits if message was processed successfully
-        update_user_credits(user.id, -DEFAULT_CREDITS_PER_MESSAGE, "message", "AI response")
-        record_usage(user.id, user_message, tokens_used, DEFAULT_CREDITS_PER_MESSAGE)
+        response_tokens = count_tokens(ai_response)
+        tokens_used = count_tokens(user_message) + response_tokens
         
-        # Delete processing message and send the response
+        # Return the completion tokens that were reserved but not used
+        rate_limiter.refund(user.id, persona.max_tokens - response_tokens)
+    except GenerationError as e:
+        # The generation failed: nothing is charged and the reserved tokens are returned
+        release_credits(hold)
+        rate_limiter.refund(user.id, persona.max_tokens)
         processing_message.delete()
-        
-        # Send the response back to the user with appropriate parse mode
-        if parse_mode.lower() == "markdown":
-            update.message.reply_text(ai_response, parse_mode=ParseMode.MARKDOWN)
-        else:  # Default to HTML
-            update.message.reply_text(ai_response, parse_mode=ParseMode.HTML)
-        
-        # Inform about remaining credits
-        remaining_credits = get_user_credits(user.id)
-        update.message.reply_text(f"Créditos restantes: {remaining_credits}")
+        if e.reason == REASON_CIRCUIT_OPEN:
+            update.message.reply_text(
+                "⚠️ El servicio de IA no está disponible en este momento. No se han descontado créditos. "
+                "Por favor, intenta de nuevo en unos minutos."
+            )
+        elif e.reason == REASON_OVERLOADED:
+            update.message.reply_text(
+                "⏳ El asistente está recibiendo muchas solicitudes en este momento. No se han descontado créditos. "
+                "Por favor, intenta de nuevo en unos segundos."
+            )
+        else:
+            update.message.reply_text(
+                "Lo siento, tuve un problema al procesar tu solicitud. No se han descontado créditos. "
+                "Por favor, intenta de nuevo más tarde."
+            )
+        return
     except Exception as e:
         # If there's an error, don't deduct credits
         logger.error(f"Error processing message: {e}")
+        release_credits(hold)
+        rate_limiter.refund(user.id, persona.max_tokens)
         processing_message.delete()
         update.message.reply_text(
             "Lo siento, ocurrió un error al procesar tu mensaje. No se han descontado créditos. "
             "Por favor, intenta de nuevo más tarde."
         )
+        return
+    
+    try:
+        processing_message.delete()
+    except Exception as e:
+        logger.warning(f"Could not delete processing message: {e}")
+    
+    # Send the response as Telegram-safe HTML, split and with plain-text fallback
+    try:
+        with span("telegram.send_message", SPAN_KIND_CLIENT, parse_mode=parse_mode):
+            send_rendered(update.message.reply_text, ai_response, parse_mode)
+    except Exception as e:
+        # The user did not get the reply: the held credits are not charged
+        logger.error(f"Error delivering AI response to user {user.id}: {e}")
+        release_credits(hold)
+        return
+    
+    # Charge the held credits now that the reply was delivered. Keyed by the
+    # message so a redelivered update is not charged twice
+    message_id = update.message.message_id
+    commit_credits(
+        hold, "message", "AI response",
+        reference=str(message_id), idempotency_key=f"message:{user.id}:{message_id}"
+    )
+    record_usage(user.id, user_message, tokens_used, DEFAULT_CREDITS_PER_MESSAGE, selected_model)
+    
+    try:
+        # Inform about remaining credits
+        remaining_credits = get_user_credits(user.id)
+        with span("telegram.send_message", SPAN_KIND_CLIENT):
+            update.message.reply_text(f"Créditos restantes: {remaining_credits}")
+    except Exception as e:
+        logger.error(f"Error sending remaining credits to user {user.id}: {e}")
+
+message_coalescer = MessageCoalescer(process_message_turn)
 
 def reset_command(update: Update, context: CallbackContext) -> None:
     """Reset the conversation context for a user."""
@@ -573,7 +978,8 @@ def cleanup_inactive_conversations():
             # Primero esperar el tiempo especificado antes de realizar cualquier limpieza
             # Esto evita que se eliminen conversaciones inmediatamente al iniciar el bot
             logger.info(f"Programando próxima limpieza de conversaciones para dentro de {CONVERSATION_TIMEOUT_MINUTES} minutos")
-            time.sleep(CONVERSATION_TIMEOUT_MINUTES * 60)
+            if lifecycle.stop_event.wait(CONVERSATION_TIMEOUT_MINUTES * 60):
+                return
             
             # Limpiar conversaciones inactivas después de esperar y obtener los IDs de usuarios afectados
             inactive_users = clear_inactive_conversations(CONVERSATION_TIMEOUT_MINUTES)
@@ -612,24 +1018,101 @@ def cleanup_inactive_conversations():
         except Exception as e:
             logger.error(f"Error en la limpieza programada: {e}")
             # Esperar un poco antes de intentar de nuevo en caso de error
-            time.sleep(60)
+            if lifecycle.stop_event.wait(60):
+                return
 
-def main() -> None:
-    """Start the bot."""
-    # Check if token is available
-    if not TELEGRAM_TOKEN:
-        logger.error("No se encontró el token de Telegram. Por favor, configura la variable de entorno TELEGRAM_TOKEN.")
-        return
-    
-    if not OPENAI_API_KEY:
-        logger.error("No se encontró la clave API de OpenAI. Por favor, configura la variable de entorno OPENAI_API_KEY.")
-        return
-        
+def save_pending_turns(path=PENDING_TURNS_PATH):
+    """Write the turns still unanswered at shutdown so the next start replays them."""
+    turns = message_coalescer.unfinished_turns()
+    if not turns:
+        return 0
+    data = [{'user_id': user_id, 'updates': [update.to_dict() for update in updates]}
+            for user_id, updates in turns]
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+    except OSError as e:
+        logger.error(f"Error saving pending turns to {path}: {e}")
+        return 0
+    logger.info(f"Saved {len(turns)} unanswered turns to {path}")
+    return len(turns)
+
+def restore_pending_turns(dispatcher, path=PENDING_TURNS_PATH):
+    """Queue the turns saved by the previous process again and delete the file.
+
+    Credits are committed with a per-message idempotency key, so a turn that
+    was in fact answered just before the old process exited is not charged twice.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        logger.error(f"Error reading pending turns from {path}: {e}")
+        return 0
+    os.remove(path)
+    for turn in data:
+        for update_data in turn['updates']:
+            update = Update.de_json(update_data, dispatcher.bot)
+            message_coalescer.add(turn['user_id'], update, CallbackContext.from_update(update, dispatcher))
+    logger.info(f"Restored {len(data)} unanswered turns from {path}")
+    return len(data)
+
+def shutdown(updater, threads=()):
+    """Drain in-flight work after polling has stopped, then persist the rest.
+
+    New work is refused, buffered turns are started at once, and everything in
+    flight (turns, payment verifications, HTTP requests, broadcasts) and the
+    maintenance threads get until SHUTDOWN_DRAIN_SECONDS to finish.
+    """
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_SECONDS
+    lifecycle.begin_shutdown()
+
+    # Confirm the updates handled so far; python-telegram-bot 13 only does it
+    # with the next getUpdates, so Telegram would deliver them again
+    try:
+        updater.bot.get_updates(offset=updater.last_update_id, limit=1, timeout=0)
+    except Exception as e:
+        logger.warning(f"Could not confirm the last updates: {e}")
+
+    message_coalescer.flush_all(background=True)
+    lifecycle.wait_idle(deadline)
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+    save_pending_turns()
+    get_storage().close()
+    logger.info("Shutdown complete")
+    # Last, so the spans of the drain above are exported too
+    flush_traces()
+
+def create_app(token=None):
+    """Application factory: prepare the database and build the Updater.
+
+    All the process-level side effects (schema setup, admin bootstrap,
+    tokenizer warm up) happen here instead of at import time.
+    """
     # Declarar acceso a la variable global
     global bot_instance
-
+    
+    timings = {}
+    started = time.perf_counter()
+    
+    # Initialize the database (once per process)
+    ensure_schema()
+    timings['schema'] = time.perf_counter() - started
+    
+    # Set initial admin if provided
+    if ADMIN_USER_ID > 0:
+        set_admin_status(ADMIN_USER_ID, True)
+        logger.info(f"Set user {ADMIN_USER_ID} as admin")
+    
+    # Cargar el tokenizer en segundo plano para no retrasar el arranque
+    warm_up_tokenizer()
+    
+    phase_started = time.perf_counter()
     # Create the Updater and pass it your bot's token
-    updater = Updater(TELEGRAM_TOKEN)
+    updater = Updater(token or TELEGRAM_TOKEN)
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
@@ -637,36 +1120,99 @@ def main() -> None:
     # Guardar referencia global al bot para enviar notificaciones
     bot_instance = updater.bot
 
+    # Updates Telegram delivers again (after a restart or a failed poll) stop
+    # here, before any handler calls OpenAI or charges credits
+    update_deduplicator.load()
+    dispatcher.add_handler(TypeHandler(Update, skip_duplicate_update), group=-1)
+
     # Register command handlers
     # Modificar el manejador de start para soportar deep linking
-    dispatcher.add_handler(CommandHandler("start", lambda update, context: 
-                                         handle_deep_link_start(update, context) or start(update, context), 
+    # Cada handler se envuelve con trace_update para que cada update tenga su propio trace id
+    dispatcher.add_handler(CommandHandler("start", trace_update(lambda update, context: 
+                                         handle_deep_link_start(update, context) or start(update, context)), 
                                          pass_args=True))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("creditos", credits_command))
-    dispatcher.add_handler(CommandHandler("modelos", models_command))
-    dispatcher.add_handler(CommandHandler("modelo", select_model_command))
-    dispatcher.add_handler(CommandHandler("admin", admin_command))
-    dispatcher.add_handler(CommandHandler("reset", reset_command))
-    dispatcher.add_handler(CommandHandler("eliminar", eliminar_command))
+    dispatcher.add_handler(CommandHandler("help", trace_update(help_command)))
+    dispatcher.add_handler(CommandHandler("creditos", trace_update(credits_command)))
+    dispatcher.add_handler(CommandHandler("modelos", trace_update(models_command)))
+    dispatcher.add_handler(CommandHandler("modelo", trace_update(select_model_command)))
+    dispatcher.add_handler(CommandHandler("admin", trace_update(admin_command)))
+    dispatcher.add_handler(CommandHandler("reset", trace_update(reset_command)))
+    dispatcher.add_handler(CommandHandler("eliminar", trace_update(eliminar_command)))
+    dispatcher.add_handler(CommandHandler("perfil", trace_update(perfil_command)))
+    dispatcher.add_handler(CommandHandler("stats", trace_update(stats_command)))
+    dispatcher.add_handler(CommandHandler("archivo", trace_update(archivo_command)))
+    dispatcher.add_handler(CommandHandler("difusion", trace_update(difusion_command)))
+    dispatcher.add_handler(CommandHandler("movimientos", trace_update(movimientos_command)))
     
     # Add callback query handler for non-payment related callbacks
-    dispatcher.add_handler(CallbackQueryHandler(handle_button_callback, pattern=r'^(?!buy_package_|verify_payment_)'))
+    dispatcher.add_handler(CallbackQueryHandler(trace_update(handle_button_callback), pattern=r'^(?!buy_package_|verify_payment_|verify_package_)'))
     
     # Asegurar que el callback 'select_model' también sea manejado
-    dispatcher.add_handler(CallbackQueryHandler(handle_button_callback, pattern=r'^select_model$'))
+    dispatcher.add_handler(CallbackQueryHandler(trace_update(handle_button_callback), pattern=r'^select_model$'))
     
     # Register payment handlers
     register_payment_handlers(dispatcher)
     
     # Register message handler
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, trace_update(handle_message)))
+    timings['handlers'] = time.perf_counter() - phase_started
+    
+    timings['total'] = time.perf_counter() - started
+    logger.info("Startup timings: " + ", ".join(
+        f"{phase}={seconds * 1000:.0f}ms" for phase, seconds in timings.items()
+    ))
+    return updater
 
+def main() -> None:
+    """Start the bot."""
+    # Check if token is available
+    if not TELEGRAM_TOKEN:
+        logger.error("No se encontró el token de Telegram. Por favor, configura la variable de entorno TELEGRAM_TOKEN.")
+        return
+    
+    if not OPENAI_API_KEY:
+        logger.error("No se encontró la clave API de OpenAI. Por favor, configura la variable de entorno OPENAI_API_KEY.")
+        return
+    
+    # Declarar acceso a la variable global
+    global bot_instance
+    
+    updater = create_app()
+
+    # Recargar modelos.json en caliente cuando cambie
+    AI_MODELS.start_watching()
+    
     # Start background thread for cleaning up inactive conversations
     cleanup_thread = threading.Thread(target=cleanup_inactive_conversations, daemon=True)
     cleanup_thread.start()
     logger.info("Iniciado hilo de limpieza de conversaciones inactivas")
 
+    # Retention of usage_history (text expiry, compression, monthly archives, vacuum)
+    retention_thread = threading.Thread(
+        target=retention_loop, kwargs={'stop_event': lifecycle.stop_event}, daemon=True
+    )
+    retention_thread.start()
+
+    # Check credit balances against the ledger
+    ledger_thread = threading.Thread(
+        target=ledger_check_loop,
+        kwargs={'on_mismatch': notify_balance_mismatches, 'stop_event': lifecycle.stop_event},
+        daemon=True
+    )
+    ledger_thread.start()
+
+    # Free credit holds left behind by generations that never finished
+    hold_sweeper_thread = threading.Thread(
+        target=credit_hold_sweeper_loop, kwargs={'stop_event': lifecycle.stop_event}, daemon=True
+    )
+    hold_sweeper_thread.start()
+
+    # Forget processed update ids Telegram can no longer redeliver
+    update_dedup_thread = threading.Thread(
+        target=update_dedup_prune_loop, kwargs={'stop_event': lifecycle.stop_event}, daemon=True
+    )
+    update_dedup_thread.start()
+
     # Start the Bot
     updater.start_polling()
     logger.info("Bot started successfully!")
@@ -674,8 +1220,17 @@ def main() -> None:
     # Guardar referencia al bot para usar en el hilo de limpieza
     bot_instance = updater.bot
 
-    # Run the bot until you press Ctrl-C
+    # Reanudar las difusiones que quedaron en curso
+    broadcaster.start(updater.bot)
+
+    # Answer the turns the previous process could not finish
+    threading.Thread(target=restore_pending_turns, args=(updater.dispatcher,), daemon=True).start()
+
+    # Run the bot until Ctrl-C or SIGTERM; idle() stops polling and the dispatcher
     updater.idle()
 
+    shutdown(updater, threads=(cleanup_thread, retention_thread, ledger_thread, hold_sweeper_thread,
+                               update_dedup_thread))
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,187 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from telegram import ParseMode
+from telegram.error import RetryAfter, Unauthorized, BadRequest, TimedOut, NetworkError
+from storage import get_storage, BROADCAST_SEGMENTS
+from rate_limiter import TokenBucket
+from tracing import start_trace
+from lifecycle import lifecycle
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second per bot; leave room for replies
+BROADCAST_MESSAGES_PER_SECOND = float(os.getenv('BROADCAST_MESSAGES_PER_SECOND', '20'))
+BROADCAST_PAGE_SIZE = 500
+# Results are stored and the checkpoint moved every this many recipients; after
+# a crash at most this many users can receive the message twice
+BROADCAST_CHECKPOINT_EVERY = 50
+BROADCAST_MAX_ATTEMPTS = 3
+DEFAULT_SEGMENT_DAYS = 30
+# Jobs still 'running' among the most recent ones are resumed on startup
+RESUME_LOOKBACK_JOBS = 20
+
+RESULT_SENT = 'sent'
+RESULT_FAILED = 'failed'
+RESULT_BLOCKED = 'blocked'
+
+
+class Broadcaster:
+    """Runs broadcast jobs in background threads, paced under Telegram's limits.
+
+    Recipients are read page by page with keyset pagination and the job's
+    checkpoint (last_user_id) is stored with every batch of results, so a
+    restarted process resumes a job where it stopped. On shutdown a job stops
+    after its current batch and stays 'running' to be resumed.
+    """
+
+    def __init__(self, messages_per_second=BROADCAST_MESSAGES_PER_SECOND):
+        self.bot = None
+        # One bucket for all jobs: the limit is per bot, not per job
+        self._bucket = TokenBucket(max(1, messages_per_second), messages_per_second)
+        self._bucket_lock = threading.Lock()
+        self._threads = {}
+        self._threads_lock = threading.Lock()
+
+    def start(self, bot):
+        """Attach the bot and resume jobs left running by a previous process."""
+        self.bot = bot
+        for job in get_storage().list_broadcasts(RESUME_LOOKBACK_JOBS):
+            if job['status'] == 'running':
+                logger.info(f"Resuming broadcast {job['job_id']} after user {job['last_user_id']}")
+                self._launch(job['job_id'])
+
+    def create(self, segment, days, message, created_by):
+        """Create a job for a segment and start sending. Returns the job id."""
+        if segment not in BROADCAST_SEGMENTS:
+            raise ValueError(f"Unknown segment: {segment}")
+        since = None
+        if BROADCAST_SEGMENTS[segment]:
+            since = (datetime.utcnow() - timedelta(days=days or DEFAULT_SEGMENT_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+        job_id = get_storage().create_broadcast(segment, since, message, created_by)
+        logger.info(f"Created broadcast {job_id} for segment {segment} (since {since})")
+        self._launch(job_id)
+        return job_id
+
+    def pause(self, job_id):
+        return self._change_status(job_id, 'paused', from_statuses=('running',))
+
+    def resume(self, job_id):
+        if not self._change_status(job_id, 'running', from_statuses=('paused',)):
+            return False
+        self._launch(job_id)
+        return True
+
+    def cancel(self, job_id):
+        return self._change_status(job_id, 'cancelled', from_statuses=('running', 'paused'))
+
+    def _change_status(self, job_id, status, from_statuses):
+        job = get_storage().get_broadcast(job_id)
+        if not job or job['status'] not in from_statuses:
+            return False
+        # The worker notices the change before its next batch
+        get_storage().set_broadcast_status(job_id, status)
+        return True
+
+    def _launch(self, job_id):
+        if self.bot is None:
+            logger.warning(f"Broadcast {job_id} will start once the bot is running")
+            return
+        with self._threads_lock:
+            thread = self._threads.get(job_id)
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(target=self._run, args=(job_id,), name=f"broadcast-{job_id}", daemon=True)
+            self._threads[job_id] = thread
+            thread.start()
+
+    def _pace(self):
+        """Block until the shared bucket allows one more message."""
+        while True:
+            with self._bucket_lock:
+                wait = self._bucket.wait_time(1, time.monotonic())
+                if wait <= 0:
+                    self._bucket.consume(1)
+                    return
+            time.sleep(wait)
+
+    def _send(self, user_id, message):
+        """Send to one user. Returns (status, error)."""
+        error = None
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            self._pace()
+            try:
+                self.bot.send_message(chat_id=user_id, text=message, parse_mode=ParseMode.HTML)
+                return RESULT_SENT, None
+            except RetryAfter as e:
+                # Flood control: wait as told and retry the same user
+                error = str(e)
+                time.sleep(e.retry_after)
+            except Unauthorized as e:
+                # Blocked the bot or deactivated the account
+                return RESULT_BLOCKED, str(e)
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower():
+                    return RESULT_BLOCKED, str(e)
+                return RESULT_FAILED, str(e)
+            except (TimedOut, NetworkError) as e:
+                error = str(e)
+                time.sleep(2 ** attempt)
+        return RESULT_FAILED, error
+
+    def _run(self, job_id):
+        with lifecycle.track('broadcast'):
+            self._run_job(job_id)
+
+    def _run_job(self, job_id):
+        storage = get_storage()
+        try:
+            job = storage.get_broadcast(job_id)
+            after_user_id = job['last_user_id']
+            while True:
+                with start_trace("broadcast.page", job_id=job_id, after_user_id=after_user_id):
+                    recipients = storage.get_broadcast_recipients(
+                        job['segment'], job['since'], after_user_id, BROADCAST_PAGE_SIZE
+                    )
+                    if not recipients:
+                        storage.set_broadcast_status(job_id, 'completed')
+                        self._notify_creator(job_id)
+                        return
+                    for start in range(0, len(recipients), BROADCAST_CHECKPOINT_EVERY):
+                        if lifecycle.stopping:
+                            logger.info(f"Broadcast {job_id} paused for shutdown after user {after_user_id}")
+                            return
+                        if storage.get_broadcast(job_id)['status'] != 'running':
+                            logger.info(f"Broadcast {job_id} stopped after user {after_user_id}")
+                            return
+                        batch = recipients[start:start + BROADCAST_CHECKPOINT_EVERY]
+                        results = [(user_id, *self._send(user_id, job['message'])) for user_id in batch]
+                        storage.record_broadcast_results(job_id, results, batch[-1])
+                        after_user_id = batch[-1]
+        except Exception as e:
+            # The job stays 'running' and is resumed from its checkpoint on restart
+            logger.error(f"Broadcast {job_id} interrupted: {e}")
+
+    def _notify_creator(self, job_id):
+        job = get_storage().get_broadcast(job_id)
+        logger.info(f"Broadcast {job_id} completed: {job['sent']} sent, {job['blocked']} blocked, {job['failed']} failed")
+        if not job['created_by']:
+            return
+        try:
+            self.bot.send_message(
+                chat_id=job['created_by'],
+                text=(f"📣 Difusión #{job_id} completada\n"
+                      f"Enviados: {job['sent']}\nBloqueados: {job['blocked']}\nFallidos: {job['failed']}")
+            )
+        except Exception as e:
+            logger.error(f"Error notifying broadcast creator: {e}")
+
+
+broadcaster = Broadcaster()
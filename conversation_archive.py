@@ -0,0 +1,67 @@
+import json
+import zlib
+
+# Conversations are archived in batches of this many rows per transaction
+ARCHIVE_BATCH_SIZE = 200
+COMPRESSION_LEVEL = 9
+
+ARCHIVE_REASON_EXPIRED = "expired"
+ARCHIVE_REASON_RESET = "reset"
+
+# Preset dictionaries for zlib. Archived conversations are short JSON documents
+# that share most of their structure, so priming the compressor with that
+# structure (most frequent strings last) makes them noticeably smaller. Each row
+# stores the version it was written with; never change an existing entry, add a
+# new version instead.
+_DICTIONARIES = {
+    0: None,  # Plain zlib
+    1: (
+        ' de la que el en y a los se del las un por con no una su para es al lo como más pero sus le ya o '
+        'este sí porque esta entre cuando muy sin sobre también me hasta hay donde quien desde todo nos '
+        'durante todos uno les ni contra otros ese eso ante ellos e esto mí antes algunos qué unos yo otro '
+        'puedes puedo ayudarte gracias hola por favor ejemplo importante recuerda además '
+        ' the of and to in is you that it for are with as this be on your can or an if '
+        '\\n\\n1. \\n2. \\n3. \\n- **'
+        '"}, {"role": "assistant", "content": "'
+        '"}, {"role": "user", "content": "'
+        '[{"role": "user", "content": "'
+    ).encode('utf-8'),
+}
+CURRENT_DICTIONARY_VERSION = 1
+
+
+def compress_conversation(messages):
+    """Serialize and compress a list of messages. Returns (dictionary_version, blob)."""
+    data = json.dumps(messages, ensure_ascii=False).encode('utf-8')
+    zdict = _DICTIONARIES[CURRENT_DICTIONARY_VERSION]
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=zdict) if zdict else zlib.compressobj(COMPRESSION_LEVEL)
+    return CURRENT_DICTIONARY_VERSION, compressor.compress(data) + compressor.flush()
+
+
+def decompress_conversation(dictionary_version, blob):
+    """Inverse of compress_conversation."""
+    zdict = _DICTIONARIES[dictionary_version]
+    decompressor = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+    data = decompressor.decompress(blob) + decompressor.flush()
+    return json.loads(data.decode('utf-8'))
+
+
+def compress_text(text):
+    """Compress a short text with the current dictionary.
+
+    Returns a blob whose first byte is the dictionary version, followed by a
+    raw deflate stream (no zlib header, it would not pay off on short texts).
+    """
+    zdict = _DICTIONARIES[CURRENT_DICTIONARY_VERSION]
+    if zdict:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+    return bytes([CURRENT_DICTIONARY_VERSION]) + compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+
+def decompress_text(blob):
+    """Inverse of compress_text."""
+    zdict = _DICTIONARIES[blob[0]]
+    decompressor = zlib.decompressobj(-15, zdict=zdict) if zdict else zlib.decompressobj(-15)
+    return (decompressor.decompress(blob[1:]) + decompressor.flush()).decode('utf-8')
@@ -1,8 +1,11 @@
-import sqlite3
 import os
-import logging
 import uuid
+import logging
+import threading
+from collections import namedtuple
 from datetime import datetime, timedelta
+from tracing import traced
+from storage import get_storage, DEFAULT_CREDITS
 
 # Configure logging
 logging.basicConfig(
@@ -11,108 +14,63 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Path of the SQLite database used by the default storage backend
 DATABASE_PATH = 'bot_database.db'
+USERS_PAGE_SIZE = 20
+ARCHIVE_EXPORT_LIMIT = 50
+LEDGER_HISTORY_LIMIT = 20
+# A hold not committed or released by then is freed by the sweeper; it must
+# outlast the slowest generation (timeouts, retries and fallback model)
+CREDIT_HOLD_TTL_SECONDS = int(os.getenv('CREDIT_HOLD_TTL_SECONDS', '300'))
+
+CreditHold = namedtuple('CreditHold', ['hold_id', 'user_id', 'amount'])
+
+# All persistence goes through the backend returned by storage.get_storage();
+# the helpers below keep the historical API (log errors, return defaults).
+
+_schema_lock = threading.Lock()
+_schema_ready = False
 
+def ensure_schema():
+    """Create every table (bot and payments) once per process."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        init_database()
+        _schema_ready = True
+
+@traced("db.init_database")
 def init_database():
     """Initialize the database with required tables."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Create users table (simplified)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            credits INTEGER DEFAULT 5,
-            is_admin INTEGER DEFAULT 0,
-            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # Create usage history table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS usage_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            message_text TEXT,
-            tokens_used INTEGER,
-            credits_used INTEGER,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-        ''')
-        
-        # Create user preferences table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_preferences (
-            user_id INTEGER,
-            preference_key TEXT,
-            preference_value TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, preference_key),
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-        ''')
-        
-        # Create conversation context table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversation_context (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            messages TEXT,
-            last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-        ''')
-        
-        conn.commit()
+        get_storage().init_schema()
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
 
+@traced("db.get_user")
 def get_user(user_id):
     """Get user information from database."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user = cursor.fetchone()
-        return user
+        return get_storage().get_user(user_id)
     except Exception as e:
         logger.error(f"Error getting user: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
+@traced("db.register_user")
 def register_user(user_id, username, first_name, last_name):
     """Register a new user or update existing user information."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Check if user exists
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user = cursor.fetchone()
-        
-        if user:
-            # Just update basic info
-            cursor.execute(
-                "UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE user_id = ?",
-                (username, first_name, last_name, user_id)
-            )
+        is_new = get_storage().register_user(user_id, username, first_name, last_name)
+
+        if not is_new:
             logger.info(f"Updated user information for user_id: {user_id}")
         else:
-            # Create new user with default credits
-            cursor.execute(
-                "INSERT INTO users (user_id, username, first_name, last_name, credits) VALUES (?, ?, ?, ?, 5)",
-                (user_id, username, first_name, last_name)
-            )
             logger.info(f"Registered new user with user_id: {user_id}")
-            
+
             # Save new user ID to text file
             try:
                 with open('new_users.txt', 'a', encoding='utf-8') as f:
@@ -123,248 +81,270 @@ def register_user(user_id, username, first_name, last_name):
                 logger.info(f"Saved new user ID {user_id} to new_users.txt")
             except Exception as e:
                 logger.error(f"Error saving user ID to text file: {e}")
-        
-        conn.commit()
+
         return True
     except Exception as e:
         logger.error(f"Error registering user: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
+@traced("db.delete_user")
+def delete_user(user_id):
+    """Delete a user and all related records. Returns False if the user does not exist."""
+    # Errors are propagated so the admin sees them
+    return get_storage().delete_user(user_id)
+
+@traced("db.get_user_credits")
 def get_user_credits(user_id):
     """Get the number of credits for a user from the database."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else 5  # Return actual credits or default 5 if user not found
+        credits = get_storage().get_user_credits(user_id)
+        return credits if credits is not None else DEFAULT_CREDITS  # Return actual credits or default 5 if user not found
     except Exception as e:
         logger.error(f"Error getting user credits: {e}")
-        return 5  # Return default credits on error
-    finally:
-        if conn:
-            conn.close()
+        return DEFAULT_CREDITS  # Return default credits on error
 
-def update_user_credits(user_id, credits_change, transaction_type="message", description=""):
-    """Update user credits in the database."""
+@traced("db.update_user_credits")
+def update_user_credits(user_id, credits_change, transaction_type="message", description="",
+                        reference=None, idempotency_key=None):
+    """Add a signed entry to the credit ledger and update the user's balance.
+
+    reference identifies what the entry is about (payment id, message id).
+    An idempotency_key that was already applied makes this a no-op, so the
+    same payment or message is never counted twice. Returns True if the
+    entry was applied.
+    """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Get current credits
-        cursor.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            current_credits = result[0]
-            new_credits = max(0, current_credits + credits_change)  # Ensure credits don't go below 0
-            
-            # Update credits in database
-            cursor.execute(
-                "UPDATE users SET credits = ? WHERE user_id = ?",
-                (new_credits, user_id)
-            )
-        
-        # Log the transaction for record-keeping
-        cursor.execute(
-            "INSERT INTO usage_history (user_id, message_text, tokens_used, credits_used) VALUES (?, ?, ?, ?)",
-            (user_id, description, 0, abs(credits_change))
+        applied = get_storage().update_user_credits(
+            user_id, credits_change, transaction_type, description, reference, idempotency_key
         )
-        
-        conn.commit()
-        return True
+        if not applied:
+            logger.info(f"Credit entry not applied for user_id {user_id} (key {idempotency_key}): "
+                        f"duplicate or unknown user")
+        return applied
     except Exception as e:
         logger.error(f"Error updating user credits: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
-def record_usage(user_id, message_text, tokens_used, credits_used):
-    """Record usage history for a user."""
+@traced("db.reserve_credits")
+def reserve_credits(user_id, amount, ttl_seconds=CREDIT_HOLD_TTL_SECONDS):
+    """Hold credits for an operation that is charged later.
+
+    Returns a CreditHold to pass to commit_credits or release_credits, or
+    None if the user does not have enough free credits (or on error).
+    """
+    hold = CreditHold(uuid.uuid4().hex, user_id, amount)
+    expires_at = (datetime.utcnow() + timedelta(seconds=ttl_seconds)).strftime('%Y-%m-%d %H:%M:%S')
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT INTO usage_history (user_id, message_text, tokens_used, credits_used) VALUES (?, ?, ?, ?)",
-            (user_id, message_text, tokens_used, credits_used)
-        )
-        
-        conn.commit()
+        if get_storage().reserve_credits(hold.hold_id, user_id, amount, expires_at):
+            return hold
+        return None
+    except Exception as e:
+        logger.error(f"Error reserving credits: {e}")
+        return None
+
+@traced("db.commit_credits")
+def commit_credits(hold, transaction_type="message", description="", reference=None, idempotency_key=None):
+    """Charge the credits of a hold. Returns True if they were charged."""
+    try:
+        if get_storage().commit_credit_hold(hold.hold_id, transaction_type, description, reference, idempotency_key):
+            return True
+    except Exception as e:
+        logger.error(f"Error committing credit hold: {e}")
+    # The hold expired before the commit (or the key was already charged):
+    # charge directly, the idempotency key still prevents a double charge
+    logger.warning(f"Credit hold {hold.hold_id} of user_id {hold.user_id} could not be committed")
+    return update_user_credits(hold.user_id, -hold.amount, transaction_type, description, reference, idempotency_key)
+
+@traced("db.release_credits")
+def release_credits(hold):
+    """Free the credits of a hold without charging them."""
+    try:
+        return get_storage().release_credit_hold(hold.hold_id)
+    except Exception as e:
+        logger.error(f"Error releasing credit hold: {e}")
+        return False
+
+@traced("db.release_expired_credit_holds")
+def release_expired_credit_holds():
+    """Free holds left behind by crashed or stuck generations. Returns how many."""
+    try:
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        released = get_storage().release_expired_credit_holds(now)
+        if released:
+            logger.warning(f"Released {released} expired credit holds")
+        return released
+    except Exception as e:
+        logger.error(f"Error releasing expired credit holds: {e}")
+        return 0
+
+@traced("db.get_credit_ledger")
+def get_credit_ledger(user_id, limit=LEDGER_HISTORY_LIMIT):
+    """Get the most recent credit ledger entries of a user, newest first."""
+    try:
+        return get_storage().get_credit_ledger(user_id, limit)
+    except Exception as e:
+        logger.error(f"Error getting credit ledger: {e}")
+        return []
+
+@traced("db.record_usage")
+def record_usage(user_id, message_text, tokens_used, credits_used, model_key="assistant"):
+    """Record usage history for a user and update the daily rollups."""
+    try:
+        get_storage().record_usage(user_id, message_text, tokens_used, credits_used, model_key)
         return True
     except Exception as e:
         logger.error(f"Error recording usage: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
+@traced("db.get_usage_stats")
+def get_usage_stats(days=7):
+    """Get usage statistics for the last days from the rollup tables.
+
+    Returns a dict with 'daily' (list of (day, active_users, messages, tokens, credits))
+    and 'models' (list of (model, messages, tokens, credits) for the whole period).
+    """
+    try:
+        since = (datetime.utcnow() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        return get_storage().get_usage_stats(since)
+    except Exception as e:
+        logger.error(f"Error getting usage stats: {e}")
+        return {'daily': [], 'models': []}
+
+@traced("db.get_all_users")
 def get_all_users():
     """Get all users from database."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, username, first_name, last_name FROM users")
-        users = cursor.fetchall()
-        return users
+        return get_storage().get_all_users()
     except Exception as e:
         logger.error(f"Error getting all users: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
+@traced("db.get_users_page")
+def get_users_page(cursor_user_id=None, direction="next", search=None, limit=USERS_PAGE_SIZE):
+    """Get one page of users using keyset pagination on user_id.
+
+    direction "next" returns users with user_id > cursor_user_id, "prev" returns
+    the page just before cursor_user_id. search filters by username or user_id
+    prefix. Returns (users, has_more) where has_more tells whether there are
+    more rows in the requested direction. Users are always sorted by user_id.
+    """
+    try:
+        return get_storage().get_users_page(cursor_user_id, direction, search, limit)
+    except Exception as e:
+        logger.error(f"Error getting users page: {e}")
+        return [], False
+
+@traced("db.set_admin_status")
 def set_admin_status(user_id, is_admin_status):
     """Set admin status for a user."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Check if user exists
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user = cursor.fetchone()
-        
-        if user:
-            cursor.execute(
-                "UPDATE users SET is_admin = ? WHERE user_id = ?",
-                (1 if is_admin_status else 0, user_id)
-            )
-        else:
-            cursor.execute(
-                "INSERT INTO users (user_id, is_admin, credits) VALUES (?, ?, 5)",
-                (user_id, 1 if is_admin_status else 0)
-            )
-        
-        conn.commit()
+        get_storage().set_admin_status(user_id, is_admin_status)
         return True
     except Exception as e:
         logger.error(f"Error setting admin status: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
+
+# User preferences
+@traced("db.get_user_preference")
+def get_user_preference(user_id, key, default=None):
+    """Get a user preference value, or default if it is not set."""
+    try:
+        value = get_storage().get_preference(user_id, key)
+        return value if value is not None else default
+    except Exception as e:
+        logger.error(f"Error getting user preference: {e}")
+        return default
+
+@traced("db.set_user_preference")
+def set_user_preference(user_id, key, value):
+    """Set a user preference value."""
+    try:
+        get_storage().set_preference(user_id, key, value)
+        return True
+    except Exception as e:
+        logger.error(f"Error setting user preference: {e}")
+        return False
 
 # Conversation context management functions
+@traced("db.save_conversation_context")
 def save_conversation_context(user_id, messages):
     """Save conversation context for a user."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Convert messages list to JSON string
-        import json
-        messages_json = json.dumps(messages)
-        
-        # Check if user already has a context
-        cursor.execute("SELECT id FROM conversation_context WHERE user_id = ?", (user_id,))
-        context = cursor.fetchone()
-        
-        if context:
-            # Update existing context - asegurarse de actualizar el timestamp
-            cursor.execute(
-                "UPDATE conversation_context SET messages = ?, last_interaction = CURRENT_TIMESTAMP WHERE user_id = ?",
-                (messages_json, user_id)
-            )
-            logger.info(f"Updated conversation context and refreshed timestamp for user_id: {user_id}")
-        else:
-            # Create new context
-            cursor.execute(
-                "INSERT INTO conversation_context (user_id, messages) VALUES (?, ?)",
-                (user_id, messages_json)
-            )
-            logger.info(f"Created new conversation context for user_id: {user_id}")
-        
-        conn.commit()
+        get_storage().save_conversation(user_id, messages)
+        logger.info(f"Saved conversation context and refreshed timestamp for user_id: {user_id}")
         return True
     except Exception as e:
         logger.error(f"Error saving conversation context: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
+@traced("db.get_conversation_context")
 def get_conversation_context(user_id):
     """Get conversation context for a user."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT messages FROM conversation_context WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            import json
-            return json.loads(result[0])
-        else:
-            return []
+        return get_storage().get_conversation(user_id)
     except Exception as e:
         logger.error(f"Error getting conversation context: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
+@traced("db.clear_conversation_context")
 def clear_conversation_context(user_id):
-    """Clear conversation context for a user."""
+    """Clear conversation context for a user (it is moved to the compressed archive)."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("DELETE FROM conversation_context WHERE user_id = ?", (user_id,))
-        conn.commit()
+        get_storage().clear_conversation(user_id)
         return True
     except Exception as e:
         logger.error(f"Error clearing conversation context: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
+@traced("db.clear_inactive_conversations")
 def clear_inactive_conversations(timeout_minutes=30):
     """Clear conversation contexts for users who have been inactive for the specified time.
+    The conversations are moved to the compressed archive.
     Returns a list of user IDs whose conversations were cleared."""
-    conn = None
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
         # Calculate the cutoff time
         cutoff_time = datetime.now() - timedelta(minutes=timeout_minutes)
         cutoff_time_str = cutoff_time.strftime('%Y-%m-%d %H:%M:%S')
-        
-        # First get the user IDs of inactive conversations
-        cursor.execute("SELECT user_id FROM conversation_context WHERE last_interaction < ?", (cutoff_time_str,))
-        inactive_users = [row[0] for row in cursor.fetchall()]
-        
-        # Then delete contexts older than the cutoff time
-        cursor.execute("DELETE FROM conversation_context WHERE last_interaction < ?", (cutoff_time_str,))
-        deleted_count = cursor.rowcount
-        
-        conn.commit()
-        logger.info(f"Cleared {deleted_count} inactive conversation contexts")
+
+        inactive_users = get_storage().clear_inactive_conversations(cutoff_time_str)
+        logger.info(f"Cleared {len(inactive_users)} inactive conversation contexts")
         return inactive_users
     except Exception as e:
         logger.error(f"Error clearing inactive conversations: {e}")
-        return 0
-    finally:
-        if conn:
-            conn.close()
+        return []
+
+@traced("db.get_archived_conversations")
+def get_archived_conversations(user_id, limit=ARCHIVE_EXPORT_LIMIT):
+    """Get the most recent archived conversations of a user, newest first."""
+    try:
+        return get_storage().get_archived_conversations(user_id, limit)
+    except Exception as e:
+        logger.error(f"Error getting archived conversations: {e}")
+        return []
+
+@traced("db.get_broadcast")
+def get_broadcast(job_id):
+    """Get a broadcast job as a dict, or None."""
+    try:
+        return get_storage().get_broadcast(job_id)
+    except Exception as e:
+        logger.error(f"Error getting broadcast: {e}")
+        return None
+
+@traced("db.list_broadcasts")
+def list_broadcasts(limit=5):
+    """Get the most recent broadcast jobs, newest first."""
+    try:
+        return get_storage().list_broadcasts(limit)
+    except Exception as e:
+        logger.error(f"Error listing broadcasts: {e}")
+        return []
 
+@traced("db.is_admin")
 def is_admin(user_id):
     """Check if a user is an admin."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT is_admin FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result and result[0] == 1
+        return get_storage().is_admin(user_id)
     except Exception as e:
         logger.error(f"Error checking admin status: {e}")
         return False
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
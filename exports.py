@@ -0,0 +1,96 @@
+import io
+import sys
+import csv
+import json
+import logging
+import argparse
+from datetime import datetime, timedelta
+from storage import get_storage, EXPORT_COLUMNS
+from database import ensure_schema
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+EXPORT_KINDS = tuple(EXPORT_COLUMNS)
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_MIMETYPES = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson; charset=utf-8'}
+EXPORT_CHUNK_SIZE = 500
+
+
+def parse_date_bound(value, end=False):
+    """Turn 'YYYY-MM-DD' into a timestamp bound. Raises ValueError on bad input.
+
+    end=True returns the start of the next day, so the given day is included.
+    """
+    if not value:
+        return None
+    day = datetime.strptime(value, '%Y-%m-%d')
+    if end:
+        day += timedelta(days=1)
+    return day.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def iter_export(kind, fmt, since=None, until=None, user_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield an export as text, one piece per chunk of rows.
+
+    Rows are read from the storage backend chunk by chunk, so memory use does
+    not depend on the size of the table.
+    """
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"Unknown export: {kind}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    columns = EXPORT_COLUMNS[kind]
+    chunks = get_storage().iter_export(kind, since, until, user_id, chunk_size)
+
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        for chunk in chunks:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(chunk)
+            yield buffer.getvalue()
+    else:
+        for chunk in chunks:
+            yield ''.join(
+                json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + '\n'
+                for row in chunk
+            )
+
+
+def main(argv=None):
+    """Command line export: python exports.py usage --format jsonl --since 2024-01-01"""
+    parser = argparse.ArgumentParser(description="Export users, usage or payments as CSV or JSONL.")
+    parser.add_argument('kind', choices=EXPORT_KINDS)
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--since', help="First day to include (YYYY-MM-DD)")
+    parser.add_argument('--until', help="Last day to include (YYYY-MM-DD)")
+    parser.add_argument('--user-id', type=int)
+    parser.add_argument('--output', help="Output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    try:
+        since = parse_date_bound(args.since)
+        until = parse_date_bound(args.until, end=True)
+    except ValueError:
+        parser.error("dates must be YYYY-MM-DD")
+
+    ensure_schema()
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for piece in iter_export(args.kind, args.format, since, until, args.user_id):
+            output.write(piece)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
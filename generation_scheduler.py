@@ -0,0 +1,224 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+from tracing import span
+from openai_client import GenerationError, REASON_OVERLOADED
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+PRIORITY_ADMIN = 'admin'
+PRIORITY_PAYING = 'paying'  # Completed at least one payment
+PRIORITY_FREE = 'free'
+# Share of the generation slots each class gets while all of them are waiting
+PRIORITY_WEIGHTS = {
+    PRIORITY_ADMIN: float(os.getenv('SCHEDULER_WEIGHT_ADMIN', '16')),
+    PRIORITY_PAYING: float(os.getenv('SCHEDULER_WEIGHT_PAYING', '4')),
+    PRIORITY_FREE: float(os.getenv('SCHEDULER_WEIGHT_FREE', '1')),
+}
+# OpenAI calls running at once; the rest wait in the queue
+MAX_CONCURRENT_GENERATIONS = int(os.getenv('MAX_CONCURRENT_GENERATIONS', '8'))
+MAX_QUEUED_GENERATIONS = int(os.getenv('MAX_QUEUED_GENERATIONS', '200'))
+MAX_QUEUE_WAIT_SECONDS = float(os.getenv('MAX_QUEUE_WAIT_SECONDS', '60'))
+# Upper bounds of the queue wait histogram buckets, in seconds
+QUEUE_WAIT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Per-user virtual times are dropped once this many are kept
+MAX_TRACKED_FLOWS = 10000
+
+
+class QueueWaitHistogram:
+    """Cumulative histogram of queue waits (Prometheus style buckets)."""
+
+    def __init__(self, buckets=QUEUE_WAIT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of waits (None if empty)."""
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+
+class _Waiter:
+    __slots__ = ('priority_class', 'event', 'admitted', 'cancelled')
+
+    def __init__(self, priority_class):
+        self.priority_class = priority_class
+        self.event = threading.Event()
+        self.admitted = False
+        self.cancelled = False
+
+
+class GenerationScheduler:
+    """Admits at most max_concurrent generations, in weighted fair order.
+
+    Self-clocked fair queuing with one flow per user: a request is tagged
+    max(virtual time, tag of the user's previous request) + cost / weight of
+    its class, and the lowest tag runs first. A user who sends many messages
+    only pushes their own tags back, and the tags of paying users and admins
+    grow slower, so they keep low latency when the slots are busy. Requests
+    not admitted within max_wait_seconds (or beyond max_queued) fail with
+    GenerationError(REASON_OVERLOADED), before anything is billed.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_GENERATIONS, max_queued=MAX_QUEUED_GENERATIONS,
+                 max_wait_seconds=MAX_QUEUE_WAIT_SECONDS, weights=None):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_wait_seconds = max_wait_seconds
+        self.weights = dict(weights or PRIORITY_WEIGHTS)
+        self._lock = threading.Lock()
+        self._heap = []  # (tag, sequence, waiter)
+        self._sequence = itertools.count()
+        self._active = 0
+        self._virtual_time = 0.0
+        self._last_tags = {}  # user_id -> tag of the user's latest request
+        self._queued = {priority_class: 0 for priority_class in self.weights}
+        self._rejected = {priority_class: 0 for priority_class in self.weights}
+        self._waits = {priority_class: QueueWaitHistogram() for priority_class in self.weights}
+
+    @contextmanager
+    def slot(self, user_id, priority_class, cost=1):
+        """Hold a generation slot while the block runs."""
+        self.acquire(user_id, priority_class, cost)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, user_id, priority_class, cost=1):
+        """Block until a slot is free for this request. Returns the seconds waited."""
+        started = time.monotonic()
+        with self._lock:
+            tag = self._tag(user_id, priority_class, cost)
+            if self._active < self.max_concurrent and not self._heap:
+                self._virtual_time = max(self._virtual_time, tag)
+                self._active += 1
+                self._waits[priority_class].observe(0.0)
+                return 0.0
+            if len(self._heap) >= self.max_queued:
+                self._rejected[priority_class] += 1
+                raise GenerationError(REASON_OVERLOADED, "Generation queue is full")
+            waiter = _Waiter(priority_class)
+            heapq.heappush(self._heap, (tag, next(self._sequence), waiter))
+            self._queued[priority_class] += 1
+
+        with span("scheduler.queue_wait", priority_class=priority_class, user_id=user_id):
+            waiter.event.wait(self.max_wait_seconds)
+        waited = time.monotonic() - started
+        with self._lock:
+            self._waits[priority_class].observe(waited)
+            if not waiter.admitted:
+                # Left in the heap and skipped by _dispatch
+                waiter.cancelled = True
+                self._queued[priority_class] -= 1
+                self._rejected[priority_class] += 1
+                raise GenerationError(REASON_OVERLOADED, f"Not admitted after {waited:.1f}s")
+        if waited > 1:
+            logger.info(f"Generation for user {user_id} ({priority_class}) waited {waited:.1f}s in the queue")
+        return waited
+
+    def release(self):
+        with self._lock:
+            self._active -= 1
+            self._dispatch()
+
+    def _tag(self, user_id, priority_class, cost):
+        if len(self._last_tags) >= MAX_TRACKED_FLOWS:
+            # Tags at or behind the virtual time no longer delay anyone
+            self._last_tags = {uid: tag for uid, tag in self._last_tags.items() if tag > self._virtual_time}
+        tag = max(self._virtual_time, self._last_tags.get(user_id, 0.0)) + cost / self.weights[priority_class]
+        self._last_tags[user_id] = tag
+        return tag
+
+    def _dispatch(self):
+        while self._active < self.max_concurrent and self._heap:
+            tag, _, waiter = heapq.heappop(self._heap)
+            if waiter.cancelled:
+                continue
+            self._virtual_time = max(self._virtual_time, tag)
+            self._queued[waiter.priority_class] -= 1
+            self._active += 1
+            waiter.admitted = True
+            waiter.event.set()
+
+    def metrics(self):
+        """Return {'active': n, 'classes': {class: {...}}} with queue and wait figures."""
+        with self._lock:
+            return {
+                'active': self._active,
+                'classes': {
+                    priority_class: {
+                        'queued': self._queued[priority_class],
+                        'rejected': self._rejected[priority_class],
+                        'waits': self._waits[priority_class].count,
+                        'wait_sum': self._waits[priority_class].sum,
+                        'wait_max': self._waits[priority_class].max,
+                        'wait_p50': self._waits[priority_class].percentile(0.5),
+                        'wait_p95': self._waits[priority_class].percentile(0.95),
+                        'buckets': list(zip(self._waits[priority_class].buckets,
+                                            itertools.accumulate(self._waits[priority_class].counts))),
+                    }
+                    for priority_class in self.weights
+                },
+            }
+
+    def render_prometheus(self):
+        """Metrics in the Prometheus text exposition format."""
+        metrics = self.metrics()
+        lines = [
+            "# HELP generation_queue_wait_seconds Time generation requests waited for a slot.",
+            "# TYPE generation_queue_wait_seconds histogram",
+        ]
+        for priority_class, figures in metrics['classes'].items():
+            for bound, count in figures['buckets']:
+                lines.append(f'generation_queue_wait_seconds_bucket{{class="{priority_class}",le="{bound}"}} {count}')
+            lines.append(f'generation_queue_wait_seconds_bucket{{class="{priority_class}",le="+Inf"}} {figures["waits"]}')
+            lines.append(f'generation_queue_wait_seconds_sum{{class="{priority_class}"}} {figures["wait_sum"]}')
+            lines.append(f'generation_queue_wait_seconds_count{{class="{priority_class}"}} {figures["waits"]}')
+        lines += [
+            "# HELP generation_queue_length Generation requests waiting for a slot.",
+            "# TYPE generation_queue_length gauge",
+        ]
+        lines += [f'generation_queue_length{{class="{priority_class}"}} {figures["queued"]}'
+                  for priority_class, figures in metrics['classes'].items()]
+        lines += [
+            "# HELP generation_queue_rejected_total Generation requests refused because the queue was full or slow.",
+            "# TYPE generation_queue_rejected_total counter",
+        ]
+        lines += [f'generation_queue_rejected_total{{class="{priority_class}"}} {figures["rejected"]}'
+                  for priority_class, figures in metrics['classes'].items()]
+        lines += [
+            "# HELP generation_active Generations running now.",
+            "# TYPE generation_active gauge",
+            f"generation_active {metrics['active']}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+generation_scheduler = GenerationScheduler()
@@ -0,0 +1,57 @@
+import os
+import logging
+import threading
+from tracing import traced, start_trace
+from storage import get_storage
+from database import release_expired_credit_holds
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+LEDGER_CHECK_INTERVAL_HOURS = float(os.getenv('LEDGER_CHECK_INTERVAL_HOURS', '6'))
+CREDIT_HOLD_SWEEP_INTERVAL_SECONDS = 60
+
+
+@traced("db.check_credit_balances")
+def check_credit_balances():
+    """Compare every balance with the sum of its ledger.
+
+    Returns [(user_id, credits, ledger_sum), ...] for the users that differ,
+    or None on error. Balances are only reported, never corrected: a
+    difference means something wrote users.credits outside the ledger.
+    """
+    try:
+        mismatches = get_storage().find_balance_mismatches()
+    except Exception as e:
+        logger.error(f"Error checking credit balances: {e}")
+        return None
+    for user_id, credits, ledger_sum in mismatches:
+        logger.error(f"Credit balance mismatch for user_id {user_id}: balance {credits}, ledger {ledger_sum}")
+    if not mismatches:
+        logger.info("Credit balances match the ledger")
+    return mismatches
+
+
+def ledger_check_loop(interval_hours=LEDGER_CHECK_INTERVAL_HOURS, stop_event=None, on_mismatch=None):
+    """Check balances periodically (run in a daemon thread).
+
+    on_mismatch, if given, is called with the list of mismatches.
+    """
+    stop_event = stop_event or threading.Event()
+    while not stop_event.wait(interval_hours * 3600):
+        with start_trace("maintenance.ledger_check"):
+            mismatches = check_credit_balances()
+        if mismatches and on_mismatch:
+            on_mismatch(mismatches)
+
+
+def credit_hold_sweeper_loop(interval_seconds=CREDIT_HOLD_SWEEP_INTERVAL_SECONDS, stop_event=None):
+    """Free expired credit holds periodically (run in a daemon thread)."""
+    stop_event = stop_event or threading.Event()
+    while not stop_event.wait(interval_seconds):
+        with start_trace("maintenance.credit_hold_sweep"):
+            release_expired_credit_holds()
@@ -0,0 +1,82 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# How long shutdown waits for in-flight work; keep it under the deployment's
+# grace period (30 seconds by default in Kubernetes)
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', '25'))
+
+
+class Lifecycle:
+    """Process-wide shutdown state and in-flight work accounting.
+
+    Background loops wait on stop_event, entry points refuse new work once
+    stopping is set, and units of work (a message turn, an HTTP request, a
+    payment verification) are wrapped in track() so shutdown can wait for them.
+    """
+
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self._condition = threading.Condition()
+        self._inflight = {}  # kind -> count
+
+    @property
+    def stopping(self):
+        return self.stop_event.is_set()
+
+    def begin(self, kind):
+        with self._condition:
+            self._inflight[kind] = self._inflight.get(kind, 0) + 1
+
+    def end(self, kind):
+        with self._condition:
+            self._inflight[kind] -= 1
+            if not self._inflight[kind]:
+                del self._inflight[kind]
+            self._condition.notify_all()
+
+    @contextmanager
+    def track(self, kind):
+        """Count a unit of work as in flight while the block runs."""
+        self.begin(kind)
+        try:
+            yield
+        finally:
+            self.end(kind)
+
+    def inflight(self):
+        """Return {kind: count} of the work in flight."""
+        with self._condition:
+            return dict(self._inflight)
+
+    def begin_shutdown(self):
+        """Stop background loops and refuse new work."""
+        if not self.stopping:
+            logger.info("Shutdown started: no new work is accepted")
+        self.stop_event.set()
+
+    def wait_idle(self, deadline):
+        """Wait until nothing is in flight or time.monotonic() reaches deadline.
+
+        Returns True if everything finished.
+        """
+        with self._condition:
+            while self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"Shutdown deadline reached with work in flight: {self._inflight}")
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+
+lifecycle = Lifecycle()
@@ -0,0 +1,47 @@
+import os
+import time
+import hmac
+import hashlib
+import logging
+from urllib.parse import urlencode
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Links to the payment server are signed by the bot with this secret. Without
+# it a random one is used, which only works while the bot and the payment
+# server run in the same process (the default) and until it restarts.
+PAYMENT_LINK_SECRET = os.getenv('PAYMENT_LINK_SECRET')
+PAYMENT_LINK_TTL_SECONDS = int(os.getenv('PAYMENT_LINK_TTL_SECONDS', '900'))
+
+if PAYMENT_LINK_SECRET:
+    _secret = PAYMENT_LINK_SECRET.encode('utf-8')
+else:
+    logger.warning("PAYMENT_LINK_SECRET is not set; signed payment links only last until restart")
+    _secret = os.urandom(32)
+
+
+def _signature(parts, expires):
+    message = ':'.join(str(part) for part in parts) + f':{expires}'
+    return hmac.new(_secret, message.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def sign_query(*parts, ttl_seconds=PAYMENT_LINK_TTL_SECONDS):
+    """Query string ('expires=...&sig=...') that authorizes a link for parts."""
+    expires = int(time.time()) + ttl_seconds
+    return urlencode({'expires': expires, 'sig': _signature(parts, expires)})
+
+
+def verify_signature(parts, expires, signature):
+    """True if signature was made by sign_query for parts and has not expired."""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < time.time() or not signature:
+        return False
+    return hmac.compare_digest(_signature(parts, expires), signature)
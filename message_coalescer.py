@@ -0,0 +1,167 @@
+import os
+import time
+import logging
+import itertools
+import threading
+from lifecycle import lifecycle
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Messages from the same user that arrive within this window are merged into one turn
+MESSAGE_COALESCE_WINDOW_MS = int(os.getenv('MESSAGE_COALESCE_WINDOW_MS', '1500'))
+# Upper bound on how long a turn can be delayed while the user keeps typing
+MESSAGE_COALESCE_MAX_WAIT_MS = int(os.getenv('MESSAGE_COALESCE_MAX_WAIT_MS', '5000'))
+MAX_COALESCED_MESSAGES = 10
+
+
+class _PendingTurn:
+    """Messages buffered for one user while the window is open."""
+
+    def __init__(self, context):
+        self.context = context
+        self.updates = []
+        self.first_at = time.monotonic()
+        self.timer = None
+
+
+class MessageCoalescer:
+    """Debounce bursts of messages per user and hand them over as a single turn.
+
+    on_flush(update, context, text) is called with the last update of the burst
+    and the message texts joined by newlines. Turns of the same user are
+    processed one at a time so the conversation context stays ordered.
+    """
+
+    def __init__(self, on_flush,
+                 window_ms=MESSAGE_COALESCE_WINDOW_MS,
+                 max_wait_ms=MESSAGE_COALESCE_MAX_WAIT_MS,
+                 max_messages=MAX_COALESCED_MESSAGES):
+        self.on_flush = on_flush
+        self.window = window_ms / 1000
+        self.max_wait = max(window_ms, max_wait_ms) / 1000
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._running = {}  # token -> (user_id, updates) of turns being processed
+        self._tokens = itertools.count()
+        # user_id -> [lock, turns using it]; dropped when no turn of the user is left.
+        # One lock per real user: turns hold it across OpenAI and Telegram calls
+        self._user_locks = {}
+
+    def add(self, user_id, update, context):
+        """Buffer a message; the turn is flushed once the user stops typing."""
+        if self.window <= 0:
+            self._process(user_id, [update], context)
+            return
+
+        flush_now = None
+        with self._lock:
+            turn = self._pending.get(user_id)
+            if turn is None:
+                turn = _PendingTurn(context)
+                self._pending[user_id] = turn
+            elif turn.timer is not None:
+                turn.timer.cancel()
+            turn.updates.append(update)
+
+            waited = time.monotonic() - turn.first_at
+            delay = min(self.window, self.max_wait - waited)
+            if len(turn.updates) >= self.max_messages or delay <= 0:
+                del self._pending[user_id]
+                flush_now = turn
+            else:
+                turn.timer = threading.Timer(delay, self._flush, args=(user_id, turn))
+                turn.timer.daemon = True
+                turn.timer.start()
+
+        if flush_now is not None:
+            self._process(user_id, flush_now.updates, flush_now.context)
+
+    def _flush(self, user_id, turn):
+        with self._lock:
+            # The turn may already have been flushed by add() or flush_all()
+            if self._pending.get(user_id) is not turn:
+                return
+            del self._pending[user_id]
+        self._process(user_id, turn.updates, turn.context)
+
+    def _process(self, user_id, updates, context):
+        self._run(self._register(user_id, updates), user_id, updates, context)
+
+    def _register(self, user_id, updates):
+        """Count a turn as in flight (for shutdown) before it starts."""
+        lifecycle.begin('turn')
+        with self._lock:
+            token = next(self._tokens)
+            self._running[token] = (user_id, updates)
+        return token
+
+    def _run(self, token, user_id, updates, context):
+        try:
+            text = "\n".join(update.message.text for update in updates)
+            if len(updates) > 1:
+                logger.info(f"Coalesced {len(updates)} messages from user {user_id} into one turn")
+            user_lock = self._acquire_user_lock(user_id)
+            try:
+                self.on_flush(updates[-1], context, text)
+            except Exception as e:
+                logger.error(f"Error processing coalesced turn for user {user_id}: {e}")
+            finally:
+                self._release_user_lock(user_id, user_lock)
+        finally:
+            with self._lock:
+                self._running.pop(token, None)
+            lifecycle.end('turn')
+
+    def _acquire_user_lock(self, user_id):
+        with self._lock:
+            entry = self._user_locks.get(user_id)
+            if entry is None:
+                entry = self._user_locks[user_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        entry[0].acquire()
+        return entry
+
+    def _release_user_lock(self, user_id, entry):
+        entry[0].release()
+        with self._lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user_id]
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush_all(self, background=False):
+        """Process every buffered turn now (used on shutdown).
+
+        With background=True each turn runs in its own thread and this returns
+        at once; the turns are already counted as in flight by then.
+        """
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+            for _, turn in pending:
+                if turn.timer is not None:
+                    turn.timer.cancel()
+        for user_id, turn in pending:
+            if background:
+                token = self._register(user_id, turn.updates)
+                threading.Thread(
+                    target=self._run, args=(token, user_id, turn.updates, turn.context), daemon=True
+                ).start()
+            else:
+                self._process(user_id, turn.updates, turn.context)
+
+    def unfinished_turns(self):
+        """Return [(user_id, updates), ...] of turns buffered or still being processed."""
+        with self._lock:
+            turns = [(user_id, list(turn.updates)) for user_id, turn in self._pending.items()]
+            turns.extend((user_id, list(updates)) for user_id, updates in self._running.values())
+        return turns
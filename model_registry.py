@@ -0,0 +1,247 @@
+import os
+import json
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+MODELS_FILE = "modelos.json"
+DEFAULT_MODEL_KEY = "assistant"
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
+DEFAULT_PARSE_MODE = "html"
+VALID_PARSE_MODES = ("html", "markdown")
+
+# Generation defaults for personas that do not declare their own
+DEFAULT_OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+DEFAULT_MAX_TOKENS = 500
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_HISTORY_MESSAGES = 10
+
+# Cheap-model routing: short turns go to ROUTING_CHEAP_MODEL (disabled if unset).
+# Personas can override both values with a "routing" object in modelos.json.
+ROUTING_CHEAP_MODEL = os.getenv('ROUTING_CHEAP_MODEL') or None
+ROUTING_MAX_INPUT_TOKENS = int(os.getenv('ROUTING_MAX_INPUT_TOKENS', '30'))
+RELOAD_CHECK_INTERVAL_SECONDS = 5
+
+
+class ModelConfigError(ValueError):
+    """Raised when modelos.json is not valid."""
+
+
+@dataclass(frozen=True)
+class Persona:
+    """Precomputed, read-only configuration of one AI persona."""
+    key: str
+    name: str
+    welcome_message: str
+    system_prompt: str
+    # Shared between requests: treat as read-only
+    system_message: dict
+    system_prompt_tokens: int
+    parse_mode: str
+    model: str = DEFAULT_OPENAI_MODEL
+    max_tokens: int = DEFAULT_MAX_TOKENS
+    temperature: float = DEFAULT_TEMPERATURE
+    history_messages: int = DEFAULT_HISTORY_MESSAGES
+    cheap_model: Optional[str] = ROUTING_CHEAP_MODEL
+    cheap_max_input_tokens: int = ROUTING_MAX_INPUT_TOKENS
+
+    def route(self, input_tokens):
+        """Pick the model for a turn of input_tokens tokens.
+
+        Short turns go to the persona's cheap model when one is configured.
+        """
+        if self.cheap_model and input_tokens <= self.cheap_max_input_tokens:
+            return self.cheap_model
+        return self.model
+
+
+# Used only if modelos.json could not be loaded at all
+FALLBACK_PERSONA = Persona(
+    key=DEFAULT_MODEL_KEY,
+    name='Asistente General',
+    welcome_message='',
+    system_prompt=DEFAULT_SYSTEM_PROMPT,
+    system_message={"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
+    system_prompt_tokens=len(DEFAULT_SYSTEM_PROMPT) // 4,
+    parse_mode=DEFAULT_PARSE_MODE,
+)
+
+
+class _ModelSnapshot:
+    """Everything derived from one version of modelos.json."""
+
+    def __init__(self, personas, mtime):
+        self.personas = personas
+        self.mtime = mtime
+        self.default = personas.get(DEFAULT_MODEL_KEY) or next(iter(personas.values()))
+        self.keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(persona.name, callback_data=f"select_model_{key}")]
+            for key, persona in personas.items()
+            if key != DEFAULT_MODEL_KEY  # Skip the default assistant
+        ])
+
+
+def _build_persona(key, data, token_counter):
+    """Validate one entry of modelos.json and build its Persona."""
+    if not isinstance(data, dict):
+        raise ModelConfigError(f"Model '{key}' must be an object")
+    name = data.get('name', key)
+    welcome_message = data.get('welcome_message', '')
+    system_prompt = data.get('prompt_start', DEFAULT_SYSTEM_PROMPT)
+    parse_mode = data.get('parse_mode', DEFAULT_PARSE_MODE).lower()
+    for field, value in (('name', name), ('welcome_message', welcome_message), ('prompt_start', system_prompt)):
+        if not isinstance(value, str):
+            raise ModelConfigError(f"Model '{key}': '{field}' must be a string")
+    if parse_mode not in VALID_PARSE_MODES:
+        raise ModelConfigError(f"Model '{key}': invalid parse_mode '{parse_mode}'")
+
+    model = data.get('model', DEFAULT_OPENAI_MODEL)
+    max_tokens = data.get('max_tokens', DEFAULT_MAX_TOKENS)
+    temperature = data.get('temperature', DEFAULT_TEMPERATURE)
+    history_messages = data.get('history_messages', DEFAULT_HISTORY_MESSAGES)
+    routing = data.get('routing', {})
+    if not isinstance(model, str) or not model:
+        raise ModelConfigError(f"Model '{key}': 'model' must be a non-empty string")
+    for field, value in (('max_tokens', max_tokens), ('history_messages', history_messages)):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ModelConfigError(f"Model '{key}': '{field}' must be a non-negative integer")
+    if max_tokens == 0:
+        raise ModelConfigError(f"Model '{key}': 'max_tokens' must be positive")
+    if not isinstance(temperature, (int, float)) or isinstance(temperature, bool) or not 0 <= temperature <= 2:
+        raise ModelConfigError(f"Model '{key}': 'temperature' must be a number between 0 and 2")
+    if not isinstance(routing, dict):
+        raise ModelConfigError(f"Model '{key}': 'routing' must be an object")
+    # An explicit null/empty cheap_model disables routing for this persona
+    cheap_model = routing.get('cheap_model', ROUTING_CHEAP_MODEL) or None
+    cheap_max_input_tokens = routing.get('max_input_tokens', ROUTING_MAX_INPUT_TOKENS)
+    if cheap_model is not None and not isinstance(cheap_model, str):
+        raise ModelConfigError(f"Model '{key}': 'routing.cheap_model' must be a string")
+    if not isinstance(cheap_max_input_tokens, int) or isinstance(cheap_max_input_tokens, bool):
+        raise ModelConfigError(f"Model '{key}': 'routing.max_input_tokens' must be an integer")
+
+    return Persona(
+        key=key,
+        name=name,
+        welcome_message=welcome_message,
+        system_prompt=system_prompt,
+        system_message={"role": "system", "content": system_prompt},
+        system_prompt_tokens=token_counter(system_prompt) if token_counter else len(system_prompt) // 4,
+        parse_mode=parse_mode,
+        model=model,
+        max_tokens=max_tokens,
+        temperature=float(temperature),
+        history_messages=history_messages,
+        cheap_model=cheap_model,
+        cheap_max_input_tokens=cheap_max_input_tokens,
+    )
+
+
+def load_snapshot(path, token_counter=None):
+    """Read and validate a models file. Raises ModelConfigError on bad content."""
+    mtime = os.stat(path).st_mtime
+    with open(path, "r", encoding="utf-8") as file:
+        try:
+            models_data = json.load(file)
+        except json.JSONDecodeError as e:
+            raise ModelConfigError(f"Invalid JSON: {e}")
+    if not isinstance(models_data, dict) or not models_data:
+        raise ModelConfigError("The models file must be a non-empty object")
+    personas = {
+        key: _build_persona(key, data, token_counter)
+        for key, data in models_data.items()
+    }
+    return _ModelSnapshot(personas, mtime)
+
+
+class ModelRegistry:
+    """Validated view of modelos.json that reloads itself when the file changes.
+
+    Readers only dereference the current snapshot, which is swapped atomically
+    by the watcher thread, so the message hot path does no config work.
+    """
+
+    def __init__(self, path=MODELS_FILE, token_counter=None, autoload=True):
+        self.path = path
+        self.token_counter = token_counter
+        self._snapshot = None
+        self._watcher = None
+        self._stop_event = threading.Event()
+        self._load_lock = threading.Lock()
+        self._load_attempted = False
+        if autoload:
+            self.reload()
+
+    def _current(self):
+        """Return the current snapshot, loading the file on first use."""
+        snapshot = self._snapshot
+        if snapshot is None and not self._load_attempted:
+            # If this first load fails, the watcher keeps retrying
+            with self._load_lock:
+                if self._snapshot is None and not self._load_attempted:
+                    self.reload()
+            snapshot = self._snapshot
+        return snapshot
+
+    def reload(self):
+        """Reload the file. On error the previous snapshot is kept."""
+        self._load_attempted = True
+        try:
+            self._snapshot = load_snapshot(self.path, self.token_counter)
+            logger.info(f"Loaded {len(self._snapshot.personas)} models from {self.path}")
+            return True
+        except Exception as e:
+            logger.error(f"Error loading models: {e}")
+            return False
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            logger.error(f"Error checking models file: {e}")
+            return False
+        if self._snapshot is None or mtime != self._snapshot.mtime:
+            return self.reload()
+        return False
+
+    def start_watching(self, interval=RELOAD_CHECK_INTERVAL_SECONDS):
+        """Poll the file's mtime in a background thread and hot-reload it."""
+        if self._watcher is not None:
+            return
+        def watch():
+            while not self._stop_event.wait(interval):
+                self.reload_if_changed()
+        self._watcher = threading.Thread(target=watch, daemon=True)
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._stop_event.set()
+
+    def __contains__(self, key):
+        snapshot = self._current()
+        return snapshot is not None and key in snapshot.personas
+
+    def get(self, key):
+        """Return the persona for key, falling back to the default one."""
+        snapshot = self._current()
+        if snapshot is None:
+            return FALLBACK_PERSONA
+        return snapshot.personas.get(key, snapshot.default)
+
+    def keys(self):
+        snapshot = self._current()
+        return list(snapshot.personas) if snapshot else []
+
+    @property
+    def keyboard(self):
+        """Inline keyboard with one button per selectable model."""
+        snapshot = self._current()
+        return snapshot.keyboard if snapshot else InlineKeyboardMarkup([])
@@ -0,0 +1,201 @@
+import os
+import time
+import random
+import logging
+import threading
+from dotenv import load_dotenv
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TIMEOUT_SECONDS', '30'))
+OPENAI_TOTAL_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TOTAL_TIMEOUT_SECONDS', '60'))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '3'))
+OPENAI_FALLBACK_MODEL = os.getenv('OPENAI_FALLBACK_MODEL') or None
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('OPENAI_CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.getenv('OPENAI_CIRCUIT_RESET_SECONDS', '30'))
+
+# Failure reasons exposed through GenerationError.reason
+REASON_TIMEOUT = "timeout"
+REASON_RATE_LIMITED = "rate_limited"
+REASON_UNAVAILABLE = "unavailable"
+REASON_CIRCUIT_OPEN = "circuit_open"
+REASON_INVALID_REQUEST = "invalid_request"
+REASON_OVERLOADED = "overloaded"  # Not admitted by the generation scheduler in time
+REASON_UNKNOWN = "unknown"
+
+_openai_module = None
+
+
+def get_openai():
+    """Import and configure the OpenAI SDK on first use."""
+    global _openai_module
+    if _openai_module is None:
+        import openai
+        openai.api_key = OPENAI_API_KEY
+        _openai_module = openai
+    return _openai_module
+
+
+class GenerationError(Exception):
+    """A completion could not be produced. Nothing should be billed."""
+
+    def __init__(self, reason, message="", model=None):
+        super().__init__(message or reason)
+        self.reason = reason
+        self.model = model
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures and fails fast until reset_seconds pass.
+
+    After the cool-down a single trial request is let through (half-open); its
+    result closes the circuit again or re-opens it.
+    """
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow_request(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    logger.warning(f"OpenAI circuit opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+def _classify(error):
+    """Map an OpenAI SDK exception to (reason, retryable)."""
+    openai_errors = get_openai().error
+    if isinstance(error, openai_errors.Timeout):
+        return REASON_TIMEOUT, True
+    if isinstance(error, openai_errors.RateLimitError):
+        return REASON_RATE_LIMITED, True
+    if isinstance(error, (openai_errors.ServiceUnavailableError, openai_errors.APIConnectionError)):
+        return REASON_UNAVAILABLE, True
+    if isinstance(error, openai_errors.APIError):
+        status = getattr(error, 'http_status', None)
+        if status is None or status >= 500:
+            return REASON_UNAVAILABLE, True
+        return REASON_UNKNOWN, False
+    if isinstance(error, (openai_errors.InvalidRequestError, openai_errors.AuthenticationError,
+                          openai_errors.PermissionError)):
+        return REASON_INVALID_REQUEST, False
+    return REASON_UNKNOWN, False
+
+
+def _backoff_delay(attempt):
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+class ResilientOpenAIClient:
+    """ChatCompletion with timeouts, retries, a circuit breaker and a fallback model."""
+
+    def __init__(self,
+                 timeout=OPENAI_TIMEOUT_SECONDS,
+                 total_timeout=OPENAI_TOTAL_TIMEOUT_SECONDS,
+                 max_retries=OPENAI_MAX_RETRIES,
+                 fallback_model=OPENAI_FALLBACK_MODEL):
+        self.timeout = timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.fallback_model = fallback_model
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    def breaker(self, model):
+        with self._breakers_lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker()
+            return self._breakers[model]
+
+    def _call_with_retries(self, model, deadline, **params):
+        breaker = self.breaker(model)
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if not breaker.allow_request():
+                raise GenerationError(REASON_CIRCUIT_OPEN, f"Circuit open for {model}", model)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                response = get_openai().ChatCompletion.create(
+                    model=model,
+                    request_timeout=min(self.timeout, remaining),
+                    **params
+                )
+                breaker.record_success()
+                return response
+            except Exception as e:
+                reason, retryable = _classify(e)
+                last_error = GenerationError(reason, str(e), model)
+                if not retryable:
+                    # Errores del request, no del servicio: no abren el circuito
+                    breaker.record_success()
+                    raise last_error
+                breaker.record_failure()
+                logger.warning(f"OpenAI call failed ({reason}) on attempt {attempt + 1} for {model}: {e}")
+                if attempt < self.max_retries:
+                    delay = _backoff_delay(attempt)
+                    if time.monotonic() + delay >= deadline:
+                        break
+                    time.sleep(delay)
+        raise last_error or GenerationError(REASON_TIMEOUT, "Deadline exceeded", model)
+
+    def chat_completion(self, model, messages, **params):
+        """Create a chat completion, raising GenerationError if none could be produced."""
+        deadline = time.monotonic() + self.total_timeout
+        try:
+            return self._call_with_retries(model, deadline, messages=messages, **params)
+        except GenerationError as e:
+            if not self.fallback_model or self.fallback_model == model or e.reason == REASON_INVALID_REQUEST:
+                raise
+            logger.warning(f"Falling back to {self.fallback_model} after {e.reason} on {model}")
+            # The fallback gets its own time budget
+            fallback_deadline = time.monotonic() + self.total_timeout
+            return self._call_with_retries(self.fallback_model, fallback_deadline, messages=messages, **params)
+
+
+openai_client = ResilientOpenAIClient()
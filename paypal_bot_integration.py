@@ -5,9 +5,14 @@ from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CommandHandler, CallbackQueryHandler, CallbackContext
 from dotenv import load_dotenv
-from paypal_payment import CREDIT_PACKAGES, create_paypal_payment_link, verify_payment, get_payment_info
-from paypal_routes import start_payment_server
+from paypal_payment import (
+    CREDIT_PACKAGES, verify_payment, get_payment_info, get_latest_payment_info, order_expiry_loop
+)
 from database import get_user_credits
+from profiling import profiled
+from lifecycle import lifecycle
+from tracing import trace_update
+from link_signing import sign_query
 
 # Configure logging
 logging.basicConfig(
@@ -24,9 +29,16 @@ PAYMENT_SERVER_HOST = os.getenv('PAYMENT_SERVER_HOST', '0.0.0.0')
 PAYMENT_SERVER_PORT = int(os.getenv('PAYMENT_SERVER_PORT', '5000'))
 PAYMENT_SERVER_URL = os.getenv('PAYMENT_SERVER_URL', f'http://localhost:{PAYMENT_SERVER_PORT}')
 
+def payment_create_url(user_id, package_id):
+    """Signed, short-lived link to the payment server's /payment/create endpoint."""
+    return f"{PAYMENT_SERVER_URL}/payment/create/{user_id}/{package_id}?{sign_query(user_id, package_id)}"
+
 # Start payment server in a separate thread
 def start_payment_server_thread():
     """Start the payment server in a background thread."""
+    # Flask solo se importa cuando realmente se arranca el servidor
+    from paypal_routes import start_payment_server
+    
     thread = threading.Thread(
         target=start_payment_server,
         kwargs={
@@ -73,6 +85,7 @@ def comprar_command(update: Update, context: CallbackContext) -> None:
             reply_markup=reply_markup
         )
 
+@profiled
 def handle_payment_callback(update: Update, context: CallbackContext) -> None:
     """Handle payment-related button callbacks."""
     query = update.callback_query
@@ -88,14 +101,15 @@ def handle_payment_callback(update: Update, context: CallbackContext) -> None:
         if package_id in CREDIT_PACKAGES:
             package = CREDIT_PACKAGES[package_id]
             
-            # Create payment link
-            payment_data = create_paypal_payment_link(user.id, package_id)
+            # Signed, short-lived link to the payment server: the PayPal order is
+            # only created (or reused) when the user opens it
+            payment_url = payment_create_url(user.id, package_id)
             
-            if payment_data:
+            if payment_url:
                 # Create keyboard with payment link
                 keyboard = [
-                    [InlineKeyboardButton("Realizar Pago", url=payment_data['checkout_url'])],
-                    [InlineKeyboardButton("Verificar Pago", callback_data=f"verify_payment_{payment_data['payment_id']}")]
+                    [InlineKeyboardButton("Realizar Pago", url=payment_url)],
+                    [InlineKeyboardButton("Verificar Pago", callback_data=f"verify_package_{package_id}")]
                 ]
                 
                 reply_markup = InlineKeyboardMarkup(keyboard)
@@ -118,8 +132,19 @@ def handle_payment_callback(update: Update, context: CallbackContext) -> None:
             query.edit_message_text("❌ Paquete no válido. Usa /comprar para ver los paquetes disponibles.")
     
     # Handle payment verification
-    elif query.data.startswith("verify_payment_"):
-        payment_id = query.data.replace("verify_payment_", "")
+    elif query.data.startswith(("verify_payment_", "verify_package_")):
+        if query.data.startswith("verify_package_"):
+            # The order behind a signed link is the user's latest one of the package
+            latest_payment = get_latest_payment_info(user.id, query.data.replace("verify_package_", ""))
+            if not latest_payment:
+                query.edit_message_text(
+                    "⏳ Todavía no has abierto el enlace de pago. Pulsa 'Realizar Pago' para completar tu compra "
+                    "o usa /comprar para generar un enlace nuevo."
+                )
+                return
+            payment_id = latest_payment['payment_id']
+        else:
+            payment_id = query.data.replace("verify_payment_", "")
         
         # Get current payment info to check status
         payment_info = get_payment_info(payment_id)
@@ -170,17 +195,22 @@ def handle_payment_callback(update: Update, context: CallbackContext) -> None:
 def register_payment_handlers(dispatcher):
     """Register payment-related command and callback handlers."""
     # Add command handlers
-    dispatcher.add_handler(CommandHandler("comprar", comprar_command))
+    dispatcher.add_handler(CommandHandler("comprar", trace_update(comprar_command)))
     
     # Add callback query handler for payment-related callbacks
     dispatcher.add_handler(CallbackQueryHandler(
-        handle_payment_callback,
-        pattern=r'^(buy_package_|verify_payment_)'
+        trace_update(handle_payment_callback),
+        pattern=r'^(buy_package_|verify_payment_|verify_package_)'
     ))
     
     # Start payment server
     start_payment_server_thread()
     
+    # Expire orders that were never paid
+    threading.Thread(
+        target=order_expiry_loop, kwargs={'stop_event': lifecycle.stop_event}, daemon=True
+    ).start()
+    
     logger.info("Payment handlers registered successfully")
 
 # Handle deep linking for payment verification
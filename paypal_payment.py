@@ -1,11 +1,15 @@
 import os
+import time
 import logging
+import threading
 import uuid
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import requests
 from dotenv import load_dotenv
 from database import update_user_credits, get_user_credits
+from tracing import traced, span, start_trace, SPAN_KIND_CLIENT
+from storage import get_storage, LOCK_STRIPES
 
 # Configure logging
 logging.basicConfig(
@@ -35,44 +39,21 @@ CREDIT_PACKAGES = {
     'premium': {'credits': 500, 'price': 25.00, 'currency': 'USD', 'name': 'Paquete Premium'}
 }
 
-# Database functions for payment tracking
-def init_payment_database():
-    """Initialize payment-related database tables."""
-    try:
-        import sqlite3
-        from database import DATABASE_PATH
-        
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        # Create payments table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payments (
-            payment_id TEXT PRIMARY KEY,
-            user_id INTEGER,
-            amount REAL,
-            currency TEXT,
-            credits INTEGER,
-            status TEXT,
-            paypal_order_id TEXT,
-            paypal_payment_id TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-        ''')
-        
-        conn.commit()
-        logger.info("Payment database tables initialized successfully")
-    except Exception as e:
-        logger.error(f"Error initializing payment database: {e}")
+# Unpaid orders older than this are marked as expired by the background job
+# (PayPal keeps an unapproved order for about 3 hours)
+PAYPAL_ORDER_TTL_MINUTES = int(os.getenv('PAYPAL_ORDER_TTL_MINUTES', '60'))
+ORDER_EXPIRY_INTERVAL_MINUTES = 10
+# A link is only handed out again while its order has at least this long left
+# before expiry, so the user has time to pay it
+ORDER_REUSE_MARGIN_MINUTES = 20
+# Payments in these states have not been paid yet
+UNPAID_PAYMENT_STATUSES = ('pending', 'order_created')
 
+# Database functions for payment tracking (stored through the storage backend)
+@traced("db.create_payment_record")
 def create_payment_record(user_id, package_id, payment_id=None):
     """Create a payment record in the database."""
     try:
-        import sqlite3
-        from database import DATABASE_PATH
-        
         if package_id not in CREDIT_PACKAGES:
             logger.error(f"Invalid package ID: {package_id}")
             return None
@@ -80,75 +61,154 @@ def create_payment_record(user_id, package_id, payment_id=None):
         package = CREDIT_PACKAGES[package_id]
         payment_id = payment_id or str(uuid.uuid4())
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT INTO payments (payment_id, user_id, amount, currency, credits, status) VALUES (?, ?, ?, ?, ?, ?)",
-            (payment_id, user_id, package['price'], package['currency'], package['credits'], 'pending')
+        get_storage().create_payment(
+            payment_id, user_id, package_id, package['price'], package['currency'], package['credits']
         )
         
-        conn.commit()
         logger.info(f"Created payment record {payment_id} for user {user_id}")
         return payment_id
     except Exception as e:
         logger.error(f"Error creating payment record: {e}")
         return None
 
+@traced("db.update_payment_status")
 def update_payment_status(payment_id, status, paypal_order_id=None, paypal_payment_id=None):
     """Update payment status in the database."""
     try:
-        import sqlite3
-        from database import DATABASE_PATH
-        
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        update_fields = ["status = ?", "updated_at = CURRENT_TIMESTAMP"]
-        params = [status]
-        
-        if paypal_order_id:
-            update_fields.append("paypal_order_id = ?")
-            params.append(paypal_order_id)
-            
-        if paypal_payment_id:
-            update_fields.append("paypal_payment_id = ?")
-            params.append(paypal_payment_id)
-            
-        params.append(payment_id)
-        
-        cursor.execute(
-            f"UPDATE payments SET {', '.join(update_fields)} WHERE payment_id = ?",
-            params
-        )
-        
-        conn.commit()
+        get_storage().update_payment_status(payment_id, status, paypal_order_id, paypal_payment_id)
         logger.info(f"Updated payment {payment_id} status to {status}")
         return True
     except Exception as e:
         logger.error(f"Error updating payment status: {e}")
         return False
 
+@traced("db.get_payment_info")
 def get_payment_info(payment_id):
     """Get payment information from the database."""
     try:
-        import sqlite3
-        from database import DATABASE_PATH
-        
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM payments WHERE payment_id = ?", (payment_id,))
-        payment = cursor.fetchone()
-        
-        if payment:
-            columns = [desc[0] for desc in cursor.description]
-            return dict(zip(columns, payment))
-        return None
+        return get_storage().get_payment(payment_id)
     except Exception as e:
         logger.error(f"Error getting payment info: {e}")
         return None
 
+@traced("db.get_latest_payment_info")
+def get_latest_payment_info(user_id, package_id):
+    """Get the user's most recent payment of a package (or None)."""
+    try:
+        return get_storage().get_latest_payment(user_id, package_id)
+    except Exception as e:
+        logger.error(f"Error getting latest payment of user {user_id}: {e}")
+        return None
+
+@traced("db.has_completed_payment")
+def has_completed_payment(user_id):
+    """Whether the user has bought credits at least once."""
+    try:
+        return get_storage().has_completed_payment(user_id)
+    except Exception as e:
+        logger.error(f"Error checking payments of user {user_id}: {e}")
+        return False
+
+@traced("db.get_revenue_stats")
+def get_revenue_stats(days=7):
+    """Get revenue per package for the last days from the rollup table.
+
+    Returns a list of (package_id, currency, payments, revenue, credits).
+    """
+    try:
+        from datetime import timedelta
+        
+        since = (datetime.utcnow() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        return get_storage().get_revenue_stats(since)
+    except Exception as e:
+        logger.error(f"Error getting revenue stats: {e}")
+        return []
+
+def credit_purchase(user_id, credits, payment_id):
+    """Add the credits of a completed payment to the user.
+
+    The ledger entry is keyed by payment_id, so the return page, the capture
+    and the webhook can all report the same payment and it is credited once.
+    """
+    applied = update_user_credits(
+        user_id,
+        credits,
+        transaction_type="purchase",
+        description=f"Compra de {credits} créditos",
+        reference=payment_id,
+        idempotency_key=f"payment:{payment_id}"
+    )
+    if not applied:
+        logger.info(f"Payment {payment_id} was already credited to user {user_id}")
+    return applied
+
+class PendingOrderCache:
+    """Approval links of unpaid orders, keyed by (user_id, package_id).
+
+    Tapping the same package again returns the existing link instead of
+    creating another PayPal order and payments row.
+    """
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._orders = {}
+        self._lock = threading.Lock()
+        # Serializes link creation per key so a double tap creates one order
+        self._key_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def lock_for(self, key):
+        return self._key_locks[hash(key) % LOCK_STRIPES]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._orders.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._orders[key]
+                return None
+            return dict(entry[1])
+
+    def put(self, key, payment_data):
+        with self._lock:
+            self._orders[key] = (time.monotonic() + self.ttl_seconds, dict(payment_data))
+
+    def discard(self, key):
+        with self._lock:
+            self._orders.pop(key, None)
+
+    def prune(self):
+        """Drop expired entries. Returns how many."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (expires_at, _) in self._orders.items() if expires_at <= now]
+            for key in expired:
+                del self._orders[key]
+        return len(expired)
+
+pending_orders = PendingOrderCache(max(0, PAYPAL_ORDER_TTL_MINUTES - ORDER_REUSE_MARGIN_MINUTES) * 60)
+
+@traced("db.expire_abandoned_orders")
+def expire_abandoned_orders(ttl_minutes=PAYPAL_ORDER_TTL_MINUTES):
+    """Mark unpaid payments older than the TTL as expired. Returns how many."""
+    pending_orders.prune()
+    try:
+        cutoff = (datetime.utcnow() - timedelta(minutes=ttl_minutes)).strftime('%Y-%m-%d %H:%M:%S')
+        expired = get_storage().expire_stale_payments(UNPAID_PAYMENT_STATUSES, cutoff)
+        if expired:
+            logger.info(f"Expired {expired} abandoned payments")
+        return expired
+    except Exception as e:
+        logger.error(f"Error expiring abandoned payments: {e}")
+        return 0
+
+def order_expiry_loop(interval_minutes=ORDER_EXPIRY_INTERVAL_MINUTES, stop_event=None):
+    """Expire abandoned orders periodically (run in a daemon thread)."""
+    stop_event = stop_event or threading.Event()
+    while not stop_event.wait(interval_minutes * 60):
+        with start_trace("maintenance.expire_orders"):
+            expire_abandoned_orders()
+
 # PayPal API functions
 def get_paypal_access_token():
     """Get PayPal OAuth access token."""
@@ -160,12 +220,13 @@ def get_paypal_access_token():
         }
         data = {"grant_type": "client_credentials"}
         
-        response = requests.post(
-            url, 
-            auth=(PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET),
-            headers=headers,
-            data=data
-        )
+        with span("paypal.oauth_token", SPAN_KIND_CLIENT):
+            response = requests.post(
+                url, 
+                auth=(PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET),
+                headers=headers,
+                data=data
+            )
         
         if response.status_code == 200:
             return response.json().get("access_token")
@@ -176,13 +237,35 @@ def get_paypal_access_token():
         logger.error(f"Exception getting PayPal access token: {e}")
         return None
 
+@traced("payment.create_paypal_payment_link")
 def create_paypal_payment_link(user_id, package_id):
-    """Create a PayPal payment link for a credit package."""
+    """Get a PayPal payment link for a credit package.
+
+    An unpaid order the user created recently for the same package is reused.
+    """
+    if package_id not in CREDIT_PACKAGES:
+        logger.error(f"Invalid package ID: {package_id}")
+        return None
+    
+    key = (user_id, package_id)
+    with pending_orders.lock_for(key):
+        payment_data = pending_orders.get(key)
+        if payment_data:
+            payment_info = get_payment_info(payment_data['payment_id'])
+            if payment_info and payment_info['status'] == 'order_created':
+                logger.info(f"Reusing PayPal order for user {user_id}, payment {payment_data['payment_id']}")
+                return payment_data
+            # Paid, cancelled or expired since it was cached
+            pending_orders.discard(key)
+        
+        payment_data = create_paypal_order(user_id, package_id)
+        if payment_data:
+            pending_orders.put(key, payment_data)
+        return payment_data
+
+def create_paypal_order(user_id, package_id):
+    """Create a payment record and a new PayPal order for a credit package."""
     try:
-        if package_id not in CREDIT_PACKAGES:
-            logger.error(f"Invalid package ID: {package_id}")
-            return None
-            
         package = CREDIT_PACKAGES[package_id]
         payment_id = create_payment_record(user_id, package_id)
         
@@ -228,7 +311,8 @@ def create_paypal_payment_link(user_id, package_id):
             }
         }
         
-        response = requests.post(url, headers=headers, json=payload)
+        with span("paypal.create_order", SPAN_KIND_CLIENT, payment_id=payment_id):
+            response = requests.post(url, headers=headers, json=payload)
         
         if response.status_code in [200, 201]:
             order_data = response.json()
@@ -258,6 +342,7 @@ def create_paypal_payment_link(user_id, package_id):
         logger.error(f"Error creating PayPal payment link: {e}")
         return None
 
+@traced("payment.verify_payment")
 def verify_payment(payment_id):
     """Verify payment status with PayPal API."""
     try:
@@ -280,7 +365,8 @@ def verify_payment(payment_id):
             "Authorization": f"Bearer {access_token}"
         }
         
-        response = requests.get(url, headers=headers)
+        with span("paypal.get_order", SPAN_KIND_CLIENT, order_id=order_id):
+            response = requests.get(url, headers=headers)
         
         if response.status_code == 200:
             order_data = response.json()
@@ -288,18 +374,15 @@ def verify_payment(payment_id):
             
             # Check if the order has been completed
             if status == "COMPLETED":
-                # Update payment status
-                update_payment_status(payment_id, 'completed')
-                
-                # Add credits to user account
+                # Add credits to user account before marking the payment
+                # completed: if the process stops in between, the payment is
+                # verified again and the ledger key stops a second credit
                 user_id = payment_info['user_id']
                 credits = payment_info['credits']
-                update_user_credits(
-                    user_id, 
-                    credits, 
-                    transaction_type="purchase", 
-                    description=f"Compra de {credits} créditos"
-                )
+                credit_purchase(user_id, credits, payment_id)
+                
+                # Update payment status
+                update_payment_status(payment_id, 'completed')
                 
                 logger.info(f"Payment {payment_id} verified and {credits} credits added to user {user_id}")
                 return True
@@ -316,6 +399,7 @@ def verify_payment(payment_id):
         logger.error(f"Error verifying payment: {e}")
         return False
 
+@traced("payment.capture_paypal_payment")
 def capture_paypal_payment(payment_id, order_id, access_token=None):
     """Capture an approved PayPal payment."""
     try:
@@ -330,7 +414,8 @@ def capture_paypal_payment(payment_id, order_id, access_token=None):
             "Authorization": f"Bearer {access_token}"
         }
         
-        response = requests.post(url, headers=headers)
+        with span("paypal.capture_order", SPAN_KIND_CLIENT, order_id=order_id):
+            response = requests.post(url, headers=headers)
         
         if response.status_code in [200, 201]:
             capture_data = response.json()
@@ -345,24 +430,19 @@ def capture_paypal_payment(payment_id, order_id, access_token=None):
                     if captures:
                         capture_id = captures[0].get("id")
                 
-                # Update payment status
-                update_payment_status(
-                    payment_id, 
-                    'completed', 
-                    paypal_payment_id=capture_id
-                )
-                
                 # Get payment info
                 payment_info = get_payment_info(payment_id)
                 
-                # Add credits to user account
+                # Add credits to user account (before the status, as in verify_payment)
                 user_id = payment_info['user_id']
                 credits = payment_info['credits']
-                update_user_credits(
-                    user_id, 
-                    credits, 
-                    transaction_type="purchase", 
-                    description=f"Compra de {credits} créditos"
+                credit_purchase(user_id, credits, payment_id)
+                
+                # Update payment status
+                update_payment_status(
+                    payment_id, 
+                    'completed', 
+                    paypal_payment_id=capture_id
                 )
                 
                 logger.info(f"Payment {payment_id} captured and {credits} credits added to user {user_id}")
@@ -378,6 +458,7 @@ def capture_paypal_payment(payment_id, order_id, access_token=None):
         return False
 
 # Webhook handler for PayPal payment notifications
+@traced("payment.handle_paypal_webhook")
 def handle_paypal_webhook(request_data):
     """Handle PayPal webhook notifications."""
     try:
@@ -400,7 +481,8 @@ def handle_paypal_webhook(request_data):
                         access_token = get_paypal_access_token()
                         if access_token:
                             headers = {"Authorization": f"Bearer {access_token}"}
-                            order_response = requests.get(order_url, headers=headers)
+                            with span("paypal.get_order", SPAN_KIND_CLIENT):
+                                order_response = requests.get(order_url, headers=headers)
                             if order_response.status_code == 200:
                                 order_data = order_response.json()
                                 purchase_units = order_data.get('purchase_units', [])
@@ -416,6 +498,9 @@ def handle_paypal_webhook(request_data):
                     payment_id = parts[1]
                     credits = int(parts[3])
                     
+                    # Add credits to user account (before the status, as in verify_payment)
+                    credit_purchase(user_id, credits, payment_id)
+                    
                     # Update payment status
                     update_payment_status(
                         payment_id, 
@@ -423,14 +508,6 @@ def handle_paypal_webhook(request_data):
                         paypal_payment_id=capture_id
                     )
                     
-                    # Add credits to user account
-                    update_user_credits(
-                        user_id, 
-                        credits, 
-                        transaction_type="purchase", 
-                        description=f"Compra de {credits} créditos"
-                    )
-                    
                     logger.info(f"Webhook: Added {credits} credits to user {user_id} for payment {payment_id}")
                     return True
                 else:
@@ -444,6 +521,3 @@ def handle_paypal_webhook(request_data):
     except Exception as e:
         logger.error(f"Error handling PayPal webhook: {e}")
         return False
-
-# Initialize payment database tables
-init_payment_database()
\ No newline at end of file
@@ -1,12 +1,26 @@
 import os
+import hmac
+import time
 import logging
 import json
-from flask import Flask, request, jsonify, redirect, url_for, render_template_string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import (
+    Flask, Response, request, jsonify, redirect, url_for, g, stream_with_context
+)
 from dotenv import load_dotenv
 from paypal_payment import (
     CREDIT_PACKAGES, create_paypal_payment_link, verify_payment,
     handle_paypal_webhook, get_payment_info
 )
+from tracing import start_trace
+from lifecycle import lifecycle
+from rate_limiter import KeyedRateLimiter
+from link_signing import verify_signature
+from webhook_verification import verify_webhook, replay_cache, WebhookVerificationError, WebhookReplayError
+from database import ensure_schema
+from generation_scheduler import generation_scheduler
+from exports import iter_export, parse_date_bound, EXPORT_KINDS, EXPORT_FORMATS, EXPORT_MIMETYPES
 
 # Configure logging
 logging.basicConfig(
@@ -21,7 +35,60 @@ load_dotenv()
 # Flask app configuration
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', os.urandom(24))
-WEBHOOK_SECRET = os.getenv('PAYPAL_WEBHOOK_SECRET')
+# Bearer token for the /export endpoints; they are disabled if it is not set
+EXPORT_API_TOKEN = os.getenv('EXPORT_API_TOKEN')
+# PayPal is asked about a payment in the background, never on a request thread
+PAYMENT_VERIFY_WORKERS = 4
+# A payment is verified at most once per this many seconds, however often its page polls
+PAYMENT_VERIFY_MIN_INTERVAL_SECONDS = 5
+# Payments in these states will not change by polling PayPal again
+FINAL_PAYMENT_STATUSES = ('completed', 'cancelled', 'expired')
+# Limits for the public payment endpoints, checked in memory before any other work
+PAYMENT_IP_RPM = int(os.getenv('PAYMENT_IP_RPM', '30'))
+PAYMENT_USER_RPM = int(os.getenv('PAYMENT_USER_RPM', '5'))
+# Behind a reverse proxy the client address comes from X-Forwarded-For
+TRUST_PROXY_HEADERS = os.getenv('TRUST_PROXY_HEADERS', 'false').lower() == 'true'
+
+ip_limiter = KeyedRateLimiter(PAYMENT_IP_RPM)
+user_limiter = KeyedRateLimiter(PAYMENT_USER_RPM)
+
+@app.before_request
+def refuse_when_stopping():
+    """Turn requests away during shutdown; count the rest as in flight."""
+    if lifecycle.stopping:
+        response = jsonify({
+            'success': False,
+            'error': 'El servicio se está reiniciando, inténtalo en unos segundos'
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    lifecycle.begin('http')
+    g.lifecycle_tracked = True
+
+@app.before_request
+def start_request_trace():
+    """Give every HTTP request its own trace id."""
+    g.trace_span = start_trace(
+        f"http.{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+        **{"http.method": request.method, "http.target": request.path}
+    )
+    g.trace_span.__enter__()
+
+@app.after_request
+def record_response_status(response):
+    trace_span = g.get('trace_span')
+    if trace_span is not None:
+        trace_span.set_attribute("http.status_code", response.status_code)
+    return response
+
+@app.teardown_request
+def end_request_trace(exc):
+    trace_span = g.pop('trace_span', None)
+    if trace_span is not None:
+        trace_span.__exit__(type(exc) if exc else None, exc, None)
+    if g.pop('lifecycle_tracked', False):
+        lifecycle.end('http')
 
 # Simple HTML template for payment success/failure pages
 PAYMENT_SUCCESS_TEMPLATE = '''
@@ -50,6 +117,15 @@ PAYMENT_SUCCESS_TEMPLATE = '''
             font-size: 64px;
             margin-bottom: 20px;
         }
+        .pending-icon {
+            font-size: 64px;
+            margin-bottom: 20px;
+        }
+        .error-icon {
+            color: #F44336;
+            font-size: 64px;
+            margin-bottom: 20px;
+        }
         .button {
             background-color: #4CAF50;
             color: white;
@@ -66,15 +142,64 @@ PAYMENT_SUCCESS_TEMPLATE = '''
 </head>
 <body>
     <div class="container">
-        <div class="success-icon">✓</div>
-        <h1>¡Pago Completado!</h1>
-        <p>Tu pago ha sido procesado correctamente y los créditos han sido añadidos a tu cuenta.</p>
+        <div id="pending"{% if is_paid %} hidden{% endif %}>
+            <div class="pending-icon">⏳</div>
+            <h1>Confirmando tu pago…</h1>
+            <p>Estamos confirmando el pago con PayPal. Esta página se actualizará sola en unos segundos.</p>
+        </div>
+        <div id="paid"{% if not is_paid %} hidden{% endif %}>
+            <div class="success-icon">✓</div>
+            <h1>¡Pago Completado!</h1>
+            <p>Tu pago ha sido procesado correctamente y los créditos han sido añadidos a tu cuenta.</p>
+        </div>
+        <div id="failed" hidden>
+            <div class="error-icon">✗</div>
+            <h1>Pago no completado</h1>
+            <p>El pago aún no ha sido completado. Por favor, verifica el estado de tu pago en el bot.</p>
+        </div>
         <p>Detalles de la transacción:</p>
         <p><strong>Paquete:</strong> {{ package_name }}</p>
         <p><strong>Créditos:</strong> {{ credits }}</p>
         <p><strong>Monto:</strong> {{ amount }} {{ currency }}</p>
         <a href="https://t.me/CreaVisionBot" class="button">Volver al Bot</a>
     </div>
+    {% if not is_paid %}
+    <script>
+        // Poll the local payment state until the background verification finishes
+        (function () {
+            var statusUrl = {{ status_url|tojson }};
+            var attempts = 0;
+            function show(id) {
+                ['pending', 'paid', 'failed'].forEach(function (name) {
+                    document.getElementById(name).hidden = name !== id;
+                });
+            }
+            function schedule() {
+                attempts += 1;
+                if (attempts > 40) {
+                    show('failed');
+                    return;
+                }
+                setTimeout(poll, Math.min(1000 * attempts, 5000));
+            }
+            function poll() {
+                fetch(statusUrl, {cache: 'no-store'})
+                    .then(function (response) { return response.json(); })
+                    .then(function (data) {
+                        if (data.is_paid) {
+                            show('paid');
+                        } else if (data.final) {
+                            show('failed');
+                        } else {
+                            schedule();
+                        }
+                    })
+                    .catch(schedule);
+            }
+            schedule();
+        })();
+    </script>
+    {% endif %}
 </body>
 </html>
 '''
@@ -130,6 +255,66 @@ PAYMENT_ERROR_TEMPLATE = '''
 </html>
 '''
 
+# Compiled once at import; render_template_string would parse them on every request
+SUCCESS_PAGE = app.jinja_env.from_string(PAYMENT_SUCCESS_TEMPLATE)
+ERROR_PAGE = app.jinja_env.from_string(PAYMENT_ERROR_TEMPLATE)
+
+def render_error_page(error_message):
+    return ERROR_PAGE.render(error_message=error_message)
+
+_verify_executor = ThreadPoolExecutor(max_workers=PAYMENT_VERIFY_WORKERS, thread_name_prefix="payment-verify")
+_verify_started = {}  # payment_id -> time.monotonic() of the last verification
+_verify_lock = threading.Lock()
+
+def schedule_verification(payment_id):
+    """Verify a payment with PayPal in the background (rate limited per payment).
+
+    Returns False if a verification of this payment started too recently or
+    the process is shutting down.
+    """
+    if lifecycle.stopping:
+        return False
+    now = time.monotonic()
+    with _verify_lock:
+        # Forget payments nobody has polled for a while
+        for stale_id in [pid for pid, started in _verify_started.items()
+                         if now - started >= PAYMENT_VERIFY_MIN_INTERVAL_SECONDS]:
+            del _verify_started[stale_id]
+        if payment_id in _verify_started:
+            return False
+        _verify_started[payment_id] = now
+    # Counted from submission so shutdown also waits for queued verifications
+    lifecycle.begin('payment')
+    _verify_executor.submit(_verify_in_background, payment_id)
+    return True
+
+def _verify_in_background(payment_id):
+    with start_trace("payment.background_verify", payment_id=payment_id):
+        try:
+            verify_payment(payment_id)
+        except Exception as e:
+            logger.error(f"Error verifying payment {payment_id} in background: {e}")
+        finally:
+            lifecycle.end('payment')
+
+def client_ip():
+    if TRUST_PROXY_HEADERS and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr
+
+def rate_limited(limiter, key):
+    """Return a 429 response if key is over its limit, else None."""
+    allowed, retry_after = limiter.try_acquire(key)
+    if allowed:
+        return None
+    response = jsonify({
+        'success': False,
+        'error': 'Demasiadas solicitudes, inténtalo más tarde'
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, round(retry_after)))
+    return response
+
 @app.route('/payment/packages', methods=['GET'])
 def get_packages():
     """Return available credit packages."""
@@ -137,7 +322,30 @@ def get_packages():
 
 @app.route('/payment/create/<int:user_id>/<package_id>', methods=['GET'])
 def create_payment(user_id, package_id):
-    """Create a payment link for a user and package."""
+    """Create a payment link for a user and package.
+
+    Only links signed by the bot are accepted (?expires=...&sig=..., see
+    link_signing.sign_query), and callers are rate limited per IP and user.
+    The bot's "Realizar Pago" button opens this URL, so browsers are
+    redirected to the PayPal checkout; other clients get JSON.
+    """
+    limited = rate_limited(ip_limiter, client_ip())
+    if limited:
+        return limited
+    wants_html = request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html'
+    if not verify_signature((user_id, package_id), request.args.get('expires'), request.args.get('sig')):
+        if wants_html:
+            return render_error_page(
+                "El enlace de pago no es válido o ha caducado. Usa /comprar en el bot para generar uno nuevo."
+            ), 403
+        return jsonify({
+            'success': False,
+            'error': 'Enlace no válido o caducado'
+        }), 403
+    limited = rate_limited(user_limiter, user_id)
+    if limited:
+        return limited
+    
     try:
         if package_id not in CREDIT_PACKAGES:
             return jsonify({
@@ -147,6 +355,8 @@ def create_payment(user_id, package_id):
             
         payment_data = create_paypal_payment_link(user_id, package_id)
         
+        if payment_data and wants_html:
+            return redirect(payment_data['checkout_url'])
         if payment_data:
             return jsonify({
                 'success': True,
@@ -167,7 +377,15 @@ def create_payment(user_id, package_id):
 
 @app.route('/payment/verify/<payment_id>', methods=['GET'])
 def check_payment(payment_id):
-    """Verify payment status."""
+    """Verify payment status.
+
+    Answers from the local state; PayPal is asked in the background, at most
+    once per payment every few seconds (see schedule_verification).
+    """
+    limited = rate_limited(ip_limiter, client_ip())
+    if limited:
+        return limited
+    
     try:
         payment_info = get_payment_info(payment_id)
         
@@ -176,15 +394,15 @@ def check_payment(payment_id):
                 'success': False,
                 'error': 'ID de pago no válido'
             }), 404
-            
-        # Verify with PayPal
-        is_paid = verify_payment(payment_id)
+        
+        if payment_info['status'] not in FINAL_PAYMENT_STATUSES:
+            schedule_verification(payment_id)
         
         return jsonify({
             'success': True,
             'payment_id': payment_id,
             'status': payment_info['status'],
-            'is_paid': is_paid
+            'is_paid': payment_info['status'] == 'completed'
         })
     except Exception as e:
         logger.error(f"Error verifying payment: {e}")
@@ -195,75 +413,87 @@ def check_payment(payment_id):
 
 @app.route('/payment/success/<payment_id>', methods=['GET'])
 def payment_success(payment_id):
-    """Handle successful payment redirect."""
+    """Handle successful payment redirect.
+
+    The page is rendered at once from the local payment state; if the payment
+    is not completed yet it is verified in the background and the page polls
+    /payment/status until it is.
+    """
     try:
         payment_info = get_payment_info(payment_id)
         
         if not payment_info:
-            return render_template_string(
-                PAYMENT_ERROR_TEMPLATE,
-                error_message="ID de pago no válido o expirado."
-            )
+            return render_error_page("ID de pago no válido o expirado.")
         
-        # Verify payment status
-        is_paid = verify_payment(payment_id)
+        is_paid = payment_info['status'] == 'completed'
+        if not is_paid:
+            schedule_verification(payment_id)
         
-        if is_paid:
-            # Get package information
-            package_id = None
-            for pid, package in CREDIT_PACKAGES.items():
-                if package['credits'] == payment_info['credits'] and package['price'] == payment_info['amount']:
-                    package_id = pid
-                    break
-            
-            if package_id:
-                package = CREDIT_PACKAGES[package_id]
-                return render_template_string(
-                    PAYMENT_SUCCESS_TEMPLATE,
-                    package_name=package['name'],
-                    credits=package['credits'],
-                    amount=package['price'],
-                    currency=package['currency']
-                )
-            else:
-                return render_template_string(
-                    PAYMENT_SUCCESS_TEMPLATE,
-                    package_name="Paquete de créditos",
-                    credits=payment_info['credits'],
-                    amount=payment_info['amount'],
-                    currency=payment_info['currency']
-                )
-        else:
-            return render_template_string(
-                PAYMENT_ERROR_TEMPLATE,
-                error_message="El pago aún no ha sido completado. Por favor, verifica el estado de tu pago en el bot."
-            )
+        package = CREDIT_PACKAGES.get(payment_info.get('package_id'))
+        return SUCCESS_PAGE.render(
+            is_paid=is_paid,
+            status_url=url_for('payment_status', payment_id=payment_id),
+            package_name=package['name'] if package else "Paquete de créditos",
+            credits=payment_info['credits'],
+            amount=payment_info['amount'],
+            currency=payment_info['currency']
+        )
     except Exception as e:
         logger.error(f"Error handling success page: {e}")
-        return render_template_string(
-            PAYMENT_ERROR_TEMPLATE,
-            error_message="Error al procesar el pago. Por favor, contacta al soporte."
-        )
+        return render_error_page("Error al procesar el pago. Por favor, contacta al soporte.")
+
+@app.route('/payment/status/<payment_id>', methods=['GET'])
+def payment_status(payment_id):
+    """Return the local state of a payment, verifying it in the background if still open."""
+    limited = rate_limited(ip_limiter, client_ip())
+    if limited:
+        return limited
+    
+    payment_info = get_payment_info(payment_id)
+    if not payment_info:
+        return jsonify({
+            'success': False,
+            'error': 'ID de pago no válido'
+        }), 404
+    
+    status = payment_info['status']
+    if status not in FINAL_PAYMENT_STATUSES:
+        schedule_verification(payment_id)
+    
+    response = jsonify({
+        'success': True,
+        'payment_id': payment_id,
+        'status': status,
+        'is_paid': status == 'completed',
+        'final': status in FINAL_PAYMENT_STATUSES
+    })
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 @app.route('/payment/cancel/<payment_id>', methods=['GET'])
 def payment_cancel(payment_id):
     """Handle cancelled payment redirect."""
-    return render_template_string(
-        PAYMENT_ERROR_TEMPLATE,
-        error_message="El pago ha sido cancelado. Puedes intentarlo de nuevo desde el bot."
-    )
+    return render_error_page("El pago ha sido cancelado. Puedes intentarlo de nuevo desde el bot.")
 
 @app.route('/webhook/paypal', methods=['POST'])
 def paypal_webhook():
-    """Handle PayPal webhook notifications."""
+    """Handle PayPal webhook notifications.
+
+    The signature is checked locally (see webhook_verification); unsigned,
+    forged, stale or replayed events never reach handle_paypal_webhook.
+    """
     try:
-        # Verify webhook signature if webhook secret is configured
-        if WEBHOOK_SECRET:
-            # PayPal webhook verification would go here
-            pass
+        try:
+            verify_webhook(request.headers, request.get_data(cache=True))
+        except WebhookReplayError as e:
+            logger.info(f"Webhook: {e}")
+            return jsonify({'status': 'duplicate'}), 200
+        except WebhookVerificationError as e:
+            logger.warning(f"Webhook rejected from {client_ip()}: {e}")
+            return jsonify({'status': 'error', 'message': 'Firma no válida'}), 401
         
         # Process the webhook payload
-        webhook_data = request.json
+        webhook_data = request.get_json(force=True)
         
         # Handle the webhook event
         success = handle_paypal_webhook(webhook_data)
@@ -274,11 +504,70 @@ def paypal_webhook():
             return jsonify({'status': 'ignored'}), 200
     except Exception as e:
         logger.error(f"Error processing webhook: {e}")
+        # PayPal retries failed deliveries; do not answer the retry as a replay
+        replay_cache.forget(request.headers.get('PAYPAL-TRANSMISSION-ID'))
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+def check_export_token():
+    """Return an error response unless the request carries EXPORT_API_TOKEN."""
+    if not EXPORT_API_TOKEN:
+        return jsonify({'success': False, 'error': 'Exportación deshabilitada'}), 404
+    expected = f"Bearer {EXPORT_API_TOKEN}".encode('utf-8')
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'), expected):
+        return jsonify({'success': False, 'error': 'No autorizado'}), 401
+    return None
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Generation queue metrics (Prometheus text format).
+
+    The payment server runs in the bot process, so these are the bot's
+    figures. Requires the same bearer token as the exports.
+    """
+    auth_error = check_export_token()
+    if auth_error:
+        return auth_error
+    return Response(generation_scheduler.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/export/<kind>.<fmt>', methods=['GET'])
+def export_data(kind, fmt):
+    """Stream users, usage or payments as CSV or JSONL.
+
+    Requires 'Authorization: Bearer <EXPORT_API_TOKEN>'. Optional query
+    parameters: since and until (YYYY-MM-DD, inclusive) and user_id.
+    """
+    auth_error = check_export_token()
+    if auth_error:
+        return auth_error
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'error': 'Exportación no válida'}), 404
+    
+    try:
+        since = parse_date_bound(request.args.get('since'))
+        until = parse_date_bound(request.args.get('until'), end=True)
+        user_id = request.args.get('user_id', type=int)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Las fechas deben tener el formato YYYY-MM-DD'}), 400
+    if request.args.get('user_id') and user_id is None:
+        return jsonify({'success': False, 'error': 'user_id debe ser un número entero'}), 400
+    
+    def generate():
+        try:
+            yield from iter_export(kind, fmt, since, until, user_id)
+        except Exception as e:
+            # Headers are already sent: the truncated body is all we can signal
+            logger.error(f"Error streaming {kind} export: {e}")
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype=EXPORT_MIMETYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{kind}.{fmt}"'}
+    )
+
 def start_payment_server(host='0.0.0.0', port=5000, debug=False):
     """Start the Flask server for payment processing."""
     try:
+        ensure_schema()
         app.run(host=host, port=port, debug=debug)
     except Exception as e:
         logger.error(f"Error starting payment server: {e}")
\ No newline at end of file
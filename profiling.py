@@ -0,0 +1,251 @@
+import os
+import sys
+import time
+import logging
+import threading
+import functools
+import cProfile
+import pstats
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+PROFILE_OUTPUT_DIR = os.getenv('PROFILE_OUTPUT_DIR', 'profiles')
+SAMPLING_INTERVAL_SECONDS = float(os.getenv('PROFILE_SAMPLING_INTERVAL_MS', '5')) / 1000
+MEMORY_TOP_LINES = 15
+
+MODE_DETERMINISTIC = "deterministic"
+MODE_SAMPLING = "sampling"
+
+
+def _output_path(prefix, extension):
+    """Build a timestamped file path inside the profile output directory."""
+    os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    return os.path.join(PROFILE_OUTPUT_DIR, f"{prefix}-{timestamp}.{extension}")
+
+
+class ProfilingSession:
+    """A profiling run bounded by a duration and/or a number of handled updates."""
+
+    def __init__(self, mode, duration_seconds=None, max_updates=None):
+        self.mode = mode
+        self.duration_seconds = duration_seconds
+        self.max_updates = max_updates
+        self.started_at = time.monotonic()
+        self.updates_seen = 0
+        self.stats = None
+        self.samples = Counter()
+        self.active_threads = set()
+        self._stop_event = threading.Event()
+        self._sampler_thread = None
+
+    def is_expired(self):
+        """Return True once the duration or update budget is exhausted."""
+        if self.duration_seconds and time.monotonic() - self.started_at >= self.duration_seconds:
+            return True
+        if self.max_updates and self.updates_seen >= self.max_updates:
+            return True
+        return False
+
+    def start(self):
+        if self.mode == MODE_SAMPLING:
+            self._sampler_thread = threading.Thread(target=self._sample_loop, daemon=True)
+            self._sampler_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._sampler_thread:
+            self._sampler_thread.join(timeout=1)
+
+    def _sample_loop(self):
+        """Periodically capture the stacks of threads running a profiled handler."""
+        while not self._stop_event.wait(SAMPLING_INTERVAL_SECONDS):
+            frames = sys._current_frames()
+            for thread_id in list(self.active_threads):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write_output(self):
+        """Write the collected data to disk and return the file path."""
+        if self.mode == MODE_DETERMINISTIC:
+            if self.stats is None:
+                return None
+            path = _output_path("profile", "pstats")
+            self.stats.dump_stats(path)
+        else:
+            if not self.samples:
+                return None
+            path = _output_path("profile", "folded")
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        return path
+
+
+class Profiler:
+    """Process-wide switch that profiles the wrapped handlers on demand."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._last_snapshot = None
+        self.last_output = None
+        self._local = threading.local()
+
+    @property
+    def active(self):
+        return self._session is not None
+
+    def start(self, mode=MODE_DETERMINISTIC, duration_seconds=None, max_updates=None):
+        """Start a profiling session. Returns False if one is already running."""
+        with self._lock:
+            if self._session is not None:
+                return False
+            session = ProfilingSession(mode, duration_seconds, max_updates)
+            self._session = session
+            session.start()
+        if duration_seconds:
+            # Cerrar la sesión aunque no lleguen más updates
+            timer = threading.Timer(duration_seconds, self._expire, args=(session,))
+            timer.daemon = True
+            timer.start()
+        logger.info(f"Profiling started: mode={mode}, duration={duration_seconds}, updates={max_updates}")
+        return True
+
+    def _expire(self, session):
+        if self._session is session:
+            self.stop(session)
+
+    def stop(self, expected_session=None):
+        """Stop the current session and return the written file path, if any."""
+        with self._lock:
+            session = self._session
+            if session is None or (expected_session is not None and session is not expected_session):
+                return None
+            self._session = None
+        session.stop()
+        try:
+            path = session.write_output()
+            self.last_output = path
+            logger.info(f"Profiling stopped after {session.updates_seen} updates, output: {path}")
+            return path
+        except Exception as e:
+            logger.error(f"Error writing profile output: {e}")
+            return None
+
+    def status(self):
+        """Return a short human readable description of the current session."""
+        session = self._session
+        if session is None:
+            return "inactivo"
+        elapsed = int(time.monotonic() - session.started_at)
+        return f"{session.mode}, {session.updates_seen} updates, {elapsed}s"
+
+    def run(self, func, *args, **kwargs):
+        """Run func, profiling it if a session is active."""
+        session = self._session
+        # Las llamadas anidadas ya quedan cubiertas por el handler exterior
+        if session is None or getattr(self._local, 'depth', 0):
+            return func(*args, **kwargs)
+
+        thread_id = threading.get_ident()
+        profile = None
+        profiled = False
+        try:
+            self._local.depth = 1
+            if session.mode == MODE_DETERMINISTIC:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                    profiled = True
+                except ValueError as e:
+                    # Python 3.12+ allows one cProfile per process, so handlers
+                    # running alongside the profiled one are not profiled
+                    logger.debug(f"Not profiling this call: {e}")
+                    profile = None
+            else:
+                session.active_threads.add(thread_id)
+                profiled = True
+            return func(*args, **kwargs)
+        finally:
+            self._local.depth = 0
+            if profile is not None:
+                profile.disable()
+            elif profiled:
+                session.active_threads.discard(thread_id)
+            with self._lock:
+                if profile is not None:
+                    if session.stats is None:
+                        session.stats = pstats.Stats(profile)
+                    else:
+                        session.stats.add(profile)
+                if profiled:
+                    session.updates_seen += 1
+                expired = session is self._session and session.is_expired()
+            if expired:
+                self.stop(session)
+
+    # Memory tracking with tracemalloc
+    def start_memory_tracking(self, frames=10):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self._last_snapshot = tracemalloc.take_snapshot()
+        logger.info("tracemalloc started")
+
+    def stop_memory_tracking(self):
+        self._last_snapshot = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        logger.info("tracemalloc stopped")
+
+    def memory_snapshot(self):
+        """Take a snapshot, diff it against the previous one and write the report.
+
+        Returns a tuple (path, summary_lines) or (None, []) if tracing is off.
+        """
+        if not tracemalloc.is_tracing():
+            return None, []
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        if self._last_snapshot is not None:
+            stats = snapshot.compare_to(self._last_snapshot, 'lineno')
+        else:
+            stats = snapshot.statistics('lineno')
+        self._last_snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        path = _output_path("memory", "txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"current={current} peak={peak}\n")
+            for stat in stats:
+                f.write(f"{stat}\n")
+        summary = [str(stat) for stat in stats[:MEMORY_TOP_LINES]]
+        return path, summary
+
+
+profiler = Profiler()
+
+
+def profiled(func):
+    """Decorator that lets the global profiler observe a handler."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return profiler.run(func, *args, **kwargs)
+    return wrapper
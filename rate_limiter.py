@@ -0,0 +1,156 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Global limits, sized to the OpenAI account quota
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv('OPENAI_RPM', '3500'))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv('OPENAI_TPM', '90000'))
+
+# Per-user limits
+USER_REQUESTS_PER_MINUTE = int(os.getenv('USER_RPM', '10'))
+USER_TOKENS_PER_MINUTE = int(os.getenv('USER_TPM', '8000'))
+
+MAX_TRACKED_USERS = 10000
+
+
+class TokenBucket:
+    """Classic token bucket: holds up to capacity, refills at rate per second.
+
+    Not thread-safe on its own; RateLimiter serializes access.
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount is available (0 if it is available now)."""
+        self._refill(now)
+        # A request larger than the bucket can still pass once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """Per-user and global limits in both requests and estimated tokens."""
+
+    def __init__(self,
+                 global_rpm=OPENAI_REQUESTS_PER_MINUTE,
+                 global_tpm=OPENAI_TOKENS_PER_MINUTE,
+                 user_rpm=USER_REQUESTS_PER_MINUTE,
+                 user_tpm=USER_TOKENS_PER_MINUTE,
+                 max_users=MAX_TRACKED_USERS):
+        self._lock = threading.Lock()
+        self.global_requests = TokenBucket(global_rpm, global_rpm / 60)
+        self.global_tokens = TokenBucket(global_tpm, global_tpm / 60)
+        self.user_rpm = user_rpm
+        self.user_tpm = user_tpm
+        self.max_users = max_users
+        # user_id -> (requests bucket, tokens bucket), least recently used first
+        self._user_buckets = OrderedDict()
+
+    def _buckets_for(self, user_id):
+        buckets = self._user_buckets.get(user_id)
+        if buckets is None:
+            buckets = (
+                TokenBucket(self.user_rpm, self.user_rpm / 60),
+                TokenBucket(self.user_tpm, self.user_tpm / 60),
+            )
+            self._user_buckets[user_id] = buckets
+            # Evicting an idle user only forgets a (mostly refilled) bucket
+            while len(self._user_buckets) > self.max_users:
+                self._user_buckets.popitem(last=False)
+        else:
+            self._user_buckets.move_to_end(user_id)
+        return buckets
+
+    def try_acquire(self, user_id, estimated_tokens):
+        """Take one request and estimated_tokens from every bucket, or nothing.
+
+        Returns (allowed, retry_after_seconds, scope) where scope is 'user' or
+        'global' when the request is rejected.
+        """
+        now = time.monotonic()
+        with self._lock:
+            user_requests, user_tokens = self._buckets_for(user_id)
+            user_wait = max(user_requests.wait_time(1, now), user_tokens.wait_time(estimated_tokens, now))
+            if user_wait > 0:
+                return False, user_wait, 'user'
+            global_wait = max(
+                self.global_requests.wait_time(1, now),
+                self.global_tokens.wait_time(estimated_tokens, now)
+            )
+            if global_wait > 0:
+                return False, global_wait, 'global'
+
+            user_requests.consume(1)
+            user_tokens.consume(estimated_tokens)
+            self.global_requests.consume(1)
+            self.global_tokens.consume(estimated_tokens)
+            return True, 0.0, None
+
+    def refund(self, user_id, tokens):
+        """Give back unused tokens once the real usage is known."""
+        if tokens <= 0:
+            return
+        with self._lock:
+            buckets = self._user_buckets.get(user_id)
+            if buckets:
+                buckets[1].refund(tokens)
+            self.global_tokens.refund(tokens)
+
+
+class KeyedRateLimiter:
+    """One request bucket per key (an IP, a user id), for cheap early rejection."""
+
+    def __init__(self, requests_per_minute, max_keys=MAX_TRACKED_USERS):
+        self._lock = threading.Lock()
+        self.requests_per_minute = requests_per_minute
+        self.max_keys = max_keys
+        # key -> bucket, least recently used first
+        self._buckets = OrderedDict()
+
+    def try_acquire(self, key):
+        """Take one request for key. Returns (allowed, retry_after_seconds)."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.requests_per_minute, self.requests_per_minute / 60)
+                self._buckets[key] = bucket
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            wait = bucket.wait_time(1, now)
+            if wait > 0:
+                return False, wait
+            bucket.consume(1)
+            return True, 0.0
+
+
+rate_limiter = RateLimiter()
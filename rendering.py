@@ -0,0 +1,309 @@
+import re
+import html
+import logging
+import functools
+from telegram import ParseMode
+from telegram.error import BadRequest
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Telegram rejects messages longer than this (UTF-16 code units)
+MAX_MESSAGE_LENGTH = 4096
+FRAGMENT_CACHE_SIZE = 1024
+
+# Tags Telegram accepts in HTML parse mode, and how other common tags are mapped
+ALLOWED_TAGS = {"b", "i", "u", "s", "a", "code", "pre", "tg-spoiler", "blockquote"}
+TAG_ALIASES = {
+    "strong": "b", "em": "i", "ins": "u", "strike": "s", "del": "s",
+    "h1": "b", "h2": "b", "h3": "b", "h4": "b", "h5": "b", "h6": "b",
+}
+# Block tags that are dropped but leave a line break behind
+BREAK_TAGS = {"br": "\n", "p": "\n\n", "div": "\n", "ul": "\n", "ol": "\n", "tr": "\n"}
+
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)([^<>]*?)(/?)>")
+_HREF_RE = re.compile(r"""href\s*=\s*["']([^"']*)["']""")
+_CODE_CLASS_RE = re.compile(r"""class\s*=\s*["'](language-[\w+-]+)["']""")
+_BARE_AMP_RE = re.compile(r"&(?!(?:amp|lt|gt|quot|#\d+|#x[0-9a-fA-F]+);)")
+
+_FENCE_RE = re.compile(r"```([\w+-]*)[ \t]*\n?(.*?)```", re.DOTALL)
+_INLINE_CODE_RE = re.compile(r"`([^`\n]+)`")
+_LINK_RE = re.compile(r"\[([^\]\n]+)\]\((https?://[^)\s]+)\)")
+_BOLD_RE = re.compile(r"(\*\*|__)(?=\S)(.+?)(?<=\S)\1")
+_ITALIC_RE = re.compile(r"(?<![\w*])([*_])(?=\S)([^*_\n]+?)(?<=\S)\1(?![\w*])")
+_STRIKE_RE = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~")
+_HEADING_RE = re.compile(r"^#{1,6}\s+(.+?)\s*#*$", re.MULTILINE)
+_BULLET_RE = re.compile(r"^([ \t]*)[*-][ \t]+", re.MULTILINE)
+_PARAGRAPH_RE = re.compile(r"(\n{2,})")
+
+
+def utf16_length(text):
+    """Length of text as Telegram counts it."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _escape_text(text):
+    """Escape a text run, keeping entities that are already valid."""
+    return _BARE_AMP_RE.sub("&amp;", text).replace("<", "&lt;").replace(">", "&gt;")
+
+
+def sanitize_html(text):
+    """Turn model HTML into markup Telegram accepts.
+
+    Supported tags are kept (aliases are renamed), block tags become line
+    breaks, anything else is escaped and the result is always balanced.
+    """
+    out = []
+    stack = []
+    position = 0
+    for match in _TAG_RE.finditer(text):
+        out.append(_escape_text(text[position:match.start()]))
+        position = match.end()
+        closing, name, attributes = match.group(1), match.group(2).lower(), match.group(3)
+        name = TAG_ALIASES.get(name, name)
+        in_code = any(tag in ("pre", "code") for tag, _ in stack)
+
+        if name == "li" and not in_code:
+            if not closing:
+                out.append("\n• ")
+            continue
+        if name in BREAK_TAGS and not in_code:
+            out.append(BREAK_TAGS[name] if closing or name == "br" else "")
+            continue
+        if in_code:
+            # Only <pre><code> nesting is allowed; other tags inside code are text
+            top = stack[-1][0]
+            allowed_in_code = (closing and name == top) or (not closing and name == "code" and top == "pre")
+        if name not in ALLOWED_TAGS or (in_code and not allowed_in_code):
+            out.append(_escape_text(match.group(0)))
+            continue
+
+        if closing:
+            if name not in [tag for tag, _ in stack]:
+                continue  # Stray closing tag
+            # Close anything left open inside it
+            while stack:
+                tag, _ = stack.pop()
+                out.append(f"</{tag}>")
+                if tag == name:
+                    break
+            continue
+
+        if name == "a":
+            href = _HREF_RE.search(attributes)
+            if not href:
+                continue
+            opening = f'<a href="{html.escape(html.unescape(href.group(1)))}">'
+        elif name == "code":
+            language = _CODE_CLASS_RE.search(attributes)
+            opening = f'<code class="{language.group(1)}">' if language else "<code>"
+        else:
+            opening = f"<{name}>"
+        out.append(opening)
+        stack.append((name, opening))
+
+    out.append(_escape_text(text[position:]))
+    for tag, _ in reversed(stack):
+        out.append(f"</{tag}>")
+    return "".join(out)
+
+
+def _markdown_inline(text):
+    """Convert inline Markdown of a text run that has no code fences."""
+    placeholders = []
+
+    def protect(html_fragment):
+        placeholders.append(html_fragment)
+        return f"\x00{len(placeholders) - 1}\x00"
+
+    text = html.escape(text, quote=False)
+    text = _INLINE_CODE_RE.sub(lambda m: protect(f"<code>{m.group(1)}</code>"), text)
+    text = _LINK_RE.sub(lambda m: protect(f'<a href="{m.group(2)}">{m.group(1)}</a>'), text)
+    text = _HEADING_RE.sub(r"<b>\1</b>", text)
+    text = _BOLD_RE.sub(r"<b>\2</b>", text)
+    text = _BULLET_RE.sub(r"\1• ", text)
+    text = _ITALIC_RE.sub(r"<i>\2</i>", text)
+    text = _STRIKE_RE.sub(r"<s>\1</s>", text)
+    return re.sub(r"\x00(\d+)\x00", lambda m: placeholders[int(m.group(1))], text)
+
+
+def markdown_to_html(text):
+    """Convert the Markdown subset models produce into Telegram HTML."""
+    out = []
+    position = 0
+    for match in _FENCE_RE.finditer(text):
+        out.append(_markdown_inline(text[position:match.start()]))
+        language, code = match.group(1), html.escape(match.group(2).rstrip("\n"), quote=False)
+        if language:
+            out.append(f'<pre><code class="language-{language}">{code}</code></pre>')
+        else:
+            out.append(f"<pre>{code}</pre>")
+        position = match.end()
+    out.append(_markdown_inline(text[position:]))
+    return sanitize_html("".join(out))
+
+
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def _render_fragment(fragment, parse_mode):
+    if parse_mode == "markdown":
+        return markdown_to_html(fragment)
+    return sanitize_html(fragment)
+
+
+def _fragments(text):
+    """Split text into paragraphs without breaking code fences apart."""
+    fragments = []
+    position = 0
+    for match in _FENCE_RE.finditer(text):
+        fragments.extend(_PARAGRAPH_RE.split(text[position:match.start()]))
+        fragments.append(match.group(0))
+        position = match.end()
+    fragments.extend(_PARAGRAPH_RE.split(text[position:]))
+    return [fragment for fragment in fragments if fragment]
+
+
+def to_telegram_html(text, parse_mode="html"):
+    """Render model output as Telegram-safe HTML.
+
+    Paragraphs are converted one by one through an LRU cache, so repeated
+    fragments (greetings, disclaimers, recurring snippets) are converted once.
+    """
+    parse_mode = (parse_mode or "html").lower()
+    # HTML-mode output can carry tags across paragraphs, so it is sanitized whole
+    if parse_mode != "markdown" and "\n\n" in text and _TAG_RE.search(text):
+        return _render_fragment(text, parse_mode)
+    return "".join(_render_fragment(fragment, parse_mode) for fragment in _fragments(text))
+
+
+def html_to_plain_text(text):
+    """Drop every tag and entity from Telegram HTML."""
+    return html.unescape(_TAG_RE.sub("", text))
+
+
+def _prefix_within(text, budget):
+    """Largest prefix of text whose UTF-16 length fits in budget."""
+    end = min(len(text), budget)
+    while end > 0 and utf16_length(text[:end]) > budget:
+        end -= max(1, (utf16_length(text[:end]) - budget) // 2)
+    return end
+
+
+def _break_point(text, end):
+    """Best place to cut text[:end]: paragraph, line, sentence, word, then anywhere."""
+    minimum = end // 2
+    for separator in ("\n\n", "\n", ". ", " "):
+        index = text.rfind(separator, minimum, end)
+        if index != -1:
+            return index + len(separator)
+    # Never cut an HTML entity in half
+    amp = text.rfind("&", max(0, end - 8), end)
+    if amp != -1 and ";" not in text[amp:end]:
+        return amp or end
+    return end
+
+
+def split_plain_text(text, limit=MAX_MESSAGE_LENGTH):
+    """Split plain text into chunks of at most limit on natural boundaries."""
+    chunks = []
+    while utf16_length(text) > limit:
+        cut = _break_point(text, _prefix_within(text, limit))
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip("\n")
+    if text.strip():
+        chunks.append(text)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def split_html(text, limit=MAX_MESSAGE_LENGTH):
+    """Split balanced Telegram HTML into chunks of at most limit.
+
+    Tags open at a cut are closed at the end of the chunk and reopened at the
+    start of the next one, so every chunk parses on its own.
+    """
+    if utf16_length(text) <= limit:
+        return [text]
+
+    chunks = []
+    stack = []  # (name, opening tag)
+    current = []
+    current_length = 0
+
+    def closers():
+        return "".join(f"</{name}>" for name, _ in reversed(stack))
+
+    def flush():
+        nonlocal current, current_length
+        body = "".join(current) + closers()
+        if html_to_plain_text(body).strip():
+            chunks.append(body)
+        current = [opening for _, opening in stack]
+        current_length = sum(utf16_length(opening) for opening in current)
+
+    position = 0
+    tokens = []
+    for match in _TAG_RE.finditer(text):
+        if match.start() > position:
+            tokens.append((None, text[position:match.start()]))
+        tokens.append((match, match.group(0)))
+        position = match.end()
+    if position < len(text):
+        tokens.append((None, text[position:]))
+
+    for match, token in tokens:
+        if match is None:
+            while token:
+                budget = limit - current_length - utf16_length(closers())
+                if utf16_length(token) <= budget:
+                    current.append(token)
+                    current_length += utf16_length(token)
+                    break
+                cut = _break_point(token, _prefix_within(token, budget)) if budget > 0 else 0
+                if cut == 0 and current_length == sum(utf16_length(o) for _, o in stack):
+                    # Nothing fits even in an empty chunk: hard cut
+                    cut = max(1, _prefix_within(token, budget))
+                current.append(token[:cut])
+                flush()
+                token = token[cut:].lstrip("\n")
+            continue
+
+        token_length = utf16_length(token)
+        if current_length + token_length + utf16_length(closers()) > limit:
+            flush()
+        current.append(token)
+        current_length += token_length
+        if match.group(1):
+            if stack:
+                stack.pop()
+        else:
+            stack.append((match.group(2).lower(), token))
+    flush()
+    return chunks
+
+
+def render_reply(text, parse_mode="html", limit=MAX_MESSAGE_LENGTH):
+    """Render model output into a list of Telegram HTML messages."""
+    return split_html(to_telegram_html(text, parse_mode), limit)
+
+
+def send_rendered(reply, text, parse_mode="html"):
+    """Send model output with reply(text, parse_mode=...), one message per chunk.
+
+    If Telegram still rejects a chunk's markup it is resent as plain text, so a
+    paid completion is never lost to a formatting error. Returns the number of
+    messages sent.
+    """
+    sent = 0
+    for chunk in render_reply(text, parse_mode):
+        try:
+            reply(chunk, parse_mode=ParseMode.HTML)
+            sent += 1
+        except BadRequest as e:
+            logger.warning(f"Telegram rejected rendered reply ({e}); resending as plain text")
+            for plain_chunk in split_plain_text(html_to_plain_text(chunk)):
+                reply(plain_chunk)
+                sent += 1
+    return sent
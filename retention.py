@@ -0,0 +1,112 @@
+import os
+import logging
+import argparse
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from tracing import traced, start_trace
+from storage import get_storage, USAGE_ARCHIVE_DIR
+from database import ensure_schema
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# usage_history retention policy. A value of 0 disables that step.
+USAGE_COMPRESS_AFTER_DAYS = int(os.getenv('USAGE_COMPRESS_AFTER_DAYS', '1'))
+USAGE_TEXT_RETENTION_DAYS = int(os.getenv('USAGE_TEXT_RETENTION_DAYS', '30'))
+USAGE_ARCHIVE_AFTER_MONTHS = int(os.getenv('USAGE_ARCHIVE_AFTER_MONTHS', '3'))
+# Let the retention job convert an existing database to incremental
+# auto-vacuum. That is one full VACUUM, which locks the database for every
+# write while it runs: prefer `python retention.py --convert-vacuum` with the
+# bot stopped
+USAGE_VACUUM_CONVERT = os.getenv('USAGE_VACUUM_CONVERT', 'false').lower() == 'true'
+RETENTION_INTERVAL_HOURS = float(os.getenv('RETENTION_INTERVAL_HOURS', '24'))
+RETENTION_BATCH_SIZE = 1000
+# Pages released per incremental vacuum run (4 KiB each by default)
+INCREMENTAL_VACUUM_PAGES = 5000
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    """How long each tier of usage_history keeps what.
+
+    - rows older than compress_after_days keep their text compressed
+    - rows older than text_retention_days lose their text, counts are kept
+    - months older than archive_after_months move to one file per month
+    """
+    compress_after_days: int = USAGE_COMPRESS_AFTER_DAYS
+    text_retention_days: int = USAGE_TEXT_RETENTION_DAYS
+    archive_after_months: int = USAGE_ARCHIVE_AFTER_MONTHS
+    archive_dir: str = USAGE_ARCHIVE_DIR
+    vacuum_convert: bool = USAGE_VACUUM_CONVERT
+    batch_size: int = RETENTION_BATCH_SIZE
+    vacuum_pages: int = INCREMENTAL_VACUUM_PAGES
+
+    def compress_cutoff(self, now):
+        return _timestamp(now - timedelta(days=self.compress_after_days)) if self.compress_after_days else None
+
+    def text_cutoff(self, now):
+        return _timestamp(now - timedelta(days=self.text_retention_days)) if self.text_retention_days else None
+
+    def archive_cutoff(self, now):
+        """First day of the oldest month that stays in the live table."""
+        if not self.archive_after_months:
+            return None
+        month_index = now.year * 12 + now.month - 1 - self.archive_after_months
+        return f"{month_index // 12:04d}-{month_index % 12 + 1:02d}-01 00:00:00"
+
+
+def _timestamp(moment):
+    """Format like SQLite's CURRENT_TIMESTAMP (UTC)."""
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+DEFAULT_POLICY = RetentionPolicy()
+
+
+@traced("db.apply_usage_retention")
+def apply_usage_retention(policy=DEFAULT_POLICY, now=None):
+    """Run one retention pass. Returns a dict with what was done, or None on error."""
+    try:
+        result = get_storage().apply_usage_retention(policy, now or datetime.utcnow())
+        logger.info(f"Usage retention finished: {result}")
+        return result
+    except Exception as e:
+        logger.error(f"Error applying usage retention: {e}")
+        return None
+
+
+def retention_loop(interval_hours=RETENTION_INTERVAL_HOURS, stop_event=None):
+    """Apply the retention policy periodically (run in a daemon thread)."""
+    stop_event = stop_event or threading.Event()
+    while not stop_event.wait(interval_hours * 3600):
+        with start_trace("maintenance.usage_retention"):
+            apply_usage_retention()
+
+
+def main(argv=None):
+    """Command line maintenance: python retention.py --convert-vacuum"""
+    parser = argparse.ArgumentParser(description="Usage history retention.")
+    parser.add_argument('--convert-vacuum', action='store_true',
+                        help="Switch the database to incremental auto-vacuum (full VACUUM; stop the bot first)")
+    parser.add_argument('--run', action='store_true', help="Run one retention pass")
+    args = parser.parse_args(argv)
+    if not (args.convert_vacuum or args.run):
+        parser.error("nothing to do: use --convert-vacuum and/or --run")
+
+    ensure_schema()
+    if args.convert_vacuum:
+        if get_storage().convert_to_incremental_vacuum():
+            print("Database converted to incremental auto-vacuum")
+        else:
+            print("Nothing to convert")
+    if args.run:
+        apply_usage_retention()
+
+
+if __name__ == '__main__':
+    main()
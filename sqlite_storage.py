@@ -0,0 +1,1168 @@
+import os
+import glob
+import json
+import sqlite3
+import logging
+from contextlib import contextmanager
+from storage import (
+    StorageBackend, DEFAULT_CREDITS, EXPORT_COLUMNS, BROADCAST_SEGMENTS, LEDGER_SIGNUP, LEDGER_OPENING_BALANCE
+)
+from conversation_archive import (
+    compress_conversation, decompress_conversation, compress_text, decompress_text,
+    ARCHIVE_BATCH_SIZE, ARCHIVE_REASON_EXPIRED, ARCHIVE_REASON_RESET
+)
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Exports read this many rows per query; the read lock is released between pages
+EXPORT_PAGE_SIZE = 5000
+
+# kind -> (table, keyset column, date column, selected columns)
+_EXPORT_SOURCES = {
+    'users': ('users', 'user_id', 'registration_date', ', '.join(EXPORT_COLUMNS['users'])),
+    'usage': ('usage_history', 'id', 'timestamp', ', '.join(EXPORT_COLUMNS['usage'] + ('message_blob',))),
+    'payments': ('payments', 'payment_id', 'created_at', ', '.join(EXPORT_COLUMNS['payments'])),
+}
+
+
+class SQLiteStorage(StorageBackend):
+    """Storage backend on a single SQLite database file."""
+
+    def __init__(self, path, usage_archive_dir=None):
+        self.path = path
+        self.usage_archive_dir = usage_archive_dir
+
+    @contextmanager
+    def _connection(self):
+        """Open a connection, commit on success and always close it."""
+        conn = sqlite3.connect(self.path)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def init_schema(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            # Only takes effect on a new database; existing ones are converted
+            # once with `python retention.py --convert-vacuum`
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+            # Create users table (simplified)
+            cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                credits INTEGER DEFAULT {DEFAULT_CREDITS},
+                is_admin INTEGER DEFAULT 0,
+                registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''')
+
+            # Index for username prefix search in the admin user browser
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE)
+            ''')
+
+            # Create usage history table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS usage_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                message_text TEXT,
+                tokens_used INTEGER,
+                credits_used INTEGER,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+            ''')
+
+            # Older databases were created without message_blob, where the
+            # retention job keeps compressed message text
+            cursor.execute("PRAGMA table_info(usage_history)")
+            usage_columns = [row[1] for row in cursor.fetchall()]
+            if 'message_blob' not in usage_columns:
+                cursor.execute("ALTER TABLE usage_history ADD COLUMN message_blob BLOB")
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_usage_history_timestamp ON usage_history(timestamp)
+            ''')
+
+            # Progress of the retention job (last usage_history id handled per step)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS retention_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+            ''')
+
+            # Create user preferences table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_preferences (
+                user_id INTEGER,
+                preference_key TEXT,
+                preference_value TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, preference_key),
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+            ''')
+
+            # Rollup tables, updated incrementally by record_usage so reports
+            # never need to scan usage_history
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_usage_rollup (
+                day TEXT,
+                model TEXT,
+                messages INTEGER DEFAULT 0,
+                tokens INTEGER DEFAULT 0,
+                credits INTEGER DEFAULT 0,
+                PRIMARY KEY (day, model)
+            )
+            ''')
+
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_active_users (
+                day TEXT,
+                user_id INTEGER,
+                PRIMARY KEY (day, user_id)
+            ) WITHOUT ROWID
+            ''')
+
+            # Create conversation context table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_context (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                messages TEXT,
+                last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+            ''')
+
+            # Compressed archive of expired and reset conversations, so the
+            # live conversation_context table only holds active ones
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_archive (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                reason TEXT,
+                last_interaction TIMESTAMP,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                message_count INTEGER,
+                dictionary_version INTEGER,
+                data BLOB
+            )
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_conversation_archive_user ON conversation_archive(user_id, id)
+            ''')
+
+            # Create payments table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS payments (
+                payment_id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                amount REAL,
+                currency TEXT,
+                credits INTEGER,
+                status TEXT,
+                paypal_order_id TEXT,
+                paypal_payment_id TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+            ''')
+
+            # Older databases were created without package_id
+            cursor.execute("PRAGMA table_info(payments)")
+            payment_columns = [row[1] for row in cursor.fetchall()]
+            if 'package_id' not in payment_columns:
+                cursor.execute("ALTER TABLE payments ADD COLUMN package_id TEXT")
+
+            # Revenue rollup, updated when a payment becomes completed
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_revenue_rollup (
+                day TEXT,
+                package_id TEXT,
+                currency TEXT,
+                payments INTEGER DEFAULT 0,
+                revenue REAL DEFAULT 0,
+                credits INTEGER DEFAULT 0,
+                PRIMARY KEY (day, package_id, currency)
+            )
+            ''')
+
+            # Users who blocked the bot are skipped by broadcasts
+            cursor.execute("PRAGMA table_info(users)")
+            user_columns = [row[1] for row in cursor.fetchall()]
+            if 'is_blocked' not in user_columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN is_blocked INTEGER DEFAULT 0")
+
+            # Per-user lookups used by broadcast segments
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_daily_active_users_user ON daily_active_users(user_id, day)
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id, status)
+            ''')
+            # Lets the order expiry job find abandoned orders without a scan
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments(status, created_at)
+            ''')
+
+            # Broadcast jobs; last_user_id is the checkpoint a restart resumes from
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                segment TEXT,
+                since TIMESTAMP,
+                message TEXT,
+                status TEXT,
+                last_user_id INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                created_by INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_results (
+                job_id INTEGER,
+                user_id INTEGER,
+                status TEXT,
+                error TEXT,
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (job_id, user_id)
+            ) WITHOUT ROWID
+            ''')
+
+            # Append-only credit ledger; users.credits is the balance it adds up to
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'credit_ledger'")
+            ledger_exists = cursor.fetchone() is not None
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS credit_ledger (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                amount INTEGER,
+                balance_after INTEGER,
+                entry_type TEXT,
+                reference TEXT,
+                idempotency_key TEXT UNIQUE,
+                description TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_credit_ledger_user ON credit_ledger(user_id, id)
+            ''')
+            if not ledger_exists:
+                # Existing balances become the first entry of each user
+                cursor.execute(
+                    "INSERT INTO credit_ledger (user_id, amount, balance_after, entry_type, description) "
+                    "SELECT user_id, credits, credits, ?, ? FROM users ORDER BY user_id",
+                    (LEDGER_OPENING_BALANCE, "Saldo anterior al registro de movimientos")
+                )
+
+            # Credits held by in-flight generations; credits_held is the sum of
+            # the user's holds, so free credits are credits - credits_held
+            cursor.execute("PRAGMA table_info(users)")
+            user_columns = [row[1] for row in cursor.fetchall()]
+            if 'credits_held' not in user_columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN credits_held INTEGER DEFAULT 0")
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS credit_holds (
+                hold_id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                amount INTEGER,
+                expires_at TIMESTAMP
+            ) WITHOUT ROWID
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_credit_holds_expires ON credit_holds(expires_at)
+            ''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS processed_updates (
+                update_id INTEGER PRIMARY KEY,
+                processed_at TIMESTAMP
+            )
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_processed_updates_time ON processed_updates(processed_at)
+            ''')
+
+    @staticmethod
+    def _insert_ledger_entry(cursor, user_id, amount, balance_after, entry_type,
+                             reference=None, idempotency_key=None, description=None):
+        cursor.execute(
+            "INSERT INTO credit_ledger (user_id, amount, balance_after, entry_type, reference, idempotency_key, description) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, amount, balance_after, entry_type, reference, idempotency_key, description)
+        )
+
+    # Users
+    def get_user(self, user_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            return cursor.fetchone()
+
+    def register_user(self, user_id, username, first_name, last_name):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            # Check if user exists
+            cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+            if cursor.fetchone():
+                # Just update basic info
+                cursor.execute(
+                    "UPDATE users SET username = ?, first_name = ?, last_name = ?, is_blocked = 0 WHERE user_id = ?",
+                    (username, first_name, last_name, user_id)
+                )
+                return False
+
+            # Create new user with default credits
+            cursor.execute(
+                "INSERT INTO users (user_id, username, first_name, last_name, credits) VALUES (?, ?, ?, ?, ?)",
+                (user_id, username, first_name, last_name, DEFAULT_CREDITS)
+            )
+            self._insert_ledger_entry(cursor, user_id, DEFAULT_CREDITS, DEFAULT_CREDITS, LEDGER_SIGNUP,
+                                      description="Créditos iniciales")
+            return True
+
+    def delete_user(self, user_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+            if not cursor.fetchone():
+                return False
+
+            # Eliminar registros relacionados primero
+            cursor.execute("DELETE FROM conversation_context WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM conversation_archive WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM user_preferences WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM usage_history WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM broadcast_results WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM credit_ledger WHERE user_id = ?", (user_id,))
+
+            # Finalmente eliminar el usuario
+            cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+
+        # Also forget the user in the monthly usage archives
+        for path in self._usage_archive_files():
+            archive = sqlite3.connect(path)
+            try:
+                archive.execute("DELETE FROM usage_history WHERE user_id = ?", (user_id,))
+                archive.commit()
+            finally:
+                archive.close()
+        return True
+
+    def set_admin_status(self, user_id, is_admin_status):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+            if cursor.fetchone():
+                cursor.execute(
+                    "UPDATE users SET is_admin = ? WHERE user_id = ?",
+                    (1 if is_admin_status else 0, user_id)
+                )
+            else:
+                cursor.execute(
+                    "INSERT INTO users (user_id, is_admin, credits) VALUES (?, ?, ?)",
+                    (user_id, 1 if is_admin_status else 0, DEFAULT_CREDITS)
+                )
+                self._insert_ledger_entry(cursor, user_id, DEFAULT_CREDITS, DEFAULT_CREDITS, LEDGER_SIGNUP,
+                                          description="Créditos iniciales")
+
+    def is_admin(self, user_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT is_admin FROM users WHERE user_id = ?", (user_id,))
+            result = cursor.fetchone()
+            return bool(result and result[0] == 1)
+
+    def get_all_users(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id, username, first_name, last_name FROM users")
+            return cursor.fetchall()
+
+    def get_users_page(self, cursor_user_id, direction, search, limit):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            conditions = []
+            params = []
+            if search:
+                search = search.lstrip('@')
+                # Prefix match as a range so idx_users_username can be used
+                username_condition = "(username >= ? COLLATE NOCASE AND username < ? COLLATE NOCASE)"
+                username_params = [search, search + '\U0010ffff']
+                if search.isdigit():
+                    conditions.append(f"(CAST(user_id AS TEXT) LIKE ? OR {username_condition})")
+                    params.extend([f"{search}%"] + username_params)
+                else:
+                    conditions.append(username_condition)
+                    params.extend(username_params)
+            if cursor_user_id is not None:
+                conditions.append("user_id < ?" if direction == "prev" else "user_id > ?")
+                params.append(cursor_user_id)
+
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            order = "DESC" if direction == "prev" else "ASC"
+            # Fetch one extra row to know whether another page exists
+            cursor.execute(
+                f"SELECT user_id, username, first_name, last_name FROM users {where} ORDER BY user_id {order} LIMIT ?",
+                params + [limit + 1]
+            )
+            users = cursor.fetchall()
+        has_more = len(users) > limit
+        users = users[:limit]
+        if direction == "prev":
+            users.reverse()
+        return users, has_more
+
+    # Credits
+    def get_user_credits(self, user_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+    def update_user_credits(self, user_id, credits_change, transaction_type, description,
+                            reference=None, idempotency_key=None):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # Take the write lock before reading the balance so concurrent
+            # updates of the same user cannot interleave
+            cursor.execute("BEGIN IMMEDIATE")
+
+            return self._apply_credit_change(cursor, user_id, credits_change, transaction_type, description,
+                                             reference, idempotency_key)
+
+    def _apply_credit_change(self, cursor, user_id, credits_change, transaction_type, description,
+                             reference, idempotency_key):
+        """Update the balance and insert its ledger entry. Caller holds the write lock."""
+        if idempotency_key is not None:
+            cursor.execute("SELECT 1 FROM credit_ledger WHERE idempotency_key = ?", (idempotency_key,))
+            if cursor.fetchone():
+                return False
+
+        cursor.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,))
+        result = cursor.fetchone()
+        if not result:
+            return False
+
+        new_credits = max(0, result[0] + credits_change)  # Ensure credits don't go below 0
+        cursor.execute(
+            "UPDATE users SET credits = ? WHERE user_id = ?",
+            (new_credits, user_id)
+        )
+        self._insert_ledger_entry(cursor, user_id, new_credits - result[0], new_credits, transaction_type,
+                                  reference, idempotency_key, description)
+        return True
+
+    _LEDGER_COLUMNS = (
+        'id', 'user_id', 'amount', 'balance_after', 'entry_type', 'reference',
+        'idempotency_key', 'description', 'created_at',
+    )
+
+    def get_credit_ledger(self, user_id, limit):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT {', '.join(self._LEDGER_COLUMNS)} FROM credit_ledger WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, limit)
+            )
+            return [dict(zip(self._LEDGER_COLUMNS, row)) for row in cursor.fetchall()]
+
+    def find_balance_mismatches(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT u.user_id, u.credits, COALESCE(l.total, 0)
+            FROM users u
+            LEFT JOIN (SELECT user_id, SUM(amount) AS total FROM credit_ledger GROUP BY user_id) l
+                ON l.user_id = u.user_id
+            WHERE u.credits != COALESCE(l.total, 0)
+            ORDER BY u.user_id
+            ''')
+            return cursor.fetchall()
+
+    def reserve_credits(self, hold_id, user_id, amount, expires_at):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # Check and hold in one statement so concurrent reservations cannot both pass
+            cursor.execute(
+                "UPDATE users SET credits_held = COALESCE(credits_held, 0) + ? "
+                "WHERE user_id = ? AND credits - COALESCE(credits_held, 0) >= ?",
+                (amount, user_id, amount)
+            )
+            if cursor.rowcount != 1:
+                return False
+            cursor.execute(
+                "INSERT INTO credit_holds (hold_id, user_id, amount, expires_at) VALUES (?, ?, ?, ?)",
+                (hold_id, user_id, amount, expires_at)
+            )
+            return True
+
+    @staticmethod
+    def _take_hold(cursor, hold_id):
+        """Delete a hold and free its credits. Returns (user_id, amount) or None."""
+        cursor.execute("SELECT user_id, amount FROM credit_holds WHERE hold_id = ?", (hold_id,))
+        hold = cursor.fetchone()
+        if hold is None:
+            return None
+        cursor.execute("DELETE FROM credit_holds WHERE hold_id = ?", (hold_id,))
+        cursor.execute(
+            "UPDATE users SET credits_held = MAX(0, COALESCE(credits_held, 0) - ?) WHERE user_id = ?",
+            (hold[1], hold[0])
+        )
+        return hold
+
+    def commit_credit_hold(self, hold_id, transaction_type, description, reference=None, idempotency_key=None):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            hold = self._take_hold(cursor, hold_id)
+            if hold is None:
+                return False
+            return self._apply_credit_change(cursor, hold[0], -hold[1], transaction_type, description,
+                                             reference, idempotency_key)
+
+    def release_credit_hold(self, hold_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            return self._take_hold(cursor, hold_id) is not None
+
+    def release_expired_credit_holds(self, now):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT hold_id FROM credit_holds WHERE expires_at < ?", (now,))
+            expired = [row[0] for row in cursor.fetchall()]
+            for hold_id in expired:
+                self._take_hold(cursor, hold_id)
+            return len(expired)
+
+    # Processed Telegram updates
+    def record_processed_update(self, update_id, processed_at):
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO processed_updates (update_id, processed_at) VALUES (?, ?)",
+                (update_id, processed_at)
+            )
+            return cursor.rowcount == 1
+
+    def get_processed_update_ids(self, since):
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "SELECT update_id FROM processed_updates WHERE processed_at >= ? ORDER BY update_id",
+                (since,)
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def prune_processed_updates(self, cutoff):
+        with self._connection() as conn:
+            cursor = conn.execute("DELETE FROM processed_updates WHERE processed_at < ?", (cutoff,))
+            return cursor.rowcount
+
+    # Preferences
+    def get_preference(self, user_id, key):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT preference_value FROM user_preferences WHERE user_id = ? AND preference_key = ?",
+                (user_id, key)
+            )
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+    def set_preference(self, user_id, key, value):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO user_preferences (user_id, preference_key, preference_value) VALUES (?, ?, ?)",
+                (user_id, key, value)
+            )
+
+    # Conversations
+    def get_conversation(self, user_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT messages FROM conversation_context WHERE user_id = ?", (user_id,))
+            result = cursor.fetchone()
+            return json.loads(result[0]) if result else []
+
+    def save_conversation(self, user_id, messages):
+        messages_json = json.dumps(messages)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            # Update existing context - asegurarse de actualizar el timestamp
+            cursor.execute(
+                "UPDATE conversation_context SET messages = ?, last_interaction = CURRENT_TIMESTAMP WHERE user_id = ?",
+                (messages_json, user_id)
+            )
+            if cursor.rowcount == 0:
+                # Create new context
+                cursor.execute(
+                    "INSERT INTO conversation_context (user_id, messages) VALUES (?, ?)",
+                    (user_id, messages_json)
+                )
+
+    def _archive_rows(self, cursor, rows, reason):
+        """Compress (id, user_id, messages, last_interaction) rows into the archive and drop them."""
+        archived = []
+        for _, user_id, messages_json, last_interaction in rows:
+            messages = json.loads(messages_json) if messages_json else []
+            dictionary_version, data = compress_conversation(messages)
+            archived.append((user_id, reason, last_interaction, len(messages), dictionary_version, data))
+        cursor.executemany(
+            '''INSERT INTO conversation_archive
+               (user_id, reason, last_interaction, message_count, dictionary_version, data)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            archived
+        )
+        cursor.executemany("DELETE FROM conversation_context WHERE id = ?", [(row[0],) for row in rows])
+
+    def clear_conversation(self, user_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id, user_id, messages, last_interaction FROM conversation_context WHERE user_id = ?",
+                (user_id,)
+            )
+            rows = cursor.fetchall()
+            if rows:
+                self._archive_rows(cursor, rows, ARCHIVE_REASON_RESET)
+
+    def clear_inactive_conversations(self, cutoff_time_str):
+        inactive_users = []
+        last_id = 0
+        # One short transaction per batch so the bot is never blocked for long
+        while True:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    '''SELECT id, user_id, messages, last_interaction FROM conversation_context
+                       WHERE last_interaction < ? AND id > ? ORDER BY id LIMIT ?''',
+                    (cutoff_time_str, last_id, ARCHIVE_BATCH_SIZE)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return inactive_users
+                self._archive_rows(cursor, rows, ARCHIVE_REASON_EXPIRED)
+            inactive_users.extend(row[1] for row in rows)
+            last_id = rows[-1][0]
+
+    def get_archived_conversations(self, user_id, limit):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''SELECT id, user_id, reason, last_interaction, archived_at, dictionary_version, data
+                   FROM conversation_archive WHERE user_id = ? ORDER BY id DESC LIMIT ?''',
+                (user_id, limit)
+            )
+            rows = cursor.fetchall()
+        return [
+            {
+                'id': archive_id, 'user_id': row_user_id, 'reason': reason,
+                'last_interaction': last_interaction, 'archived_at': archived_at,
+                'messages': decompress_conversation(dictionary_version, data),
+            }
+            for archive_id, row_user_id, reason, last_interaction, archived_at, dictionary_version, data in rows
+        ]
+
+    # Usage
+    def record_usage(self, user_id, message_text, tokens_used, credits_used, model_key):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO usage_history (user_id, message_text, tokens_used, credits_used) VALUES (?, ?, ?, ?)",
+                (user_id, message_text, tokens_used, credits_used)
+            )
+
+            # Update rollups in the same transaction
+            cursor.execute(
+                '''INSERT INTO daily_usage_rollup (day, model, messages, tokens, credits)
+                   VALUES (date('now'), ?, 1, ?, ?)
+                   ON CONFLICT(day, model) DO UPDATE SET
+                       messages = messages + 1,
+                       tokens = tokens + excluded.tokens,
+                       credits = credits + excluded.credits''',
+                (model_key, tokens_used, credits_used)
+            )
+            cursor.execute(
+                "INSERT OR IGNORE INTO daily_active_users (day, user_id) VALUES (date('now'), ?)",
+                (user_id,)
+            )
+
+    def get_usage_stats(self, since_day):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''SELECT day, SUM(messages), SUM(tokens), SUM(credits)
+                   FROM daily_usage_rollup WHERE day >= ? GROUP BY day ORDER BY day''',
+                (since_day,)
+            )
+            usage_by_day = {row[0]: row[1:] for row in cursor.fetchall()}
+
+            cursor.execute(
+                "SELECT day, COUNT(*) FROM daily_active_users WHERE day >= ? GROUP BY day",
+                (since_day,)
+            )
+            active_by_day = dict(cursor.fetchall())
+
+            cursor.execute(
+                '''SELECT model, SUM(messages), SUM(tokens), SUM(credits)
+                   FROM daily_usage_rollup WHERE day >= ? GROUP BY model ORDER BY SUM(messages) DESC''',
+                (since_day,)
+            )
+            models = cursor.fetchall()
+
+        daily = []
+        for day in sorted(set(usage_by_day) | set(active_by_day)):
+            messages, tokens, credits = usage_by_day.get(day, (0, 0, 0))
+            daily.append((day, active_by_day.get(day, 0), messages, tokens, credits))
+        return {'daily': daily, 'models': models}
+
+    # Retention
+    def apply_usage_retention(self, policy, now):
+        result = {'compressed': 0, 'text_removed': 0, 'archived': 0, 'vacuumed_pages': 0}
+
+        # Expire text first so it is not compressed just to be dropped
+        text_cutoff = policy.text_cutoff(now)
+        if text_cutoff:
+            result['text_removed'] = self._usage_batches(
+                'text_expired_through_id', text_cutoff, policy.batch_size, self._expire_text)
+        compress_cutoff = policy.compress_cutoff(now)
+        if compress_cutoff:
+            result['compressed'] = self._usage_batches(
+                'compressed_through_id', compress_cutoff, policy.batch_size, self._compress_text)
+
+        archive_cutoff = policy.archive_cutoff(now)
+        if archive_cutoff:
+            with self._connection() as conn:
+                months = [row[0] for row in conn.execute(
+                    "SELECT DISTINCT substr(timestamp, 1, 7) FROM usage_history WHERE timestamp < ?",
+                    (archive_cutoff,)
+                )]
+            for month in months:
+                result['archived'] += self._archive_usage_month(month, policy.archive_dir, policy.batch_size)
+
+        result['vacuumed_pages'] = self._incremental_vacuum(policy.vacuum_convert, policy.vacuum_pages)
+        return result
+
+    def _usage_batches(self, state_key, cutoff, batch_size, process):
+        """Feed usage_history rows older than cutoff to process(cursor, rows) in id order.
+
+        Each batch is its own transaction and the last id handled is stored
+        under state_key, so every row is visited once across runs.
+        """
+        total = 0
+        while True:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT value FROM retention_state WHERE key = ?", (state_key,))
+                row = cursor.fetchone()
+                cursor.execute(
+                    '''SELECT id, message_text FROM usage_history
+                       WHERE id > ? AND timestamp < ? ORDER BY id LIMIT ?''',
+                    (row[0] if row else 0, cutoff, batch_size)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return total
+                total += process(cursor, rows)
+                cursor.execute(
+                    '''INSERT INTO retention_state (key, value) VALUES (?, ?)
+                       ON CONFLICT(key) DO UPDATE SET value = excluded.value''',
+                    (state_key, rows[-1][0])
+                )
+            if len(rows) < batch_size:
+                return total
+
+    @staticmethod
+    def _expire_text(cursor, rows):
+        cursor.executemany(
+            '''UPDATE usage_history SET message_text = NULL, message_blob = NULL
+               WHERE id = ? AND (message_text IS NOT NULL OR message_blob IS NOT NULL)''',
+            [(row_id,) for row_id, _ in rows]
+        )
+        return cursor.rowcount
+
+    @staticmethod
+    def _compress_text(cursor, rows):
+        updates = []
+        for row_id, message_text in rows:
+            if not message_text:
+                continue
+            blob = compress_text(message_text)
+            # Very short texts grow when compressed: keep those as they are
+            if len(blob) < len(message_text.encode('utf-8')):
+                updates.append((blob, row_id))
+        cursor.executemany("UPDATE usage_history SET message_blob = ?, message_text = NULL WHERE id = ?", updates)
+        return len(updates)
+
+    def _usage_archive_files(self):
+        if not self.usage_archive_dir:
+            return []
+        return sorted(glob.glob(os.path.join(self.usage_archive_dir, 'usage_*.db')))
+
+    def _archive_usage_month(self, month, archive_dir, batch_size):
+        """Move one month (YYYY-MM) of usage_history to its own database file."""
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(archive_dir, f"usage_{month.replace('-', '_')}.db")
+        year, month_number = (int(part) for part in month.split('-'))
+        start = f"{month}-01 00:00:00"
+        end = f"{year + month_number // 12:04d}-{month_number % 12 + 1:02d}-01 00:00:00"
+        columns = "id, user_id, message_text, tokens_used, credits_used, timestamp, message_blob"
+
+        moved = 0
+        with self._connection() as conn:
+            # ATTACH is not allowed inside a transaction, so it goes first
+            conn.execute("ATTACH DATABASE ? AS usage_archive", (path,))
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS usage_archive.usage_history (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                message_text TEXT,
+                tokens_used INTEGER,
+                credits_used INTEGER,
+                timestamp TIMESTAMP,
+                message_blob BLOB
+            )
+            ''')
+            while True:
+                rows = conn.execute(
+                    "SELECT id FROM usage_history WHERE timestamp >= ? AND timestamp < ? ORDER BY id LIMIT ?",
+                    (start, end, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                batch = (start, end, rows[-1][0])
+                conn.execute(
+                    f'''INSERT OR IGNORE INTO usage_archive.usage_history ({columns})
+                        SELECT {columns} FROM usage_history
+                        WHERE timestamp >= ? AND timestamp < ? AND id <= ?''',
+                    batch
+                )
+                cursor = conn.execute(
+                    "DELETE FROM usage_history WHERE timestamp >= ? AND timestamp < ? AND id <= ?", batch
+                )
+                # Both files are committed atomically
+                conn.commit()
+                moved += cursor.rowcount
+            conn.execute("DETACH DATABASE usage_archive")
+        logger.info(f"Moved {moved} usage_history rows of {month} to {path}")
+        return moved
+
+    def _incremental_vacuum(self, convert, pages):
+        """Return up to pages free pages to the filesystem."""
+        with self._connection() as conn:
+            auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum != 2:  # Not INCREMENTAL
+            if not convert:
+                logger.warning("Incremental vacuum is inactive: convert the database once with "
+                               "`python retention.py --convert-vacuum` while the bot is stopped")
+                return 0
+            self.convert_to_incremental_vacuum()
+            return 0
+        with self._connection() as conn:
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # The pragma frees one page per step: fetch every row to run it fully
+            conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return min(free_pages, pages)
+
+    def convert_to_incremental_vacuum(self):
+        # Changing auto_vacuum on an existing database needs one full VACUUM:
+        # it rewrites the file under an exclusive lock and needs about as much
+        # free disk as the database
+        with self._connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return False
+        logger.info("Converting the database to incremental auto-vacuum (full VACUUM)")
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+        return True
+
+    # Broadcasts
+    _BROADCAST_COLUMNS = (
+        'job_id', 'segment', 'since', 'message', 'status', 'last_user_id',
+        'sent', 'failed', 'blocked', 'created_by', 'created_at', 'updated_at',
+    )
+
+    # segment -> extra condition on users u, and whether it takes the since bound
+    _SEGMENT_CONDITIONS = {
+        'all': ("", False),
+        'paid': (
+            """ AND EXISTS (SELECT 1 FROM payments p
+                         WHERE p.user_id = u.user_id AND p.status = 'completed' AND p.updated_at >= ?)""",
+            True
+        ),
+        'active': (
+            " AND EXISTS (SELECT 1 FROM daily_active_users d WHERE d.user_id = u.user_id AND d.day >= ?)",
+            True
+        ),
+        'never_paid': (
+            " AND NOT EXISTS (SELECT 1 FROM payments p WHERE p.user_id = u.user_id AND p.status = 'completed')",
+            False
+        ),
+        'no_credits': (" AND u.credits = 0", False),
+    }
+
+    def create_broadcast(self, segment, since, message, created_by):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO broadcast_jobs (segment, since, message, status, created_by) VALUES (?, ?, ?, 'running', ?)",
+                (segment, since, message, created_by)
+            )
+            return cursor.lastrowid
+
+    def get_broadcast(self, job_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT {', '.join(self._BROADCAST_COLUMNS)} FROM broadcast_jobs WHERE job_id = ?", (job_id,)
+            )
+            row = cursor.fetchone()
+            return dict(zip(self._BROADCAST_COLUMNS, row)) if row else None
+
+    def list_broadcasts(self, limit):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT {', '.join(self._BROADCAST_COLUMNS)} FROM broadcast_jobs ORDER BY job_id DESC LIMIT ?",
+                (limit,)
+            )
+            return [dict(zip(self._BROADCAST_COLUMNS, row)) for row in cursor.fetchall()]
+
+    def set_broadcast_status(self, job_id, status):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE broadcast_jobs SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE job_id = ?",
+                (status, job_id)
+            )
+
+    def get_broadcast_recipients(self, segment, since, after_user_id, limit):
+        if segment not in BROADCAST_SEGMENTS:
+            raise ValueError(f"Unknown segment: {segment}")
+        condition, uses_since = self._SEGMENT_CONDITIONS[segment]
+        params = [after_user_id or 0]
+        if uses_since:
+            # daily_active_users stores days, payments full timestamps
+            params.append(since[:10] if segment == 'active' else since)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'''SELECT u.user_id FROM users u
+                    WHERE u.user_id > ? AND COALESCE(u.is_blocked, 0) = 0{condition}
+                    ORDER BY u.user_id LIMIT ?''',
+                params + [limit]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def record_broadcast_results(self, job_id, results, last_user_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+            for user_id, status, error in results:
+                # Ignore users already recorded (a resend after a crash)
+                cursor.execute(
+                    "INSERT OR IGNORE INTO broadcast_results (job_id, user_id, status, error) VALUES (?, ?, ?, ?)",
+                    (job_id, user_id, status, error)
+                )
+                if cursor.rowcount:
+                    counts[status] += 1
+            cursor.executemany(
+                "UPDATE users SET is_blocked = 1 WHERE user_id = ?",
+                [(user_id,) for user_id, status, _ in results if status == 'blocked']
+            )
+            cursor.execute(
+                '''UPDATE broadcast_jobs SET
+                       sent = sent + ?, failed = failed + ?, blocked = blocked + ?,
+                       last_user_id = MAX(last_user_id, ?), updated_at = CURRENT_TIMESTAMP
+                   WHERE job_id = ?''',
+                (counts['sent'], counts['failed'], counts['blocked'], last_user_id, job_id)
+            )
+
+    # Exports
+    def iter_export(self, kind, since, until, user_id, chunk_size):
+        if kind not in _EXPORT_SOURCES:
+            raise ValueError(f"Unknown export: {kind}")
+        paths = [self.path]
+        if kind == 'usage':
+            # Months moved out by the retention job come first, in order
+            paths = self._usage_archive_files_between(since, until) + paths
+        for path in paths:
+            for chunk in self._iter_export_pages(path, kind, since, until, user_id, chunk_size):
+                if kind == 'usage':
+                    chunk = [
+                        (row_id, row_user_id, text if blob is None else decompress_text(blob), tokens, credits, timestamp)
+                        for row_id, row_user_id, text, tokens, credits, timestamp, blob in chunk
+                    ]
+                yield chunk
+
+    def _iter_export_pages(self, path, kind, since, until, user_id, chunk_size):
+        """Keyset-paginated read of one table, yielding chunks of chunk_size rows."""
+        table, key, date_column, columns = _EXPORT_SOURCES[kind]
+        last_key = None
+        while True:
+            conditions, params = [], []
+            for condition, value in ((f"{key} > ?", last_key), (f"{date_column} >= ?", since),
+                                     (f"{date_column} < ?", until), ("user_id = ?", user_id)):
+                if value is not None:
+                    conditions.append(condition)
+                    params.append(value)
+            where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+            # Read one page and close the connection before yielding, so a slow
+            # client never keeps the database locked
+            conn = sqlite3.connect(path)
+            try:
+                cursor = conn.execute(
+                    f"SELECT {columns} FROM {table}{where} ORDER BY {key} LIMIT ?",
+                    params + [EXPORT_PAGE_SIZE]
+                )
+                page = cursor.fetchmany(EXPORT_PAGE_SIZE)
+            finally:
+                conn.close()
+
+            for start in range(0, len(page), chunk_size):
+                yield page[start:start + chunk_size]
+            if len(page) < EXPORT_PAGE_SIZE:
+                return
+            last_key = page[-1][0]
+
+    def _usage_archive_files_between(self, since, until):
+        """Monthly usage archive files that may hold rows in [since, until)."""
+        paths = []
+        for path in self._usage_archive_files():
+            month = os.path.basename(path)[len('usage_'):-len('.db')].replace('_', '-')
+            if (since is None or month >= since[:7]) and (until is None or month <= until[:7]):
+                paths.append(path)
+        return paths
+
+    # Payments
+    def create_payment(self, payment_id, user_id, package_id, amount, currency, credits):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO payments (payment_id, user_id, amount, currency, credits, status, package_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (payment_id, user_id, amount, currency, credits, 'pending', package_id)
+            )
+
+    def update_payment_status(self, payment_id, status, paypal_order_id=None, paypal_payment_id=None):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # The return page, the capture and the webhook may complete the
+            # same payment at once: only one of them may see the transition
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(
+                "SELECT status, package_id, amount, currency, credits FROM payments WHERE payment_id = ?",
+                (payment_id,)
+            )
+            previous = cursor.fetchone()
+
+            update_fields = ["status = ?", "updated_at = CURRENT_TIMESTAMP"]
+            params = [status]
+
+            if paypal_order_id:
+                update_fields.append("paypal_order_id = ?")
+                params.append(paypal_order_id)
+
+            if paypal_payment_id:
+                update_fields.append("paypal_payment_id = ?")
+                params.append(paypal_payment_id)
+
+            params.append(payment_id)
+
+            cursor.execute(
+                f"UPDATE payments SET {', '.join(update_fields)} WHERE payment_id = ?",
+                params
+            )
+
+            # Count revenue only once, on the transition to completed
+            if status == 'completed' and previous and previous[0] != 'completed':
+                _, package_id, amount, currency, credits = previous
+                cursor.execute(
+                    '''INSERT INTO daily_revenue_rollup (day, package_id, currency, payments, revenue, credits)
+                       VALUES (date('now'), ?, ?, 1, ?, ?)
+                       ON CONFLICT(day, package_id, currency) DO UPDATE SET
+                           payments = payments + 1,
+                           revenue = revenue + excluded.revenue,
+                           credits = credits + excluded.credits''',
+                    (package_id or 'unknown', currency, amount, credits)
+                )
+
+    def expire_stale_payments(self, statuses, cutoff):
+        placeholders = ', '.join('?' for _ in statuses)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"UPDATE payments SET status = 'expired', updated_at = CURRENT_TIMESTAMP "
+                f"WHERE status IN ({placeholders}) AND created_at < ?",
+                (*statuses, cutoff)
+            )
+            return cursor.rowcount
+
+    def has_completed_payment(self, user_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # Served by idx_payments_user (user_id, status)
+            cursor.execute(
+                "SELECT 1 FROM payments WHERE user_id = ? AND status = 'completed' LIMIT 1", (user_id,)
+            )
+            return cursor.fetchone() is not None
+
+    def get_payment(self, payment_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM payments WHERE payment_id = ?", (payment_id,))
+            payment = cursor.fetchone()
+            if payment:
+                columns = [desc[0] for desc in cursor.description]
+                return dict(zip(columns, payment))
+            return None
+
+    def get_latest_payment(self, user_id, package_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT * FROM payments WHERE user_id = ? AND package_id = ? ORDER BY created_at DESC, rowid DESC LIMIT 1",
+                (user_id, package_id)
+            )
+            payment = cursor.fetchone()
+            if payment:
+                columns = [desc[0] for desc in cursor.description]
+                return dict(zip(columns, payment))
+            return None
+
+    def get_revenue_stats(self, since_day):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''SELECT package_id, currency, SUM(payments), SUM(revenue), SUM(credits)
+                   FROM daily_revenue_rollup WHERE day >= ?
+                   GROUP BY package_id, currency ORDER BY SUM(revenue) DESC''',
+                (since_day,)
+            )
+            return cursor.fetchall()
@@ -0,0 +1,1012 @@
+import os
+import json
+import base64
+import bisect
+import logging
+import threading
+from datetime import datetime
+from conversation_archive import (
+    compress_conversation, decompress_conversation, ARCHIVE_REASON_EXPIRED, ARCHIVE_REASON_RESET
+)
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')  # 'sqlite' or 'memory'
+MEMORY_SNAPSHOT_PATH = os.getenv('MEMORY_SNAPSHOT_PATH')
+MEMORY_SNAPSHOT_INTERVAL_SECONDS = int(os.getenv('MEMORY_SNAPSHOT_INTERVAL_SECONDS', '300'))
+# Old months of usage_history are moved to one SQLite file per month in this directory
+USAGE_ARCHIVE_DIR = os.getenv('USAGE_ARCHIVE_DIR', 'usage_archive')
+
+# Broadcast segments. Segments marked True take a number of days
+# (e.g. 'paid' = completed a payment in the last N days).
+BROADCAST_SEGMENTS = {
+    'all': False,         # Everyone who has not blocked the bot
+    'paid': True,         # Completed a payment in the last N days
+    'active': True,       # Used the assistant in the last N days
+    'never_paid': False,  # Never completed a payment
+    'no_credits': False,  # Ran out of credits
+}
+BROADCAST_STATUSES = ('running', 'paused', 'completed', 'cancelled')
+
+# Columns of each export, in order (see StorageBackend.iter_export)
+EXPORT_COLUMNS = {
+    'users': ('user_id', 'username', 'first_name', 'last_name', 'credits', 'is_admin', 'registration_date'),
+    'usage': ('id', 'user_id', 'message_text', 'tokens_used', 'credits_used', 'timestamp'),
+    'payments': (
+        'payment_id', 'user_id', 'package_id', 'amount', 'currency', 'credits', 'status',
+        'paypal_order_id', 'paypal_payment_id', 'created_at', 'updated_at',
+    ),
+}
+DEFAULT_CREDITS = 5
+LOCK_STRIPES = 16
+
+# Ledger entry types written by the storage backends themselves
+LEDGER_SIGNUP = 'signup'
+LEDGER_OPENING_BALANCE = 'opening_balance'
+
+
+def _utc_timestamp():
+    """Current UTC time formatted like SQLite's CURRENT_TIMESTAMP."""
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _utc_day():
+    return datetime.utcnow().strftime('%Y-%m-%d')
+
+
+class StorageBackend:
+    """Persistence interface used by database.py and paypal_payment.py.
+
+    Backends raise on errors; the module level helpers in database.py and
+    paypal_payment.py log them and fall back to safe defaults.
+    """
+
+    def init_schema(self):
+        """Create whatever structures the backend needs. Must be idempotent."""
+        raise NotImplementedError
+
+    def close(self):
+        """Flush anything held in memory before the process exits."""
+
+    # Users
+    def get_user(self, user_id):
+        """Return (user_id, username, first_name, last_name, credits, is_admin, registration_date) or None."""
+        raise NotImplementedError
+
+    def register_user(self, user_id, username, first_name, last_name):
+        """Insert or update a user. Returns True if the user is new.
+
+        A user who talks to the bot again is no longer marked as blocked.
+        """
+        raise NotImplementedError
+
+    def delete_user(self, user_id):
+        """Delete a user and all its data. Returns False if it did not exist."""
+        raise NotImplementedError
+
+    def set_admin_status(self, user_id, is_admin_status):
+        raise NotImplementedError
+
+    def is_admin(self, user_id):
+        raise NotImplementedError
+
+    def get_all_users(self):
+        """Return [(user_id, username, first_name, last_name), ...]."""
+        raise NotImplementedError
+
+    def get_users_page(self, cursor_user_id, direction, search, limit):
+        """Keyset page of users, see database.get_users_page."""
+        raise NotImplementedError
+
+    # Credits
+    def get_user_credits(self, user_id):
+        """Return the user's credits or None if the user does not exist."""
+        raise NotImplementedError
+
+    def update_user_credits(self, user_id, credits_change, transaction_type, description,
+                            reference=None, idempotency_key=None):
+        """Append a signed entry to the credit ledger and update the balance atomically.
+
+        The balance never goes below 0; the entry records the change actually
+        applied. Returns False (and changes nothing) if the user does not exist
+        or an entry with the same idempotency_key was already applied.
+        """
+        raise NotImplementedError
+
+    def get_credit_ledger(self, user_id, limit):
+        """Return the user's most recent ledger entries as dicts, newest first."""
+        raise NotImplementedError
+
+    def find_balance_mismatches(self):
+        """Return [(user_id, credits, ledger_sum), ...] for users whose balance differs from their ledger."""
+        raise NotImplementedError
+
+    def reserve_credits(self, hold_id, user_id, amount, expires_at):
+        """Hold amount credits until commit, release or expires_at.
+
+        Held credits stay in the balance but cannot be reserved again. Returns
+        False if the user does not have amount credits free of other holds.
+        """
+        raise NotImplementedError
+
+    def commit_credit_hold(self, hold_id, transaction_type, description, reference=None, idempotency_key=None):
+        """Turn a hold into a ledger entry that charges its credits.
+
+        Returns False if the hold no longer exists (released or expired) or
+        the idempotency_key was already applied; the hold is gone either way.
+        """
+        raise NotImplementedError
+
+    def release_credit_hold(self, hold_id):
+        """Drop a hold without charging it. Returns False if it did not exist."""
+        raise NotImplementedError
+
+    def release_expired_credit_holds(self, now):
+        """Release every hold that expired before now ('YYYY-MM-DD HH:MM:SS'). Returns how many."""
+        raise NotImplementedError
+
+    # Processed Telegram updates
+    def record_processed_update(self, update_id, processed_at):
+        """Remember an update id. Returns False if it was already recorded."""
+        raise NotImplementedError
+
+    def get_processed_update_ids(self, since):
+        """Return the ids recorded at or after since ('YYYY-MM-DD HH:MM:SS'), in ascending order."""
+        raise NotImplementedError
+
+    def prune_processed_updates(self, cutoff):
+        """Forget the ids recorded before cutoff. Returns how many."""
+        raise NotImplementedError
+
+    # Preferences
+    def get_preference(self, user_id, key):
+        raise NotImplementedError
+
+    def set_preference(self, user_id, key, value):
+        raise NotImplementedError
+
+    # Conversations
+    def get_conversation(self, user_id):
+        """Return the list of messages (empty if there is none)."""
+        raise NotImplementedError
+
+    def save_conversation(self, user_id, messages):
+        raise NotImplementedError
+
+    def clear_conversation(self, user_id):
+        """Move the user's conversation to the compressed archive."""
+        raise NotImplementedError
+
+    def clear_inactive_conversations(self, cutoff_time_str):
+        """Archive conversations idle since before the cutoff and return their user ids."""
+        raise NotImplementedError
+
+    def get_archived_conversations(self, user_id, limit):
+        """Return the user's most recent archived conversations, newest first.
+
+        Each one is a dict with id, user_id, reason, last_interaction,
+        archived_at and the decompressed messages.
+        """
+        raise NotImplementedError
+
+    # Usage
+    def record_usage(self, user_id, message_text, tokens_used, credits_used, model_key):
+        raise NotImplementedError
+
+    def get_usage_stats(self, since_day):
+        """Return {'daily': [...], 'models': [...]}, see database.get_usage_stats."""
+        raise NotImplementedError
+
+    def apply_usage_retention(self, policy, now):
+        """Apply a retention.RetentionPolicy to usage_history. Returns a dict of counters."""
+        raise NotImplementedError
+
+    def convert_to_incremental_vacuum(self):
+        """Switch an existing database file to incremental auto-vacuum.
+
+        Blocks every other write while it runs. Returns False if there was
+        nothing to convert.
+        """
+        return False
+
+    # Payments
+    def create_payment(self, payment_id, user_id, package_id, amount, currency, credits):
+        raise NotImplementedError
+
+    def update_payment_status(self, payment_id, status, paypal_order_id=None, paypal_payment_id=None):
+        raise NotImplementedError
+
+    def get_payment(self, payment_id):
+        """Return the payment as a dict or None."""
+        raise NotImplementedError
+
+    def get_latest_payment(self, user_id, package_id):
+        """Return the user's most recent payment of a package as a dict, or None."""
+        raise NotImplementedError
+
+    def expire_stale_payments(self, statuses, cutoff):
+        """Mark payments in one of statuses created before cutoff as 'expired'. Returns how many."""
+        raise NotImplementedError
+
+    def has_completed_payment(self, user_id):
+        """Return True if the user ever completed a payment."""
+        raise NotImplementedError
+
+    def get_revenue_stats(self, since_day):
+        """Return [(package_id, currency, payments, revenue, credits), ...]."""
+        raise NotImplementedError
+
+    # Broadcasts
+    def create_broadcast(self, segment, since, message, created_by):
+        """Create a running broadcast job and return its id.
+
+        since is the 'YYYY-MM-DD HH:MM:SS' lower bound for segments that take
+        days; it is fixed at creation so a resumed job targets the same users.
+        """
+        raise NotImplementedError
+
+    def get_broadcast(self, job_id):
+        """Return the job as a dict or None."""
+        raise NotImplementedError
+
+    def list_broadcasts(self, limit):
+        """Return the most recent jobs as dicts, newest first."""
+        raise NotImplementedError
+
+    def set_broadcast_status(self, job_id, status):
+        raise NotImplementedError
+
+    def get_broadcast_recipients(self, segment, since, after_user_id, limit):
+        """Keyset page of user ids in the segment, greater than after_user_id."""
+        raise NotImplementedError
+
+    def record_broadcast_results(self, job_id, results, last_user_id):
+        """Store [(user_id, status, error), ...] and move the job checkpoint to last_user_id.
+
+        status is 'sent', 'failed' or 'blocked'; blocked users are marked so
+        later segments skip them. Everything is applied atomically.
+        """
+        raise NotImplementedError
+
+    # Exports
+    def iter_export(self, kind, since, until, user_id, chunk_size):
+        """Yield lists of at most chunk_size rows (tuples in EXPORT_COLUMNS[kind] order).
+
+        since/until are 'YYYY-MM-DD HH:MM:SS' bounds (inclusive/exclusive) on
+        the row's date, user_id restricts to one user; any of them may be None.
+        Implementations must keep memory bounded regardless of table size.
+        """
+        raise NotImplementedError
+
+
+class MemoryStorage(StorageBackend):
+    """In-memory backend for tests, benchmarks and small deployments.
+
+    Per-user data is guarded by striped locks so different users do not
+    contend; aggregates and payments have their own locks. If snapshot_path is
+    set the whole state is loaded from / saved to a JSON file.
+    """
+
+    def __init__(self, snapshot_path=None, snapshot_interval=None):
+        self._stripes = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        self._index_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._payments_lock = threading.Lock()
+        self.users = {}
+        self.user_ids = []  # Sorted, for keyset pagination
+        self.preferences = {}
+        self.conversations = {}
+        self.archive = {}  # user_id -> [archived conversation, ...], oldest first
+        self.next_archive_id = 1
+        self.ledger = {}  # user_id -> [ledger entry, ...], oldest first
+        self.ledger_keys = set()
+        self.next_ledger_id = 1
+        self._ledger_lock = threading.Lock()
+        self.credit_holds = {}  # hold_id -> (user_id, amount, expires_at), not snapshotted
+        self.usage = []
+        self.usage_rollup = {}
+        self.active_users = {}
+        self.payments = {}
+        self.revenue_rollup = {}
+        self.broadcasts = {}
+        self.broadcast_results = {}  # job_id -> {user_id: (status, error, sent_at)}
+        self._broadcast_lock = threading.Lock()
+        self.processed_updates = {}  # update_id -> processed_at
+        self._updates_lock = threading.Lock()
+        self.snapshot_path = snapshot_path
+        self._stop_event = threading.Event()
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.load_snapshot()
+        if snapshot_path and snapshot_interval:
+            threading.Thread(target=self._snapshot_loop, args=(snapshot_interval,), daemon=True).start()
+
+    def _lock_for(self, key):
+        return self._stripes[hash(key) % LOCK_STRIPES]
+
+    def init_schema(self):
+        pass
+
+    # Users
+    def get_user(self, user_id):
+        with self._lock_for(user_id):
+            user = self.users.get(user_id)
+            if user is None:
+                return None
+            return (user_id, user['username'], user['first_name'], user['last_name'],
+                    user['credits'], user['is_admin'], user['registration_date'])
+
+    def _create_user(self, user_id, **fields):
+        user = {
+            'username': None, 'first_name': None, 'last_name': None,
+            'credits': DEFAULT_CREDITS, 'is_admin': 0, 'registration_date': _utc_timestamp(),
+            'is_blocked': 0, 'credits_held': 0,
+        }
+        user.update(fields)
+        self.users[user_id] = user
+        self._append_ledger(user_id, user['credits'], user['credits'], LEDGER_SIGNUP, None, None, "Créditos iniciales")
+        with self._index_lock:
+            bisect.insort(self.user_ids, user_id)
+
+    def register_user(self, user_id, username, first_name, last_name):
+        with self._lock_for(user_id):
+            user = self.users.get(user_id)
+            if user:
+                user.update(username=username, first_name=first_name, last_name=last_name, is_blocked=0)
+                return False
+            self._create_user(user_id, username=username, first_name=first_name, last_name=last_name)
+            return True
+
+    def delete_user(self, user_id):
+        with self._lock_for(user_id):
+            if self.users.pop(user_id, None) is None:
+                return False
+            self.preferences.pop(user_id, None)
+            self.conversations.pop(user_id, None)
+            self.archive.pop(user_id, None)
+            with self._ledger_lock:
+                for entry in self.ledger.pop(user_id, []):
+                    self.ledger_keys.discard(entry['idempotency_key'])
+            with self._index_lock:
+                index = bisect.bisect_left(self.user_ids, user_id)
+                if index < len(self.user_ids) and self.user_ids[index] == user_id:
+                    del self.user_ids[index]
+        with self._stats_lock:
+            self.usage = [row for row in self.usage if row['user_id'] != user_id]
+        with self._broadcast_lock:
+            for results in self.broadcast_results.values():
+                results.pop(user_id, None)
+        return True
+
+    def set_admin_status(self, user_id, is_admin_status):
+        with self._lock_for(user_id):
+            if user_id in self.users:
+                self.users[user_id]['is_admin'] = 1 if is_admin_status else 0
+            else:
+                self._create_user(user_id, is_admin=1 if is_admin_status else 0)
+
+    def is_admin(self, user_id):
+        with self._lock_for(user_id):
+            user = self.users.get(user_id)
+            return bool(user and user['is_admin'] == 1)
+
+    def _user_summary(self, user_id):
+        user = self.users.get(user_id)
+        if user is None:
+            return None
+        return (user_id, user['username'], user['first_name'], user['last_name'])
+
+    def get_all_users(self):
+        with self._index_lock:
+            user_ids = list(self.user_ids)
+        return [row for row in map(self._user_summary, user_ids) if row]
+
+    def get_users_page(self, cursor_user_id, direction, search, limit):
+        search = search.lstrip('@').lower() if search else None
+
+        def matches(user_id):
+            user = self.users.get(user_id)
+            if user is None:
+                return False
+            if not search:
+                return True
+            if search.isdigit() and str(user_id).startswith(search):
+                return True
+            return (user['username'] or '').lower().startswith(search)
+
+        with self._index_lock:
+            if direction == "prev":
+                end = bisect.bisect_left(self.user_ids, cursor_user_id) if cursor_user_id is not None else len(self.user_ids)
+                candidates = reversed(self.user_ids[:end])
+            else:
+                start = bisect.bisect_right(self.user_ids, cursor_user_id) if cursor_user_id is not None else 0
+                candidates = iter(self.user_ids[start:])
+            users = []
+            for user_id in candidates:
+                if matches(user_id):
+                    users.append(self._user_summary(user_id))
+                    if len(users) > limit:
+                        break
+        has_more = len(users) > limit
+        users = users[:limit]
+        if direction == "prev":
+            users.reverse()
+        return users, has_more
+
+    # Credits
+    def get_user_credits(self, user_id):
+        with self._lock_for(user_id):
+            user = self.users.get(user_id)
+            return user['credits'] if user else None
+
+    def update_user_credits(self, user_id, credits_change, transaction_type, description,
+                            reference=None, idempotency_key=None):
+        with self._lock_for(user_id):
+            return self._apply_credit_change(user_id, credits_change, transaction_type, description,
+                                             reference, idempotency_key)
+
+    def _apply_credit_change(self, user_id, credits_change, transaction_type, description, reference, idempotency_key):
+        """Update the balance and append its ledger entry. Caller holds the user's lock."""
+        user = self.users.get(user_id)
+        if user is None:
+            return False
+        new_credits = max(0, user['credits'] + credits_change)
+        if not self._append_ledger(user_id, new_credits - user['credits'], new_credits,
+                                   transaction_type, reference, idempotency_key, description):
+            return False
+        user['credits'] = new_credits
+        return True
+
+    def _append_ledger(self, user_id, amount, balance_after, entry_type, reference, idempotency_key, description):
+        """Append a ledger entry. Caller holds the user's lock. False if the key was used."""
+        with self._ledger_lock:
+            if idempotency_key is not None:
+                if idempotency_key in self.ledger_keys:
+                    return False
+                self.ledger_keys.add(idempotency_key)
+            entry_id = self.next_ledger_id
+            self.next_ledger_id += 1
+        self.ledger.setdefault(user_id, []).append({
+            'id': entry_id, 'user_id': user_id, 'amount': amount, 'balance_after': balance_after,
+            'entry_type': entry_type, 'reference': reference, 'idempotency_key': idempotency_key,
+            'description': description, 'created_at': _utc_timestamp(),
+        })
+        return True
+
+    def get_credit_ledger(self, user_id, limit):
+        with self._lock_for(user_id):
+            return [dict(entry) for entry in reversed(self.ledger.get(user_id, [])[-limit:])]
+
+    def find_balance_mismatches(self):
+        with self._index_lock:
+            user_ids = list(self.user_ids)
+        mismatches = []
+        for user_id in user_ids:
+            with self._lock_for(user_id):
+                user = self.users.get(user_id)
+                if user is None:
+                    continue
+                ledger_sum = sum(entry['amount'] for entry in self.ledger.get(user_id, []))
+                if user['credits'] != ledger_sum:
+                    mismatches.append((user_id, user['credits'], ledger_sum))
+        return mismatches
+
+    def reserve_credits(self, hold_id, user_id, amount, expires_at):
+        with self._lock_for(user_id):
+            user = self.users.get(user_id)
+            if user is None or user['credits'] - user.get('credits_held', 0) < amount:
+                return False
+            user['credits_held'] = user.get('credits_held', 0) + amount
+            with self._ledger_lock:
+                self.credit_holds[hold_id] = (user_id, amount, expires_at)
+            return True
+
+    def _take_hold(self, hold_id):
+        """Remove a hold and give its credits back to the user's free balance."""
+        with self._ledger_lock:
+            hold = self.credit_holds.get(hold_id)
+        if hold is None:
+            return None
+        user_id, amount, _ = hold
+        with self._lock_for(user_id):
+            with self._ledger_lock:
+                if self.credit_holds.pop(hold_id, None) is None:
+                    return None
+            user = self.users.get(user_id)
+            if user:
+                user['credits_held'] = max(0, user.get('credits_held', 0) - amount)
+        return hold
+
+    def commit_credit_hold(self, hold_id, transaction_type, description, reference=None, idempotency_key=None):
+        with self._ledger_lock:
+            hold = self.credit_holds.get(hold_id)
+        if hold is None:
+            return False
+        with self._lock_for(hold[0]):
+            # Re-entrant: the hold is released and charged under the same lock
+            if self._take_hold(hold_id) is None:
+                return False
+            return self._apply_credit_change(hold[0], -hold[1], transaction_type, description,
+                                             reference, idempotency_key)
+
+    def release_credit_hold(self, hold_id):
+        return self._take_hold(hold_id) is not None
+
+    def release_expired_credit_holds(self, now):
+        with self._ledger_lock:
+            expired = [hold_id for hold_id, (_, _, expires_at) in self.credit_holds.items() if expires_at < now]
+        return sum(1 for hold_id in expired if self._take_hold(hold_id) is not None)
+
+    # Processed Telegram updates
+    def record_processed_update(self, update_id, processed_at):
+        with self._updates_lock:
+            if update_id in self.processed_updates:
+                return False
+            self.processed_updates[update_id] = processed_at
+            return True
+
+    def get_processed_update_ids(self, since):
+        with self._updates_lock:
+            return sorted(update_id for update_id, processed_at in self.processed_updates.items()
+                          if processed_at >= since)
+
+    def prune_processed_updates(self, cutoff):
+        with self._updates_lock:
+            stale = [update_id for update_id, processed_at in self.processed_updates.items() if processed_at < cutoff]
+            for update_id in stale:
+                del self.processed_updates[update_id]
+            return len(stale)
+
+    # Preferences
+    def get_preference(self, user_id, key):
+        with self._lock_for(user_id):
+            return self.preferences.get(user_id, {}).get(key)
+
+    def set_preference(self, user_id, key, value):
+        with self._lock_for(user_id):
+            self.preferences.setdefault(user_id, {})[key] = value
+
+    # Conversations
+    def get_conversation(self, user_id):
+        with self._lock_for(user_id):
+            conversation = self.conversations.get(user_id)
+            return list(conversation[0]) if conversation else []
+
+    def save_conversation(self, user_id, messages):
+        with self._lock_for(user_id):
+            self.conversations[user_id] = (list(messages), _utc_timestamp())
+
+    def clear_conversation(self, user_id):
+        with self._lock_for(user_id):
+            conversation = self.conversations.pop(user_id, None)
+            if conversation:
+                self._archive(user_id, conversation, ARCHIVE_REASON_RESET)
+
+    def clear_inactive_conversations(self, cutoff_time_str):
+        inactive_users = []
+        for user_id, (_, last_interaction) in list(self.conversations.items()):
+            with self._lock_for(user_id):
+                conversation = self.conversations.get(user_id)
+                if conversation and conversation[1] < cutoff_time_str:
+                    del self.conversations[user_id]
+                    self._archive(user_id, conversation, ARCHIVE_REASON_EXPIRED)
+                    inactive_users.append(user_id)
+        return inactive_users
+
+    def _archive(self, user_id, conversation, reason):
+        """Compress a conversation into the archive. Caller holds the user's lock."""
+        messages, last_interaction = conversation
+        dictionary_version, data = compress_conversation(messages)
+        with self._index_lock:
+            archive_id = self.next_archive_id
+            self.next_archive_id += 1
+        self.archive.setdefault(user_id, []).append({
+            'id': archive_id, 'user_id': user_id, 'reason': reason,
+            'last_interaction': last_interaction, 'archived_at': _utc_timestamp(),
+            'message_count': len(messages), 'dictionary_version': dictionary_version, 'data': data,
+        })
+
+    def get_archived_conversations(self, user_id, limit):
+        with self._lock_for(user_id):
+            entries = list(reversed(self.archive.get(user_id, [])))[:limit]
+        return [
+            {
+                'id': entry['id'], 'user_id': user_id, 'reason': entry['reason'],
+                'last_interaction': entry['last_interaction'], 'archived_at': entry['archived_at'],
+                'messages': decompress_conversation(entry['dictionary_version'], entry['data']),
+            }
+            for entry in entries
+        ]
+
+    # Usage
+    def record_usage(self, user_id, message_text, tokens_used, credits_used, model_key):
+        day = _utc_day()
+        with self._stats_lock:
+            self.usage.append({
+                'user_id': user_id, 'message_text': message_text, 'tokens_used': tokens_used,
+                'credits_used': credits_used, 'timestamp': _utc_timestamp(),
+            })
+            rollup = self.usage_rollup.setdefault((day, model_key), [0, 0, 0])
+            rollup[0] += 1
+            rollup[1] += tokens_used
+            rollup[2] += credits_used
+            self.active_users.setdefault(day, set()).add(user_id)
+
+    def get_usage_stats(self, since_day):
+        with self._stats_lock:
+            usage_by_day = {}
+            models = {}
+            for (day, model_key), (messages, tokens, credits) in self.usage_rollup.items():
+                if day < since_day:
+                    continue
+                for totals, key in ((usage_by_day, day), (models, model_key)):
+                    row = totals.setdefault(key, [0, 0, 0])
+                    row[0] += messages
+                    row[1] += tokens
+                    row[2] += credits
+            active_by_day = {day: len(users) for day, users in self.active_users.items() if day >= since_day}
+        daily = []
+        for day in sorted(set(usage_by_day) | set(active_by_day)):
+            messages, tokens, credits = usage_by_day.get(day, (0, 0, 0))
+            daily.append((day, active_by_day.get(day, 0), messages, tokens, credits))
+        model_rows = sorted(
+            ((model_key, *totals) for model_key, totals in models.items()),
+            key=lambda row: row[1], reverse=True
+        )
+        return {'daily': daily, 'models': model_rows}
+
+    def apply_usage_retention(self, policy, now):
+        # Only text expiry applies here: compression, monthly files and vacuum
+        # are about the size of the database file
+        removed = 0
+        text_cutoff = policy.text_cutoff(now)
+        if text_cutoff:
+            with self._stats_lock:
+                for row in self.usage:
+                    if row['timestamp'] < text_cutoff and row['message_text'] is not None:
+                        row['message_text'] = None
+                        removed += 1
+        return {'compressed': 0, 'text_removed': removed, 'archived': 0, 'vacuumed_pages': 0}
+
+    # Payments
+    def create_payment(self, payment_id, user_id, package_id, amount, currency, credits):
+        now = _utc_timestamp()
+        with self._payments_lock:
+            if payment_id in self.payments:
+                raise ValueError(f"Duplicate payment id {payment_id}")
+            self.payments[payment_id] = {
+                'payment_id': payment_id, 'user_id': user_id, 'amount': amount,
+                'currency': currency, 'credits': credits, 'status': 'pending',
+                'paypal_order_id': None, 'paypal_payment_id': None,
+                'created_at': now, 'updated_at': now, 'package_id': package_id,
+            }
+
+    def update_payment_status(self, payment_id, status, paypal_order_id=None, paypal_payment_id=None):
+        with self._payments_lock:
+            payment = self.payments.get(payment_id)
+            if payment is None:
+                return
+            previous_status = payment['status']
+            payment['status'] = status
+            payment['updated_at'] = _utc_timestamp()
+            if paypal_order_id:
+                payment['paypal_order_id'] = paypal_order_id
+            if paypal_payment_id:
+                payment['paypal_payment_id'] = paypal_payment_id
+            # Count revenue only once, on the transition to completed
+            if status == 'completed' and previous_status != 'completed':
+                key = (_utc_day(), payment['package_id'] or 'unknown', payment['currency'])
+                rollup = self.revenue_rollup.setdefault(key, [0, 0.0, 0])
+                rollup[0] += 1
+                rollup[1] += payment['amount']
+                rollup[2] += payment['credits']
+
+    def get_payment(self, payment_id):
+        with self._payments_lock:
+            payment = self.payments.get(payment_id)
+            return dict(payment) if payment else None
+
+    def get_latest_payment(self, user_id, package_id):
+        with self._payments_lock:
+            payments = [payment for payment in self.payments.values()
+                        if payment['user_id'] == user_id and payment['package_id'] == package_id]
+            return dict(max(reversed(payments), key=lambda payment: payment['created_at'])) if payments else None
+
+    def expire_stale_payments(self, statuses, cutoff):
+        now = _utc_timestamp()
+        expired = 0
+        with self._payments_lock:
+            for payment in self.payments.values():
+                if payment['status'] in statuses and payment['created_at'] < cutoff:
+                    payment['status'] = 'expired'
+                    payment['updated_at'] = now
+                    expired += 1
+        return expired
+
+    def has_completed_payment(self, user_id):
+        with self._payments_lock:
+            return any(
+                payment['user_id'] == user_id and payment['status'] == 'completed'
+                for payment in self.payments.values()
+            )
+
+    def get_revenue_stats(self, since_day):
+        with self._payments_lock:
+            totals = {}
+            for (day, package_id, currency), (payments, revenue, credits) in self.revenue_rollup.items():
+                if day < since_day:
+                    continue
+                row = totals.setdefault((package_id, currency), [0, 0.0, 0])
+                row[0] += payments
+                row[1] += revenue
+                row[2] += credits
+        return sorted(
+            ((package_id, currency, *row) for (package_id, currency), row in totals.items()),
+            key=lambda row: row[3], reverse=True
+        )
+
+    # Broadcasts
+    def create_broadcast(self, segment, since, message, created_by):
+        now = _utc_timestamp()
+        with self._broadcast_lock:
+            job_id = max(self.broadcasts, default=0) + 1
+            self.broadcasts[job_id] = {
+                'job_id': job_id, 'segment': segment, 'since': since, 'message': message,
+                'status': 'running', 'last_user_id': 0, 'sent': 0, 'failed': 0, 'blocked': 0,
+                'created_by': created_by, 'created_at': now, 'updated_at': now,
+            }
+            self.broadcast_results[job_id] = {}
+            return job_id
+
+    def get_broadcast(self, job_id):
+        with self._broadcast_lock:
+            job = self.broadcasts.get(job_id)
+            return dict(job) if job else None
+
+    def list_broadcasts(self, limit):
+        with self._broadcast_lock:
+            return [dict(self.broadcasts[job_id]) for job_id in sorted(self.broadcasts, reverse=True)[:limit]]
+
+    def set_broadcast_status(self, job_id, status):
+        with self._broadcast_lock:
+            job = self.broadcasts.get(job_id)
+            if job:
+                job['status'] = status
+                job['updated_at'] = _utc_timestamp()
+
+    def _in_segment(self, user_id, user, segment, since):
+        if user.get('is_blocked'):
+            return False
+        if segment == 'paid':
+            return any(
+                payment['user_id'] == user_id and payment['status'] == 'completed' and payment['updated_at'] >= since
+                for payment in self.payments.values()
+            )
+        if segment == 'active':
+            return any(user_id in users for day, users in self.active_users.items() if day >= since[:10])
+        if segment == 'never_paid':
+            return not any(
+                payment['user_id'] == user_id and payment['status'] == 'completed'
+                for payment in self.payments.values()
+            )
+        if segment == 'no_credits':
+            return user['credits'] == 0
+        return True
+
+    def get_broadcast_recipients(self, segment, since, after_user_id, limit):
+        if segment not in BROADCAST_SEGMENTS:
+            raise ValueError(f"Unknown segment: {segment}")
+        with self._index_lock:
+            start = bisect.bisect_right(self.user_ids, after_user_id or 0)
+            candidates = self.user_ids[start:]
+        recipients = []
+        for user_id in candidates:
+            with self._lock_for(user_id):
+                user = self.users.get(user_id)
+                if user is None:
+                    continue
+                with self._stats_lock, self._payments_lock:
+                    if not self._in_segment(user_id, user, segment, since):
+                        continue
+            recipients.append(user_id)
+            if len(recipients) >= limit:
+                break
+        return recipients
+
+    def record_broadcast_results(self, job_id, results, last_user_id):
+        for user_id, status, _ in results:
+            if status == 'blocked':
+                with self._lock_for(user_id):
+                    if user_id in self.users:
+                        self.users[user_id]['is_blocked'] = 1
+        now = _utc_timestamp()
+        with self._broadcast_lock:
+            job = self.broadcasts.get(job_id)
+            if job is None:
+                return
+            job_results = self.broadcast_results.setdefault(job_id, {})
+            for user_id, status, error in results:
+                if user_id not in job_results:
+                    job_results[user_id] = (status, error, now)
+                    job[status] += 1
+            job['last_user_id'] = max(job['last_user_id'], last_user_id)
+            job['updated_at'] = now
+
+    # Exports
+    def iter_export(self, kind, since, until, user_id, chunk_size):
+        def in_range(row_user_id, moment):
+            return ((user_id is None or row_user_id == user_id)
+                    and (since is None or moment >= since)
+                    and (until is None or moment < until))
+
+        if kind == 'users':
+            with self._index_lock:
+                user_ids = list(self.user_ids)
+            def rows():
+                for row_user_id in user_ids:
+                    with self._lock_for(row_user_id):
+                        user = self.users.get(row_user_id)
+                        if user and in_range(row_user_id, user['registration_date']):
+                            yield (row_user_id, *(user[column] for column in EXPORT_COLUMNS['users'][1:]))
+        elif kind == 'usage':
+            def rows():
+                position = 0
+                while True:
+                    # Copy a slice at a time so the lock is never held while yielding
+                    with self._stats_lock:
+                        batch = self.usage[position:position + chunk_size]
+                    if not batch:
+                        return
+                    for index, row in enumerate(batch, start=position + 1):
+                        if in_range(row['user_id'], row['timestamp']):
+                            yield (index, row['user_id'], row['message_text'], row['tokens_used'],
+                                   row['credits_used'], row['timestamp'])
+                    position += len(batch)
+        elif kind == 'payments':
+            with self._payments_lock:
+                payments = [dict(self.payments[payment_id]) for payment_id in sorted(self.payments)]
+            def rows():
+                for payment in payments:
+                    if in_range(payment['user_id'], payment['created_at']):
+                        yield tuple(payment[column] for column in EXPORT_COLUMNS['payments'])
+        else:
+            raise ValueError(f"Unknown export: {kind}")
+
+        chunk = []
+        for row in rows():
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    # Snapshots
+    def save_snapshot(self, path=None):
+        """Write the whole state to a JSON file (atomically)."""
+        path = path or self.snapshot_path
+        for lock in self._stripes:
+            lock.acquire()
+        try:
+            with self._stats_lock, self._payments_lock, self._broadcast_lock, self._ledger_lock, self._updates_lock:
+                state = {
+                    'users': [[user_id, user] for user_id, user in self.users.items()],
+                    'preferences': [[user_id, prefs] for user_id, prefs in self.preferences.items()],
+                    'conversations': [[user_id, messages, last] for user_id, (messages, last) in self.conversations.items()],
+                    'archive': [
+                        dict(entry, data=base64.b64encode(entry['data']).decode('ascii'))
+                        for entries in self.archive.values() for entry in entries
+                    ],
+                    'next_archive_id': self.next_archive_id,
+                    'ledger': [entry for entries in self.ledger.values() for entry in entries],
+                    'next_ledger_id': self.next_ledger_id,
+                    'usage': self.usage,
+                    'usage_rollup': [[list(key), value] for key, value in self.usage_rollup.items()],
+                    'active_users': {day: sorted(users) for day, users in self.active_users.items()},
+                    'payments': self.payments,
+                    'revenue_rollup': [[list(key), value] for key, value in self.revenue_rollup.items()],
+                    'broadcasts': list(self.broadcasts.values()),
+                    'broadcast_results': [
+                        [job_id, user_id, *result]
+                        for job_id, results in self.broadcast_results.items() for user_id, result in results.items()
+                    ],
+                    'processed_updates': [[update_id, processed_at] for update_id, processed_at in self.processed_updates.items()],
+                }
+                data = json.dumps(state, ensure_ascii=False)
+        finally:
+            for lock in self._stripes:
+                lock.release()
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        logger.info(f"Memory storage snapshot saved to {path}")
+
+    def load_snapshot(self, path=None):
+        path = path or self.snapshot_path
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        self.users = {user_id: user for user_id, user in state['users']}
+        self.user_ids = sorted(self.users)
+        self.preferences = {user_id: prefs for user_id, prefs in state['preferences']}
+        self.conversations = {user_id: (messages, last) for user_id, messages, last in state['conversations']}
+        self.archive = {}
+        for entry in state.get('archive', []):
+            entry['data'] = base64.b64decode(entry['data'])
+            self.archive.setdefault(entry['user_id'], []).append(entry)
+        self.next_archive_id = state.get('next_archive_id', 1)
+        self.ledger = {}
+        self.ledger_keys = set()
+        self.next_ledger_id = state.get('next_ledger_id', 1)
+        for entry in state.get('ledger', []):
+            self.ledger.setdefault(entry['user_id'], []).append(entry)
+            if entry['idempotency_key'] is not None:
+                self.ledger_keys.add(entry['idempotency_key'])
+        # Holds belong to the process that made them
+        self.credit_holds = {}
+        for user in self.users.values():
+            user['credits_held'] = 0
+        if 'ledger' not in state:
+            # Snapshots from before the ledger: start it from the current balances
+            for user_id, user in self.users.items():
+                self._append_ledger(user_id, user['credits'], user['credits'], LEDGER_OPENING_BALANCE,
+                                    None, None, "Saldo anterior al registro de movimientos")
+        self.usage = state['usage']
+        self.usage_rollup = {tuple(key): value for key, value in state['usage_rollup']}
+        self.active_users = {day: set(users) for day, users in state['active_users'].items()}
+        self.payments = state['payments']
+        self.revenue_rollup = {tuple(key): value for key, value in state['revenue_rollup']}
+        self.broadcasts = {job['job_id']: job for job in state.get('broadcasts', [])}
+        self.broadcast_results = {job_id: {} for job_id in self.broadcasts}
+        for job_id, user_id, status, error, sent_at in state.get('broadcast_results', []):
+            self.broadcast_results.setdefault(job_id, {})[user_id] = (status, error, sent_at)
+        self.processed_updates = {update_id: processed_at for update_id, processed_at in state.get('processed_updates', [])}
+        logger.info(f"Memory storage snapshot loaded from {path}")
+
+    def _snapshot_loop(self, interval):
+        while not self._stop_event.wait(interval):
+            try:
+                self.save_snapshot()
+            except Exception as e:
+                logger.error(f"Error saving memory storage snapshot: {e}")
+
+    def close(self):
+        """Stop the snapshot thread and write a final snapshot."""
+        self._stop_event.set()
+        if self.snapshot_path:
+            self.save_snapshot()
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def create_storage(kind=STORAGE_BACKEND):
+    """Build a backend by name ('sqlite' or 'memory')."""
+    if kind == 'memory':
+        return MemoryStorage(MEMORY_SNAPSHOT_PATH, MEMORY_SNAPSHOT_INTERVAL_SECONDS if MEMORY_SNAPSHOT_PATH else None)
+    if kind == 'sqlite':
+        from sqlite_storage import SQLiteStorage
+        from database import DATABASE_PATH
+        return SQLiteStorage(DATABASE_PATH, USAGE_ARCHIVE_DIR)
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+
+def get_storage():
+    """Return the process-wide backend, creating it on first use."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+
+def set_storage(backend):
+    """Replace the process-wide backend (tests, benchmarks)."""
+    global _storage
+    _storage = backend
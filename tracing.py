@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import functools
+import contextvars
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+# Trace ids are attached to every log record so lines from bot.py, database.py
+# and paypal_payment.py can be tied to the same Telegram update or HTTP request.
+_log_record_factory = logging.getLogRecordFactory()
+
+
+def _record_factory(*args, **kwargs):
+    record = _log_record_factory(*args, **kwargs)
+    span = _current_span.get()
+    record.trace_id = span.trace_id if span else "-"
+    return record
+
+
+logging.setLogRecordFactory(_record_factory)
+
+# Configure logging (this module is imported before the others configure it,
+# so the trace id ends up in every log line)
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'false').lower() == 'true'
+TRACE_EXPORT_PATH = os.getenv('TRACE_EXPORT_PATH', 'traces.jsonl')
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'creavisionbot')
+EXPORT_BATCH_SIZE = 100
+EXPORT_INTERVAL_SECONDS = 2
+
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+# OTLP status codes
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def _new_id(num_bytes):
+    return os.urandom(num_bytes).hex()
+
+
+def _attribute_value(value):
+    """Convert a Python value into an OTLP AnyValue."""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Span:
+    """A timed operation inside a trace. Use as a context manager."""
+
+    def __init__(self, name, kind=SPAN_KIND_INTERNAL, attributes=None, new_trace=False):
+        parent = None if new_trace else _current_span.get()
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.trace_id = parent.trace_id if parent else _new_id(16)
+        self.parent_span_id = parent.span_id if parent else None
+        self.span_id = _new_id(8)
+        self.status = STATUS_OK
+        self.status_message = None
+        self.start_ns = None
+        self.duration_ns = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._perf_start = time.perf_counter_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration_ns = time.perf_counter_ns() - self._perf_start
+        if exc is not None:
+            self.status = STATUS_ERROR
+            self.status_message = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+        if TRACING_ENABLED:
+            _exporter.submit(self)
+        return False
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.start_ns + self.duration_ns),
+            "attributes": [
+                {"key": key, "value": _attribute_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": self.status},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+class _FileExporter:
+    """Batches finished spans and appends them to a JSON lines file.
+
+    Each line is an OTLP/JSON ExportTraceServiceRequest, the same layout the
+    OpenTelemetry collector file exporter produces.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, span):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        self._queue.put(span)
+
+    def _drain(self):
+        spans = []
+        while len(spans) < EXPORT_BATCH_SIZE:
+            try:
+                spans.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return spans
+
+    def flush(self):
+        """Write every queued span to disk."""
+        spans = self._drain()
+        while spans:
+            self._write(spans)
+            spans = self._drain()
+
+    def _write(self, spans):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "tracing"},
+                    "spans": [span.to_otlp() for span in spans],
+                }],
+            }]
+        }
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.error(f"Error exporting spans: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(EXPORT_INTERVAL_SECONDS)
+            self.flush()
+
+
+_exporter = _FileExporter(TRACE_EXPORT_PATH)
+
+
+def span(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    """Open a child span of the current span (or a new trace if there is none)."""
+    return Span(name, kind, attributes)
+
+
+def start_trace(name, kind=SPAN_KIND_SERVER, **attributes):
+    """Open a root span with a fresh trace id."""
+    return Span(name, kind, attributes, new_trace=True)
+
+
+def current_trace_id():
+    current = _current_span.get()
+    return current.trace_id if current else None
+
+
+def flush():
+    """Export pending spans synchronously (e.g. before shutdown)."""
+    if TRACING_ENABLED:
+        _exporter.flush()
+
+
+def traced(name=None, kind=SPAN_KIND_INTERNAL):
+    """Decorator that wraps a function call in a span."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(span_name, kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_update(func):
+    """Wrap a Telegram handler so every update gets its own trace.
+
+    If the handler is called from inside another traced handler it becomes a
+    child span of that trace instead.
+    """
+    @functools.wraps(func)
+    def wrapper(update, context, *args, **kwargs):
+        attributes = {"telegram.update_id": getattr(update, "update_id", None) or 0}
+        user = getattr(update, "effective_user", None)
+        if user is not None:
+            attributes["telegram.user_id"] = user.id
+        with Span(f"telegram.{func.__name__}", SPAN_KIND_SERVER, attributes):
+            return func(update, context, *args, **kwargs)
+    return wrapper
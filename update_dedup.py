@@ -0,0 +1,152 @@
+import os
+import math
+import hashlib
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from telegram.ext import DispatcherHandlerStop
+from tracing import start_trace
+from storage import get_storage
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Telegram keeps unconfirmed updates for 24 hours, so ids older than this can
+# never be delivered again
+UPDATE_DEDUP_RETENTION_HOURS = float(os.getenv('UPDATE_DEDUP_RETENTION_HOURS', '48'))
+# Redeliveries are almost always of the last batch (at most 100 updates per
+# getUpdates); the ring answers those exactly without a query
+UPDATE_DEDUP_RING_SIZE = 1024
+UPDATE_DEDUP_BLOOM_CAPACITY = int(os.getenv('UPDATE_DEDUP_BLOOM_CAPACITY', '200000'))
+UPDATE_DEDUP_BLOOM_ERROR_RATE = 0.001
+UPDATE_DEDUP_PRUNE_INTERVAL_HOURS = 6
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over integer keys (no false negatives)."""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(str(key).encode('ascii'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class UpdateDeduplicator:
+    """Remembers which Telegram updates were already handled, across restarts.
+
+    The last ring_size ids are kept exactly in memory: a redelivery of one of
+    them (the usual case, the last getUpdates batch) is skipped without a
+    query. Any other id costs one INSERT OR IGNORE, which both records it
+    before its handlers run and tells whether it was handled before. All
+    retained ids are also kept in a Bloom filter, which only answers when
+    storage fails. Both are rebuilt from storage on load().
+    """
+
+    def __init__(self, ring_size=UPDATE_DEDUP_RING_SIZE, bloom_capacity=UPDATE_DEDUP_BLOOM_CAPACITY,
+                 retention_hours=UPDATE_DEDUP_RETENTION_HOURS):
+        self.ring_size = ring_size
+        self.bloom_capacity = bloom_capacity
+        self.retention_hours = retention_hours
+        self._ring = deque()
+        self._ring_ids = set()
+        self._bloom = BloomFilter(bloom_capacity, UPDATE_DEDUP_BLOOM_ERROR_RATE)
+        self._lock = threading.Lock()
+
+    def _cutoff(self):
+        return (datetime.utcnow() - timedelta(hours=self.retention_hours)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def _remember(self, update_id):
+        self._ring.append(update_id)
+        self._ring_ids.add(update_id)
+        if len(self._ring) > self.ring_size:
+            self._ring_ids.discard(self._ring.popleft())
+        self._bloom.add(update_id)
+
+    def load(self):
+        """Rebuild the ring and the Bloom filter from the ids in storage. Returns how many."""
+        try:
+            update_ids = get_storage().get_processed_update_ids(self._cutoff())
+        except Exception as e:
+            logger.error(f"Error loading processed update ids: {e}")
+            return 0
+        with self._lock:
+            self._ring.clear()
+            self._ring_ids.clear()
+            # A Bloom filter cannot forget, so pruned ids only leave it here
+            self._bloom = BloomFilter(max(self.bloom_capacity, len(update_ids)), UPDATE_DEDUP_BLOOM_ERROR_RATE)
+            for update_id in update_ids:
+                self._remember(update_id)
+        logger.info(f"Loaded {len(update_ids)} processed update ids")
+        return len(update_ids)
+
+    def check_and_record(self, update_id):
+        """Record update_id. Returns False if it was handled before."""
+        with self._lock:
+            if update_id in self._ring_ids:
+                return False
+            maybe_seen = update_id in self._bloom
+            self._remember(update_id)
+        try:
+            return get_storage().record_processed_update(
+                update_id, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            )
+        except Exception as e:
+            logger.error(f"Error recording update {update_id}: {e}")
+            # The filter has no false negatives: at worst a new update is
+            # dropped with probability UPDATE_DEDUP_BLOOM_ERROR_RATE
+            return not maybe_seen
+
+    def prune(self):
+        """Forget ids past the retention window. Returns how many."""
+        try:
+            pruned = get_storage().prune_processed_updates(self._cutoff())
+        except Exception as e:
+            logger.error(f"Error pruning processed update ids: {e}")
+            return 0
+        if pruned:
+            logger.info(f"Pruned {pruned} processed update ids")
+            self.load()
+        return pruned
+
+
+update_deduplicator = UpdateDeduplicator()
+
+
+def skip_duplicate_update(update, context):
+    """Stop a redelivered update before any handler does work for it.
+
+    Registered as the only handler of group -1, which runs before the others.
+    """
+    update_id = getattr(update, 'update_id', None)
+    if update_id is None:
+        return
+    if not update_deduplicator.check_and_record(update_id):
+        logger.warning(f"Skipping update {update_id}: it was already handled")
+        raise DispatcherHandlerStop()
+
+
+def update_dedup_prune_loop(interval_hours=UPDATE_DEDUP_PRUNE_INTERVAL_HOURS, stop_event=None):
+    """Prune processed update ids periodically (run in a daemon thread)."""
+    stop_event = stop_event or threading.Event()
+    while not stop_event.wait(interval_hours * 3600):
+        with start_trace("maintenance.prune_processed_updates"):
+            update_deduplicator.prune()
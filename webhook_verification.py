@@ -0,0 +1,164 @@
+import os
+import time
+import zlib
+import base64
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import requests
+from tracing import span, SPAN_KIND_CLIENT
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Id of the webhook in the PayPal developer dashboard; it is part of what PayPal signs
+PAYPAL_WEBHOOK_ID = os.getenv('PAYPAL_WEBHOOK_ID')
+# Signing certificates are only downloaded from these hosts (over HTTPS)
+PAYPAL_CERT_HOSTS = ('api.paypal.com', 'api-m.paypal.com', 'api.sandbox.paypal.com', 'api-m.sandbox.paypal.com')
+CERT_CACHE_TTL_SECONDS = 24 * 3600
+CERT_FETCH_TIMEOUT_SECONDS = 10
+# Events older than this are rejected, so the replay cache only needs to
+# remember transmission ids for this long
+WEBHOOK_MAX_AGE_SECONDS = 3600
+WEBHOOK_MAX_CLOCK_SKEW_SECONDS = 300
+REPLAY_CACHE_SIZE = 10000
+SUPPORTED_AUTH_ALGO = 'SHA256withRSA'
+
+
+class WebhookVerificationError(Exception):
+    """The webhook could not be proven to come from PayPal."""
+
+
+class WebhookReplayError(WebhookVerificationError):
+    """A correctly signed webhook whose transmission id was already processed."""
+
+
+class CertificateCache:
+    """Public keys of PayPal's signing certificates, by URL, kept for a TTL."""
+
+    def __init__(self, ttl_seconds=CERT_CACHE_TTL_SECONDS, allowed_hosts=PAYPAL_CERT_HOSTS):
+        self.ttl_seconds = ttl_seconds
+        self.allowed_hosts = allowed_hosts
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def public_key(self, cert_url):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._keys.get(cert_url)
+            if entry and entry[0] > now:
+                return entry[1]
+        # Fetched outside the lock; two threads may both download a new cert once
+        key = self._download(cert_url)
+        with self._lock:
+            self._keys[cert_url] = (now + self.ttl_seconds, key)
+        return key
+
+    def _download(self, cert_url):
+        from cryptography import x509
+
+        parsed = urlparse(cert_url or '')
+        if parsed.scheme != 'https' or parsed.hostname not in self.allowed_hosts:
+            raise WebhookVerificationError(f"Certificate URL not allowed: {cert_url}")
+        with span("paypal.get_webhook_cert", SPAN_KIND_CLIENT):
+            response = requests.get(cert_url, timeout=CERT_FETCH_TIMEOUT_SECONDS)
+        if response.status_code != 200:
+            raise WebhookVerificationError(f"Could not download certificate ({response.status_code})")
+        certificate = x509.load_pem_x509_certificate(response.content)
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if not certificate.not_valid_before <= now <= certificate.not_valid_after:
+            raise WebhookVerificationError("Certificate is not valid at this time")
+        logger.info(f"Cached PayPal webhook certificate from {cert_url}")
+        return certificate.public_key()
+
+
+class ReplayCache:
+    """Transmission ids seen in the last max_age_seconds (bounded in size)."""
+
+    def __init__(self, max_age_seconds=WEBHOOK_MAX_AGE_SECONDS, max_size=REPLAY_CACHE_SIZE):
+        self.max_age_seconds = max_age_seconds
+        self.max_size = max_size
+        self._seen = OrderedDict()  # transmission_id -> time.monotonic() when seen, oldest first
+        self._lock = threading.Lock()
+
+    def check_and_add(self, transmission_id):
+        """Remember transmission_id. Returns False if it was already seen."""
+        now = time.monotonic()
+        with self._lock:
+            while self._seen:
+                oldest_id, seen_at = next(iter(self._seen.items()))
+                if now - seen_at < self.max_age_seconds and len(self._seen) < self.max_size:
+                    break
+                del self._seen[oldest_id]
+            if transmission_id in self._seen:
+                return False
+            self._seen[transmission_id] = now
+            return True
+
+    def forget(self, transmission_id):
+        """Let a transmission be processed again (its handling failed)."""
+        with self._lock:
+            self._seen.pop(transmission_id, None)
+
+
+certificates = CertificateCache()
+replay_cache = ReplayCache()
+
+
+def _parse_transmission_time(value):
+    try:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        raise WebhookVerificationError(f"Invalid transmission time: {value}")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def verify_webhook(headers, body, webhook_id=PAYPAL_WEBHOOK_ID):
+    """Check a PayPal webhook locally, without calling verify-webhook-signature.
+
+    PayPal signs '<transmission id>|<transmission time>|<webhook id>|<crc32 of
+    the body>' with SHA256withRSA; the certificate is downloaded once per URL
+    and cached. headers must be case-insensitive (Flask's are), body the raw
+    request bytes. Raises WebhookVerificationError (WebhookReplayError for a
+    valid event seen before).
+    """
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    if not webhook_id:
+        raise WebhookVerificationError("PAYPAL_WEBHOOK_ID is not configured")
+    transmission_id = headers.get('PAYPAL-TRANSMISSION-ID')
+    transmission_time = headers.get('PAYPAL-TRANSMISSION-TIME')
+    signature = headers.get('PAYPAL-TRANSMISSION-SIG')
+    cert_url = headers.get('PAYPAL-CERT-URL')
+    auth_algo = headers.get('PAYPAL-AUTH-ALGO')
+    if not all((transmission_id, transmission_time, signature, cert_url)):
+        raise WebhookVerificationError("Missing PayPal signature headers")
+    if auth_algo != SUPPORTED_AUTH_ALGO:
+        raise WebhookVerificationError(f"Unsupported signature algorithm: {auth_algo}")
+
+    age = (datetime.now(timezone.utc) - _parse_transmission_time(transmission_time)).total_seconds()
+    if age > WEBHOOK_MAX_AGE_SECONDS or age < -WEBHOOK_MAX_CLOCK_SKEW_SECONDS:
+        raise WebhookVerificationError(f"Transmission time out of range: {transmission_time}")
+
+    crc = zlib.crc32(body) & 0xffffffff
+    message = f"{transmission_id}|{transmission_time}|{webhook_id}|{crc}".encode('utf-8')
+    try:
+        certificates.public_key(cert_url).verify(
+            base64.b64decode(signature), message, padding.PKCS1v15(), hashes.SHA256()
+        )
+    except (InvalidSignature, ValueError) as e:
+        raise WebhookVerificationError(f"Invalid signature: {e}")
+
+    # Only signed events reach the replay cache, so forged ones cannot fill it
+    if not replay_cache.check_and_add(transmission_id):
+        raise WebhookReplayError(f"Transmission {transmission_id} was already processed")